@@ -2,6 +2,8 @@ import argparse
 import os
 import logging
 
+from typing import Optional
+
 from millegrilles_messages.bus.BusConfiguration import MilleGrillesBusConfiguration
 
 # Configuration loader.
@@ -10,10 +12,45 @@ from millegrilles_messages.bus.BusConfiguration import MilleGrillesBusConfigurat
 # Environment variables
 ENV_DIR_DATA = 'DIR_DATA'
 ENV_FILEHOST_WEB_URL = 'FILEHOST_WEB_URL'
+ENV_MEMORY_BUDGET = 'MEMORY_BUDGET'
+ENV_THUMBNAIL_MAX_DIMENSION = 'THUMBNAIL_MAX_DIMENSION'
+ENV_THUMBNAIL_QUALITY = 'THUMBNAIL_QUALITY'
+ENV_THUMBNAIL_FORMAT = 'THUMBNAIL_FORMAT'
+ENV_PACK_MEMBER_SIZE = 'PACK_MEMBER_SIZE'
+ENV_METRICS_PORT = 'METRICS_PORT'
+ENV_METRICS_HOST = 'METRICS_HOST'
+ENV_METRICS_LOG_INTERVAL = 'METRICS_LOG_INTERVAL'
+ENV_LOOP_STALL_THRESHOLD = 'LOOP_STALL_THRESHOLD'
+ENV_SCRAPE_CONCURRENCY = 'SCRAPE_CONCURRENCY'
+ENV_SCRAPE_THROTTLE = 'SCRAPE_THROTTLE'
+ENV_SCRAPE_DEADLINE = 'SCRAPE_DEADLINE'
+ENV_HTTP_CAPTURE_MODE = 'HTTP_CAPTURE_MODE'
+ENV_HTTP_CAPTURE_LATENCY = 'HTTP_CAPTURE_LATENCY'
+ENV_MAX_BODY_SIZE = 'MAX_BODY_SIZE'
+ENV_IO_THREADS = 'IO_THREADS'
+ENV_CPU_THREADS = 'CPU_THREADS'
+ENV_COST_WINDOW = 'COST_WINDOW'
+ENV_COST_REPORT_INTERVAL = 'COST_REPORT_INTERVAL'
+ENV_COST_TRACEMALLOC = 'COST_TRACEMALLOC'
+ENV_BUS_BATCH_WINDOW = 'BUS_BATCH_WINDOW'
 
 # Default values
 DEFAULT_DIR_DATA="/var/opt/millegrilles/web_scraper/data"
 DEFAULT_FILEHOST_WEB_URL = 'https://filehost:1443/'
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024  # Bytes buffered in memory by all scrapers at the same time
+DEFAULT_THUMBNAIL_QUALITY = 80
+DEFAULT_THUMBNAIL_FORMAT = 'webp'
+DEFAULT_METRICS_HOST = '127.0.0.1'
+DEFAULT_METRICS_LOG_INTERVAL = 300
+DEFAULT_LOOP_STALL_THRESHOLD = 0.5  # Seconds, 0 disables the event loop monitor
+DEFAULT_SCRAPE_CONCURRENCY = 1  # Number of feeds scraped at the same time
+DEFAULT_SCRAPE_THROTTLE = 5  # Seconds to wait after a scrape before releasing its slot
+DEFAULT_SCRAPE_DEADLINE = 600  # Maximum seconds of a scrape, shorter for feeds polled more often
+DEFAULT_HTTP_CAPTURE_LATENCY = 0.0  # Seconds added to each response in replay mode
+DEFAULT_MAX_BODY_SIZE = 100_000_000  # Bytes of a downloaded body (encoded and decoded), feeds can set a lower limit
+DEFAULT_IO_THREADS = 16  # Threads for blocking file I/O (spools, temporary files, state files)
+DEFAULT_COST_WINDOW = 300  # Seconds per window of the feed cost accounting, the last 12 windows are reported
+DEFAULT_BUS_BATCH_WINDOW = 0.02  # Seconds lookups on the bus wait to be combined with other lookups, 0 disables
 
 
 def _parse_command_line():
@@ -47,11 +84,71 @@ class WebScraperConfiguration(MilleGrillesBusConfiguration):
         super().__init__()
         self.dir_data = DEFAULT_DIR_DATA
         self.filehost_web_url = DEFAULT_FILEHOST_WEB_URL
+        self.memory_budget = DEFAULT_MEMORY_BUDGET
+        self.thumbnail_max_dimension: Optional[int] = None  # Thumbnails are uploaded as-is when not set
+        self.thumbnail_quality = DEFAULT_THUMBNAIL_QUALITY
+        self.thumbnail_format = DEFAULT_THUMBNAIL_FORMAT
+        self.pack_member_size: Optional[int] = None  # Largest encrypted file grouped in a pack file, no packs when not set
+        self.metrics_port: Optional[int] = None  # Metrics http endpoint is disabled when not set
+        self.metrics_host = DEFAULT_METRICS_HOST
+        self.metrics_log_interval = DEFAULT_METRICS_LOG_INTERVAL
+        self.loop_stall_threshold = DEFAULT_LOOP_STALL_THRESHOLD
+        self.scrape_concurrency = DEFAULT_SCRAPE_CONCURRENCY
+        self.scrape_throttle = DEFAULT_SCRAPE_THROTTLE
+        self.scrape_deadline = DEFAULT_SCRAPE_DEADLINE
+        self.http_capture_mode: Optional[str] = None  # record or replay, http exchanges are not captured when not set
+        self.http_capture_latency = DEFAULT_HTTP_CAPTURE_LATENCY
+        self.max_body_size = DEFAULT_MAX_BODY_SIZE
+        self.io_threads = DEFAULT_IO_THREADS
+        self.cpu_threads: Optional[int] = None  # Threads for parsing, hashing, encryption and compression, defaults to the core count
+        self.cost_window = DEFAULT_COST_WINDOW
+        self.cost_report_interval: Optional[int] = None  # Seconds between feedCosts events on the bus, not emitted when not set
+        self.cost_tracemalloc = False  # Sample the allocation peak of process() with tracemalloc, adds overhead
+        self.bus_batch_window = DEFAULT_BUS_BATCH_WINDOW
 
     def parse_config(self):
         super().parse_config()
         self.dir_data = os.environ.get(ENV_DIR_DATA) or self.dir_data
         self.filehost_web_url = os.environ.get(ENV_FILEHOST_WEB_URL) or self.filehost_web_url
+        self.memory_budget = int(os.environ.get(ENV_MEMORY_BUDGET) or self.memory_budget)
+        thumbnail_max_dimension = os.environ.get(ENV_THUMBNAIL_MAX_DIMENSION)
+        if thumbnail_max_dimension:
+            self.thumbnail_max_dimension = int(thumbnail_max_dimension)
+        self.thumbnail_quality = int(os.environ.get(ENV_THUMBNAIL_QUALITY) or self.thumbnail_quality)
+        self.thumbnail_format = os.environ.get(ENV_THUMBNAIL_FORMAT) or self.thumbnail_format
+        pack_member_size = os.environ.get(ENV_PACK_MEMBER_SIZE)
+        if pack_member_size:
+            self.pack_member_size = int(pack_member_size)
+        metrics_port = os.environ.get(ENV_METRICS_PORT)
+        if metrics_port:
+            self.metrics_port = int(metrics_port)
+        self.metrics_host = os.environ.get(ENV_METRICS_HOST) or self.metrics_host
+        self.metrics_log_interval = int(os.environ.get(ENV_METRICS_LOG_INTERVAL) or self.metrics_log_interval)
+        loop_stall_threshold = os.environ.get(ENV_LOOP_STALL_THRESHOLD)
+        if loop_stall_threshold is not None:
+            self.loop_stall_threshold = float(loop_stall_threshold)
+        self.scrape_concurrency = int(os.environ.get(ENV_SCRAPE_CONCURRENCY) or self.scrape_concurrency)
+        scrape_throttle = os.environ.get(ENV_SCRAPE_THROTTLE)
+        if scrape_throttle is not None:
+            self.scrape_throttle = int(scrape_throttle)
+        self.scrape_deadline = float(os.environ.get(ENV_SCRAPE_DEADLINE) or self.scrape_deadline)
+        self.http_capture_mode = os.environ.get(ENV_HTTP_CAPTURE_MODE) or self.http_capture_mode
+        self.http_capture_latency = float(os.environ.get(ENV_HTTP_CAPTURE_LATENCY) or self.http_capture_latency)
+        self.max_body_size = int(os.environ.get(ENV_MAX_BODY_SIZE) or self.max_body_size)
+        self.io_threads = int(os.environ.get(ENV_IO_THREADS) or self.io_threads)
+        cpu_threads = os.environ.get(ENV_CPU_THREADS)
+        if cpu_threads:
+            self.cpu_threads = int(cpu_threads)
+        self.cost_window = int(os.environ.get(ENV_COST_WINDOW) or self.cost_window)
+        cost_report_interval = os.environ.get(ENV_COST_REPORT_INTERVAL)
+        if cost_report_interval:
+            self.cost_report_interval = int(cost_report_interval)
+        cost_tracemalloc = os.environ.get(ENV_COST_TRACEMALLOC)
+        if cost_tracemalloc:
+            self.cost_tracemalloc = cost_tracemalloc.lower() in ('1', 'true', 'yes')
+        bus_batch_window = os.environ.get(ENV_BUS_BATCH_WINDOW)
+        if bus_batch_window is not None:
+            self.bus_batch_window = float(bus_batch_window)
 
     @staticmethod
     def load():
@@ -0,0 +1,123 @@
+import zlib
+
+from typing import Callable, Optional
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DECODE_CHUNK_SIZE = 1024 * 1024  # Largest piece of decoded content produced at once, bounds compression bombs
+
+# Transport encodings that can be kept as-is in the stored files (e.g. AttachedFile compression)
+PASSTHROUGH_ENCODINGS = {'gzip'}
+
+# Brotli before 1.2 has no output limit, a small input can be decoded to gigabytes in a single call
+BROTLI_BOUNDED = brotli is not None and hasattr(brotli.Decompressor, 'can_accept_more_data')
+
+
+class UnsupportedEncodingError(ValueError):
+    """ The content coding of a response cannot be decoded (unknown or stacked codings). """
+
+
+def supported_encodings() -> list[str]:
+    """ :return: Content codings that can be decoded, in order of preference """
+    encodings = list()
+    if zstandard is not None:
+        encodings.append('zstd')
+    if BROTLI_BOUNDED:
+        encodings.append('br')
+    encodings.extend(['gzip', 'deflate'])
+    return encodings
+
+
+def accept_encoding() -> str:
+    """ :return: Value of the Accept-Encoding request header """
+    return ', '.join(supported_encodings())
+
+
+def content_coding(value: Optional[str]) -> Optional[str]:
+    """
+    :param value: Content-Encoding response header
+    :return: Content coding to decode, None for identity
+    :raises UnsupportedEncodingError: The coding is not supported or many codings are applied
+    """
+    if value is None:
+        return None
+    value = value.strip().lower()
+    if value in ('', 'identity'):
+        return None
+    if value == 'x-gzip':
+        value = 'gzip'
+    if value in supported_encodings():
+        return value
+    raise UnsupportedEncodingError('Unsupported content encoding %s' % value)
+
+
+class ContentDecoder:
+    """
+    Streaming decoder of a response body. Decoded content is passed to write() in pieces of at most
+    DECODE_CHUNK_SIZE bytes (brotli may round up), write() can raise to abort the download (e.g. size limit) before more is decoded.
+    """
+
+    def __init__(self, encoding: str, write: Callable[[bytes], None]):
+        self.encoding = encoding
+        self.__write = write
+        self.__first = True
+        if encoding == 'gzip':
+            self.__decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self.__decoder = zlib.decompressobj(zlib.MAX_WBITS)
+        elif encoding == 'br' and BROTLI_BOUNDED:
+            self.__decoder = brotli.Decompressor()
+        elif encoding == 'zstd' and zstandard is not None:
+            # The decompressobj has no output limit, the stream writer hands out write_size pieces as they are decoded
+            self.__decoder = zstandard.ZstdDecompressor().stream_writer(
+                _WriteSink(write), write_size=DECODE_CHUNK_SIZE, closefd=False)
+        else:
+            raise UnsupportedEncodingError('Unsupported content encoding %s' % encoding)
+
+    def decode(self, chunk: bytes):
+        if self.encoding == 'br':
+            piece = self.__decoder.process(chunk, output_buffer_limit=DECODE_CHUNK_SIZE)
+            self.__write(piece)
+            while not self.__decoder.can_accept_more_data():
+                # Output limit reached, the rest of the input is kept by the decoder
+                self.__write(self.__decoder.process(b'', output_buffer_limit=DECODE_CHUNK_SIZE))
+        elif self.encoding == 'zstd':
+            self.__decoder.write(chunk)
+        else:
+            if self.__first and self.encoding == 'deflate':
+                self.__first = False
+                if len(chunk) > 0 and chunk[0] & 0x0f != 8:
+                    # Raw deflate sent without the zlib header
+                    self.__decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            data = chunk
+            while len(data) > 0:
+                self.__write(self.__decoder.decompress(data, DECODE_CHUNK_SIZE))
+                data = self.__decoder.unconsumed_tail
+
+    def flush(self):
+        if self.encoding in ('gzip', 'deflate'):
+            self.__write(self.__decoder.flush())
+        elif self.encoding == 'zstd':
+            self.__decoder.flush()
+
+
+class _WriteSink:
+    """ File-like target of the zstd stream writer """
+
+    def __init__(self, write: Callable[[bytes], None]):
+        self.__write = write
+
+    def write(self, data: bytes) -> int:
+        self.__write(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
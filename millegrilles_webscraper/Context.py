@@ -1,4 +1,6 @@
 import logging
+import os
+import tracemalloc
 
 from typing import Optional
 
@@ -6,6 +8,12 @@ from millegrilles_webscraper.Configuration import WebScraperConfiguration
 from millegrilles_messages.bus.BusContext import MilleGrillesBusContext
 from millegrilles_messages.bus.PikaConnector import MilleGrillesPikaConnector
 from millegrilles_webscraper.DataStructures import AttachedFileInterface
+from millegrilles_webscraper.Executors import EXECUTOR_CPU, EXECUTOR_IO, InstrumentedExecutor
+from millegrilles_webscraper.FeedCosts import FeedCostRegistry
+from millegrilles_webscraper.InstrumentedProducer import InstrumentedProducer
+from millegrilles_webscraper.MemoryBudget import MemoryBudget
+from millegrilles_webscraper.Metrics import MetricsRegistry
+from millegrilles_webscraper.RequestBatcher import RequestBatcher
 
 LOGGER = logging.getLogger(__name__)
 
@@ -17,7 +25,41 @@ class WebScraperContext(MilleGrillesBusContext):
         self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
         self.__bus_connector: Optional[MilleGrillesPikaConnector] = None
         self.__file_handler: Optional[AttachedFileInterface] = None
-        self.__scrape_throttle_seconds: Optional[int] = 5
+        self.__http_client = None
+        self.__scrape_throttle_seconds: Optional[int] = configuration.scrape_throttle
+        self.__scrape_deadline_seconds: float = configuration.scrape_deadline
+        self.__memory_budget = MemoryBudget(configuration.memory_budget)
+        self.__metrics = MetricsRegistry()
+        self.__io_executor = InstrumentedExecutor(EXECUTOR_IO, configuration.io_threads, self.__metrics)
+        self.__cpu_executor = InstrumentedExecutor(EXECUTOR_CPU, configuration.cpu_threads or os.cpu_count() or 1,
+                                                   self.__metrics)
+        self.__costs = FeedCostRegistry(configuration.cost_window)
+        self.__request_batcher = RequestBatcher(self.__metrics, configuration.bus_batch_window)
+        self.__metrics.add_listener(self.__costs.observe_stage)
+        if configuration.cost_tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        self.__metrics.register_gauge('webscraper_memory_in_use_bytes', lambda: self.__memory_budget.in_use,
+                                      'Bytes reserved in the memory budget')
+        self.__metrics.register_gauge('webscraper_memory_high_water_bytes', lambda: self.__memory_budget.high_water,
+                                      'Highest number of bytes reserved in the memory budget')
+        self.__metrics.register_gauge('webscraper_bus_batched_requests', lambda: self.__request_batcher.stats().requests,
+                                      'Lookups on the bus received by the request batcher')
+        self.__metrics.register_gauge('webscraper_bus_batches', lambda: self.__request_batcher.stats().batches,
+                                      'Combined lookups sent on the bus by the request batcher')
+        for executor in (self.__io_executor, self.__cpu_executor):
+            self.__register_executor_gauges(executor)
+
+    def __register_executor_gauges(self, executor: InstrumentedExecutor):
+        prefix = 'webscraper_executor_%s' % executor.name
+        self.__metrics.register_gauge(prefix + '_queued', lambda: executor.queued,
+                                      'Calls waiting for a thread of the %s executor' % executor.name)
+        self.__metrics.register_gauge(prefix + '_running', lambda: executor.running,
+                                      'Calls running in the %s executor' % executor.name)
+        self.__metrics.register_gauge(prefix + '_wait_seconds_total', lambda: executor.stats().wait_seconds,
+                                      'Total seconds calls waited for a thread of the %s executor' % executor.name)
+        self.__metrics.register_gauge(prefix + '_run_seconds_total', lambda: executor.stats().run_seconds,
+                                      'Total seconds of calls run by the %s executor' % executor.name)
 
     @property
     def bus_connector(self):
@@ -35,9 +77,44 @@ class WebScraperContext(MilleGrillesBusContext):
     def file_handler(self, value: AttachedFileInterface):
         self.__file_handler = value
 
+    @property
+    def http_client(self):
+        return self.__http_client
+
+    @http_client.setter
+    def http_client(self, value):
+        self.__http_client = value
+
     async def get_producer(self):
-        return await self.__bus_connector.get_producer()
+        producer = await self.__bus_connector.get_producer()
+        return InstrumentedProducer(producer, self.__metrics, self.__request_batcher)
 
     @property
     def scrape_throttle_seconds(self) -> Optional[int]:
         return self.__scrape_throttle_seconds
+
+    @property
+    def scrape_deadline_seconds(self) -> float:
+        return self.__scrape_deadline_seconds
+
+    @property
+    def memory_budget(self) -> MemoryBudget:
+        return self.__memory_budget
+
+    @property
+    def metrics(self) -> MetricsRegistry:
+        return self.__metrics
+
+    @property
+    def costs(self) -> FeedCostRegistry:
+        return self.__costs
+
+    @property
+    def io_executor(self) -> InstrumentedExecutor:
+        """ Blocking file I/O: reads and writes of spools, temporary files and state files. """
+        return self.__io_executor
+
+    @property
+    def cpu_executor(self) -> InstrumentedExecutor:
+        """ CPU bound work: parsing, hashing, encryption, compression, image processing. """
+        return self.__cpu_executor
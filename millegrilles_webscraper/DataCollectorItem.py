@@ -1,14 +1,18 @@
 from typing import TypedDict, Optional
 
+from millegrilles_webscraper.DataStructures import PackReference
+
 
 class DecryptionInfo(TypedDict):
     cle_id: str
     nonce: str
     format: str
+    compression: Optional[str]  # Set when the decrypted content is compressed (e.g. gzip)
 
 class DataCollectorFilesDict(TypedDict):
     fuuid: str
     decryption: DecryptionInfo
+    pack: Optional[PackReference]  # Location of the file when it is a member of a pack file
 
 class DataCollectorDict(TypedDict):
     data_id: str
@@ -2,25 +2,53 @@ import datetime
 from typing import Optional, TypedDict
 
 
+class PackReference(TypedDict):
+    fuuid: str      # Fuuid of the pack file on the filehost
+    offset: int     # Position of the member in the pack
+    size: int       # Size of the encrypted member
+
+
 class AttachedFile(TypedDict):
     fuuid: str
     format: str
     nonce: str
     cle_id: Optional[str]
     compression: Optional[str]
+    pack: Optional[PackReference]  # Set when the file is a member of a pack file
 
 
 class AttachedFileInterface:
 
-    def encrypt_upload_file(self, secret_key: bytes, fp) -> AttachedFile:
+    def encrypt_upload_file(self, secret_key: bytes, fp, key_id: Optional[str] = None,
+                            thumbnail: bool = False, compression: Optional[str] = None,
+                            key_domains: Optional[list[str]] = None) -> AttachedFile:
         """
         Encrypts and uploads a file to the filehost
         :param secret_key: Secret encryption key
         :param fp: File handle at the proper position for reading content
+        :param key_id: Id of the secret key. When provided, identical content uploaded previously can be reused.
+        :param thumbnail: Content is an image displayed as a thumbnail, it can be downscaled before upload.
+        :param compression: Content is already compressed (e.g. gzip), readers decompress it after decryption.
+        :param key_domains: Domains of the secret key, content is only reused from keys of the same domains.
         :return:
         """
         raise NotImplementedError('interface method - must override')
 
+    def confirm_key(self, key_id: str):
+        """
+        Signals that the key was saved by MaitreDesCles. Files encrypted with this key can be reused by other feeds.
+        :param key_id: Id of the secret key
+        """
+        raise NotImplementedError('interface method - must override')
+
+    def pack(self):
+        """
+        Async context manager. Small files uploaded by the current task inside the context can be grouped in pack
+        files, uploaded at the latest when the context exits. The pack of the returned attached files is set once
+        uploaded, use the references only after the context exits.
+        """
+        raise NotImplementedError('interface method - must override')
+
 
 class AttachedFileCorrelation:
 
@@ -31,6 +59,7 @@ class AttachedFileCorrelation:
         self.cle_id: Optional[str] = None
         self.nonce: Optional[str] = None
         self.compression: Optional[str] = None
+        self.pack: Optional[PackReference] = None
 
     def to_attached_file(self) -> AttachedFile:
         if self.fuuid is None or self.format is None or self.nonce is None:
@@ -41,7 +70,8 @@ class AttachedFileCorrelation:
             "format": self.format,
             "nonce": self.nonce,
             "cle_id": self.cle_id,
-            "compression": self.compression
+            "compression": self.compression,
+            "pack": self.pack,
         }
 
     def map_key(self) -> Optional[str]:
@@ -57,6 +87,7 @@ class AttachedFileCorrelation:
         self.nonce = data.get('nonce')
         self.cle_id = data.get('cle_id')
         self.compression = data.get('compression')
+        self.pack = data.get('pack')
 
 
 class CustomProcessOutput:
@@ -78,6 +109,13 @@ class DataCollectorTransaction(TypedDict):
     attached_fuuids: Optional[list[str]]
 
 
+class DeltaReference(TypedDict):
+    format: str             # Delta encoding, mgdelta1
+    base_fuuid: str         # Data file of the previous version, the delta applies to its content
+    keyframe_fuuid: str     # Data file of the last full version of the chain
+    sequence: int           # Number of deltas since the keyframe, 1 for the first delta
+
+
 class DataFeedFile(TypedDict):
     feed_id: str
     data_id: str
@@ -87,6 +125,7 @@ class DataFeedFile(TypedDict):
     pub_end_date: Optional[int]
     files: Optional[list[AttachedFile]]
     encrypted_files_map: Optional[dict]
+    delta: Optional[DeltaReference]  # Set when encrypted_data is a delta against a previous version
 
 
 class Filehost:
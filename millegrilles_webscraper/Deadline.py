@@ -0,0 +1,83 @@
+import asyncio
+import contextvars
+import time
+
+from typing import Optional
+
+# Deadline of the scrape run by the current task. Propagated to the tasks and executor calls it starts.
+current_deadline: contextvars.ContextVar[Optional['ScrapeDeadline']] = contextvars.ContextVar('current_deadline', default=None)
+
+
+class ScrapeDeadline:
+    """
+    Time budget of a scrape, from the download to the last upload. The scrape task is cancelled when it expires.
+    Metric spans entered under the deadline are tracked to report the stage that was running when it expired.
+    """
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.started = time.monotonic()
+        self.expires = self.started + seconds
+        self.expired_stage: Optional[str] = None
+        self.__stages: list[str] = list()  # Stages in progress, concurrent tasks can run stages in parallel
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires
+
+    @property
+    def stage(self) -> Optional[str]:
+        """ Stage that ran out the clock, or the innermost stage in progress. """
+        if self.expired_stage is not None:
+            return self.expired_stage
+        if len(self.__stages) > 0:
+            return self.__stages[-1]
+        return None
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def timeout(self, seconds: Optional[float] = None) -> float:
+        """
+        :param seconds: Timeout of an operation, None for no limit other than the deadline
+        :return: Timeout capped to the time remaining
+        """
+        if seconds is None:
+            return self.remaining()
+        return min(seconds, self.remaining())
+
+    def enter_stage(self, stage: str):
+        self.__stages.append(stage)
+
+    def exit_stage(self, stage: str, exc_type=None):
+        try:
+            # Remove the latest occurrence, stages of concurrent tasks can be interleaved
+            index = len(self.__stages) - 1 - self.__stages[::-1].index(stage)
+            del self.__stages[index]
+        except ValueError:
+            pass
+        if self.expired_stage is None and exc_type is not None and issubclass(exc_type, asyncio.CancelledError) and self.expired:
+            # Innermost stage cancelled by the deadline, it exits first
+            self.expired_stage = stage
+
+
+def set_current_deadline(deadline: ScrapeDeadline) -> contextvars.Token:
+    return current_deadline.set(deadline)
+
+
+def reset_current_deadline(token: contextvars.Token):
+    current_deadline.reset(token)
+
+
+def deadline_timeout(seconds: Optional[float] = None) -> Optional[float]:
+    """
+    :param seconds: Timeout of an operation, None for no limit
+    :return: Timeout capped to the deadline of the current scrape, unchanged outside a scrape
+    """
+    deadline = current_deadline.get()
+    if deadline is None:
+        return seconds
+    return deadline.timeout(seconds)
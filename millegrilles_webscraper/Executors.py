@@ -0,0 +1,154 @@
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+EXECUTOR_IO = 'io'
+EXECUTOR_CPU = 'cpu'
+
+
+class ExecutorStats:
+
+    def __init__(self, name: str, max_workers: int, queued: int, running: int, completed: int,
+                 wait_seconds: float, max_wait_seconds: float, run_seconds: float):
+        self.name = name
+        self.max_workers = max_workers
+        self.queued = queued
+        self.running = running
+        self.completed = completed
+        self.wait_seconds = wait_seconds
+        self.max_wait_seconds = max_wait_seconds
+        self.run_seconds = run_seconds
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'max_workers': self.max_workers,
+            'queued': self.queued,
+            'running': self.running,
+            'completed': self.completed,
+            'wait_seconds': round(self.wait_seconds, 3),
+            'max_wait_seconds': round(self.max_wait_seconds, 3),
+            'run_seconds': round(self.run_seconds, 3),
+        }
+
+
+class ExecutorCall:
+    """ Timing of a call, perf_counter values. started, ended and cpu are set by the worker thread. """
+
+    def __init__(self):
+        self.submitted = time.perf_counter()
+        self.started: Optional[float] = None
+        self.ended: Optional[float] = None
+        self.cpu: Optional[float] = None  # Thread CPU time of the call
+
+
+class InstrumentedExecutor(ThreadPoolExecutor):
+    """
+    Named thread pool that tracks its queue depth and the time calls wait for a thread and run.
+
+    Use run() from the event loop: the call gets the context of the caller (like asyncio.to_thread) and its wait
+    and run times are recorded as the executor.<name>.wait and executor.<name>.run stages of the current feed, its
+    CPU time as the executor.<name>.cpu stage.
+    Calls submitted directly (e.g. asyncio.to_thread when this is the default executor) are only counted.
+    """
+
+    def __init__(self, name: str, max_workers: int, metrics=None):
+        super().__init__(max_workers=max_workers, thread_name_prefix='webscraper-%s' % name)
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.name = name
+        self.max_workers = max_workers
+        self.__metrics = metrics
+        self.__wait_stage = 'executor.%s.wait' % name
+        self.__run_stage = 'executor.%s.run' % name
+        self.__cpu_stage = 'executor.%s.cpu' % name
+        self.__lock = threading.Lock()
+        self.__submitted = 0
+        self.__started = 0
+        self.__completed = 0
+        self.__wait_seconds = 0.0
+        self.__max_wait_seconds = 0.0
+        self.__run_seconds = 0.0
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        return self.__submit(ExecutorCall(), fn, *args, **kwargs)
+
+    async def run(self, func: Callable, /, *args, **kwargs):
+        """
+        Runs a blocking function in the pool.
+        :return: Result of func
+        """
+        call = ExecutorCall()
+        context = contextvars.copy_context()
+        future = self.__submit(call, context.run, functools.partial(func, *args, **kwargs))
+        try:
+            return await asyncio.wrap_future(future)
+        finally:
+            if self.__metrics is not None and call.started is not None:
+                self.__metrics.observe_stage(self.__wait_stage, call.started - call.submitted)
+                if call.ended is not None:
+                    self.__metrics.observe_stage(self.__run_stage, call.ended - call.started)
+                    self.__metrics.observe_stage(self.__cpu_stage, call.cpu)
+
+    def __submit(self, call: ExecutorCall, fn, /, *args, **kwargs) -> Future:
+        with self.__lock:
+            self.__submitted += 1
+        try:
+            future = super().submit(self.__call, call, fn, args, kwargs)
+        except BaseException as e:
+            with self.__lock:
+                self.__submitted -= 1
+            raise e
+        future.add_done_callback(self.__done)
+        return future
+
+    def __done(self, future: Future):
+        if future.cancelled():
+            # Cancelled before a thread picked it up
+            with self.__lock:
+                self.__submitted -= 1
+
+    def __call(self, call: ExecutorCall, fn, args, kwargs):
+        call.started = time.perf_counter()
+        wait = call.started - call.submitted
+        with self.__lock:
+            self.__started += 1
+            self.__wait_seconds += wait
+            if wait > self.__max_wait_seconds:
+                self.__max_wait_seconds = wait
+        cpu_start = time.thread_time()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            call.cpu = time.thread_time() - cpu_start
+            call.ended = time.perf_counter()
+            with self.__lock:
+                self.__completed += 1
+                self.__run_seconds += call.ended - call.started
+
+    @property
+    def queued(self) -> int:
+        """ Calls waiting for a thread """
+        return self.__submitted - self.__started
+
+    @property
+    def running(self) -> int:
+        return self.__started - self.__completed
+
+    def stats(self) -> ExecutorStats:
+        with self.__lock:
+            return ExecutorStats(self.name, self.max_workers, self.__submitted - self.__started,
+                                 self.__started - self.__completed, self.__completed, self.__wait_seconds,
+                                 self.__max_wait_seconds, self.__run_seconds)
+
+    def log_stats(self):
+        stats = self.stats()
+        self.__logger.info("Executor %s: %d workers, %d queued, %d running, %d completed, "
+                           "wait %.3f s (max %.3f s), run %.3f s" %
+                           (stats.name, stats.max_workers, stats.queued, stats.running, stats.completed,
+                            stats.wait_seconds, stats.max_wait_seconds, stats.run_seconds))
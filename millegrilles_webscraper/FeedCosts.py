@@ -0,0 +1,166 @@
+import collections
+import logging
+import time
+import tracemalloc
+
+from typing import Optional
+
+from millegrilles_webscraper.Metrics import current_feed
+
+COST_EXECUTOR_SECONDS = 'executor_seconds'      # Thread time of the calls run in the executors
+COST_CPU_SECONDS = 'cpu_seconds'                # CPU time of the calls run in the executors
+COST_DOWNLOADED_BYTES = 'downloaded_bytes'      # Bytes received from the network, shared downloads count once
+COST_UPLOADED_BYTES = 'uploaded_bytes'          # Bytes sent to filehosts, including failed attempts
+COST_STORED_BYTES = 'stored_bytes'              # Bytes of the new files stored on the filehost
+COST_BUS_REQUESTS = 'bus_requests'              # Requests and commands sent on the bus
+COST_CUSTOM_CODE_SECONDS = 'custom_code_seconds'
+COST_SCRAPES = 'scrapes'
+COST_SCRAPE_SECONDS = 'scrape_seconds'
+COST_PROCESS_PEAK_BYTES = 'process_peak_bytes'  # Highest allocation peak sampled during process(), a maximum
+
+DEFAULT_WINDOW_SECONDS = 300
+DEFAULT_WINDOW_COUNT = 12  # Windows kept, the report covers the last hour by default
+
+
+class CostWindow:
+
+    def __init__(self, start: float):
+        self.start = start
+        self.feeds: dict[str, dict[str, float]] = dict()
+
+
+class AllocationSample:
+    """
+    Peak of the python allocations while process() runs, measured with tracemalloc. Used as a context manager.
+    The peak is process wide: a scrape is sampled only when no other sample is running and is skipped otherwise.
+    """
+
+    def __init__(self, registry):
+        self.__registry = registry
+        self.__feed: Optional[tuple[str, str]] = None
+        self.__base: Optional[int] = None
+
+    def __enter__(self):
+        if tracemalloc.is_tracing() and self.__registry.start_sample():
+            self.__feed = current_feed.get()
+            self.__base, _peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.__base is None:
+            return
+        self.__registry.end_sample()
+        _current, peak = tracemalloc.get_traced_memory()
+        self.__registry.maximum(COST_PROCESS_PEAK_BYTES, max(0, peak - self.__base), self.__feed)
+
+
+class FeedCostRegistry:
+    """
+    Resources used by each feed, accumulated in rolling windows of window_seconds. The report sums the windows
+    kept (window_count) per feed.
+
+    Stage metrics are attributed through a MetricsRegistry listener (see observe_stage), other resources are added
+    where they are used (add). The feed defaults to the feed being scraped by the current task.
+    """
+
+    def __init__(self, window_seconds: float = DEFAULT_WINDOW_SECONDS, window_count: int = DEFAULT_WINDOW_COUNT):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__window_seconds = window_seconds
+        self.__windows: collections.deque[CostWindow] = collections.deque(maxlen=window_count)
+        self.__feed_types: dict[str, str] = dict()
+        self.__sampling = False
+
+    def add(self, cost: str, amount: float, feed: Optional[tuple[str, str]] = None):
+        values = self.__values(feed)
+        if values is not None:
+            values[cost] = values.get(cost, 0) + amount
+
+    def maximum(self, cost: str, amount: float, feed: Optional[tuple[str, str]] = None):
+        values = self.__values(feed)
+        if values is not None and amount > values.get(cost, 0):
+            values[cost] = amount
+
+    def observe_stage(self, stage: str, duration: float, nbytes: Optional[int], feed_type: str, feed_id: str):
+        """ MetricsRegistry listener """
+        if not feed_id:
+            return
+        feed = (feed_type, feed_id)
+        if stage.startswith('executor.'):
+            if stage.endswith('.run'):
+                self.add(COST_EXECUTOR_SECONDS, duration, feed)
+            elif stage.endswith('.cpu'):
+                self.add(COST_CPU_SECONDS, duration, feed)
+        elif stage.startswith('bus.'):
+            self.add(COST_BUS_REQUESTS, 1, feed)
+        elif stage == 'custom_process':
+            self.add(COST_CUSTOM_CODE_SECONDS, duration, feed)
+        elif stage == 'scrape':
+            self.add(COST_SCRAPES, 1, feed)
+            self.add(COST_SCRAPE_SECONDS, duration, feed)
+
+    def sample_allocations(self) -> AllocationSample:
+        return AllocationSample(self)
+
+    def start_sample(self) -> bool:
+        if self.__sampling:
+            return False
+        self.__sampling = True
+        return True
+
+    def end_sample(self):
+        self.__sampling = False
+
+    def remove_feed(self, feed_id: str):
+        self.__feed_types.pop(feed_id, None)
+        for window in self.__windows:
+            window.feeds.pop(feed_id, None)
+
+    def report(self) -> dict:
+        """
+        :return: Resources used by each feed over the windows kept, feeds sorted by executor time.
+        """
+        now = time.monotonic()
+        self.__rotate(now)
+        totals: dict[str, dict[str, float]] = dict()
+        for window in self.__windows:
+            for feed_id, values in window.feeds.items():
+                feed_totals = totals.setdefault(feed_id, dict())
+                for cost, amount in values.items():
+                    if cost == COST_PROCESS_PEAK_BYTES:
+                        feed_totals[cost] = max(feed_totals.get(cost, 0), amount)
+                    else:
+                        feed_totals[cost] = feed_totals.get(cost, 0) + amount
+
+        feeds = list()
+        for feed_id, values in totals.items():
+            feed = {'feed_id': feed_id, 'feed_type': self.__feed_types.get(feed_id) or ''}
+            for cost, amount in sorted(values.items()):
+                feed[cost] = round(amount, 3) if isinstance(amount, float) else amount
+            feeds.append(feed)
+        feeds.sort(key=lambda f: f.get(COST_EXECUTOR_SECONDS, 0), reverse=True)
+
+        period = now - self.__windows[0].start if len(self.__windows) > 0 else 0.0
+        return {'period_seconds': round(period, 1), 'feeds': feeds}
+
+    def log_report(self, top: int = 5):
+        feeds = self.report()['feeds'][:top]
+        for feed in feeds:
+            self.__logger.info("Feed cost %s (%s): %.3f s executor, %.3f s cpu, %d bytes downloaded, "
+                               "%d bytes stored, %d bus requests" % (
+                                   feed['feed_id'], feed['feed_type'], feed.get(COST_EXECUTOR_SECONDS, 0),
+                                   feed.get(COST_CPU_SECONDS, 0), feed.get(COST_DOWNLOADED_BYTES, 0),
+                                   feed.get(COST_STORED_BYTES, 0), feed.get(COST_BUS_REQUESTS, 0)))
+
+    def __values(self, feed: Optional[tuple[str, str]]) -> Optional[dict[str, float]]:
+        feed_type, feed_id = feed or current_feed.get() or ('', '')
+        if not feed_id:
+            return None  # Not done for a feed (e.g. filehost maintenance)
+        self.__feed_types[feed_id] = feed_type
+        window = self.__rotate(time.monotonic())
+        return window.feeds.setdefault(feed_id, dict())
+
+    def __rotate(self, now: float) -> CostWindow:
+        if len(self.__windows) == 0 or self.__windows[-1].start + self.__window_seconds <= now:
+            self.__windows.append(CostWindow(now))
+        return self.__windows[-1]
@@ -9,10 +9,16 @@ from typing import Optional, TypedDict
 from millegrilles_messages.chiffrage.DechiffrageUtils import dechiffrer_reponse, dechiffrer_document_secrete
 from millegrilles_messages.messages import Constantes
 from millegrilles_webscraper.Context import WebScraperContext
+from millegrilles_webscraper.FeedScheduler import FeedScheduler
+from millegrilles_webscraper.PrioritySemaphore import PrioritySemaphore
 from millegrilles_webscraper.scrapers import WebScraper
+from millegrilles_webscraper.scrapers.CrawlScraper import CrawlScraper
 from millegrilles_webscraper.scrapers.GoogleTrendsScraper import GoogleTrendsScraper
+from millegrilles_webscraper.scrapers.GoogleTrendsMultiRegionScraper import GoogleTrendsMultiRegionScraper
+from millegrilles_webscraper.scrapers.HtmlScraper import HtmlScraper
+from millegrilles_webscraper.scrapers.RssScraper import RssScraper
 from millegrilles_webscraper.scrapers.WebCustomPythonScraper import WebCustomPythonScraper
-from millegrilles_webscraper.scrapers.WebScraper import FeedParametersType, FeedInformation
+from millegrilles_webscraper.scrapers.WebScraper import FeedParametersType, FeedInformation, ScrapeResult
 
 
 class DecryptedKeyDict(TypedDict):
@@ -33,15 +39,19 @@ class FeedManager:
         self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
         self.__context = context
 
-        # Feed semaphore to limit the number of scrapers running at the same time
-        self.__feed_semaphore = asyncio.BoundedSemaphore(1)
+        # Feed semaphore to limit the number of scrapers running at the same time, on demand scrapes go first
+        self.__feed_semaphore = PrioritySemaphore(context.configuration.scrape_concurrency)
 
-        self.__scapers: dict[str, WebScraper] = dict()
-        self.__group: Optional[TaskGroup] = None
+        # Scrapes of all the feeds, one worker per scrape slot
+        self.__scheduler = FeedScheduler(context, context.configuration.scrape_concurrency)
+
+    @property
+    def scheduler(self) -> FeedScheduler:
+        return self.__scheduler
 
     async def run(self):
         async with TaskGroup() as group:
-            self.__group = group
+            group.create_task(self.__scheduler.run())
             group.create_task(self.__maintain_scraper_thread())
 
     async def __maintain_scraper_thread(self):
@@ -52,6 +62,11 @@ class FeedManager:
                 self.__logger.warning("Timeout refreshing feeds, retry in 15 seconds")
                 await self.__context.wait(15)
             else:
+                self.__context.memory_budget.log_stats()
+                self.__context.http_client.log_stats()
+                self.__context.io_executor.log_stats()
+                self.__context.cpu_executor.log_stats()
+                self.__scheduler.log_stats()
                 await self.__context.wait(300)
 
     async def maintain_scraper_list(self):
@@ -74,18 +89,10 @@ class FeedManager:
             raise ValueError('No decryption keys were received')
 
         # Decrypt the keys message
-        decrypted_key_message = dechiffrer_reponse(self.__context.signing_key, keys)
-        decrypted_key_map: dict[str, bytes] = dict()
-        key: DecryptedKeyDict
-        for key in decrypted_key_message['cles']:
-            key_id = key['cle_id']
-            secret_key_base64 = key['cle_secrete_base64']
-            secret_key_base64 += "=" * ((4 - len(secret_key_base64) % 4) % 4)  # Padding
-            key_bytes: bytes = binascii.a2b_base64(secret_key_base64)
-            decrypted_key_map[key_id] = key_bytes
+        decrypted_key_map = self.decrypt_keys(keys)
 
         # Decrypt feed configuration
-        unchanged_scraper_feed_ids = set(self.__scapers.keys())
+        unchanged_scraper_feed_ids = self.__scheduler.feed_ids()
         for feed in feeds:
             feed_id = feed['feed_id']
             try:
@@ -93,35 +100,85 @@ class FeedManager:
             except KeyError:
                 pass
 
-            encrypted_info = feed['encrypted_feed_information']
-            key: bytes = decrypted_key_map[encrypted_info['cle_id']]
-            cleartext_content: FeedInformation = dechiffrer_document_secrete(key, encrypted_info)
-            feed['decrypted_feed_information'] = cleartext_content
-
-            existing_scraper: WebScraper = self.__scapers.get(feed_id)
-            if existing_scraper:
-                existing_scraper.update(feed)
-            else:
-                # Create and start the scraper
-                scraper = self.create_scraper(feed)
-                self.__scapers[feed_id] = scraper
-                self.__group.create_task(scraper.run())
+            try:
+                self.__load_feed(feed, decrypted_key_map)
+            except Exception:
+                # A misconfigured feed must not prevent loading the others, an existing scraper keeps running
+                self.__logger.exception("Error loading feed %s, skipped" % feed_id)
 
         for removed_scraper_id in unchanged_scraper_feed_ids:
             # This scraper was removed (deleted on inactive)
-            scraper: WebScraper = self.__scapers.get(removed_scraper_id)
+            scraper: WebScraper = self.__scheduler.remove(removed_scraper_id)
             if scraper:
                 self.__logger.info("Stopping scraper id: %s" % removed_scraper_id)
-                del self.__scapers[removed_scraper_id]
                 await scraper.stop()
+                self.__context.metrics.remove_feed(removed_scraper_id)
+                self.__context.costs.remove_feed(removed_scraper_id)
 
         pass
 
+    def __load_feed(self, feed: FeedParametersType, decrypted_key_map: dict[str, bytes]):
+        """
+        Decrypts the feed information, then updates the scraper of the feed or creates it.
+        """
+        feed_id = feed['feed_id']
+        encrypted_info = feed['encrypted_feed_information']
+        key: bytes = decrypted_key_map[encrypted_info['cle_id']]
+        cleartext_content: FeedInformation = dechiffrer_document_secrete(key, encrypted_info)
+        feed['decrypted_feed_information'] = cleartext_content
+
+        existing_scraper: WebScraper = self.__scheduler.get(feed_id)
+        if existing_scraper:
+            existing_scraper.update(feed)
+        else:
+            # Create the scraper, scraped as soon as a worker is available
+            scraper = self.create_scraper(feed)
+            self.__scheduler.add(feed_id, scraper)
+
+    async def scrape_now(self, feed_id: str) -> Optional[ScrapeResult]:
+        """
+        Scrapes a feed immediately.
+        :return: Result of the scrape, None when the feed is not handled by this scraper
+        """
+        scraper: Optional[WebScraper] = self.__scheduler.get(feed_id)
+        if scraper is None:
+            return None
+        self.__logger.info("On demand scrape of feed %s" % feed_id)
+        return await scraper.scrape_now()
+
+    def decrypt_keys(self, keys: dict) -> dict[str, bytes]:
+        """
+        Decrypts the keys message received with the feeds.
+        :param keys: Keys message encrypted for this scraper
+        :return: Map of key_id: secret key
+        """
+        decrypted_key_message = dechiffrer_reponse(self.__context.signing_key, keys)
+        return map_decrypted_keys(decrypted_key_message['cles'])
+
     def create_scraper(self, feed: FeedParametersType) -> WebScraper:
         feed_type = feed['feed_type']
         if feed_type == 'web.google_trends.news':
             return GoogleTrendsScraper(self.__context, feed, self.__feed_semaphore)
+        elif feed_type == 'web.google_trends.news.multi_region':
+            return GoogleTrendsMultiRegionScraper(self.__context, feed, self.__feed_semaphore)
+        elif feed_type == 'web.scraper.rss':
+            return RssScraper(self.__context, feed, self.__feed_semaphore)
+        elif feed_type == 'web.scraper.html':
+            return HtmlScraper(self.__context, feed, self.__feed_semaphore)
+        elif feed_type == 'web.scraper.crawl':
+            return CrawlScraper(self.__context, feed, self.__feed_semaphore)
         elif feed_type == 'web.scraper.python_custom':
             return WebCustomPythonScraper(self.__context, feed, self.__feed_semaphore)
         else:
             raise NotImplementedError('Unsupported feed type: %s' % feed_type)
+
+
+def map_decrypted_keys(keys: list[DecryptedKeyDict]) -> dict[str, bytes]:
+    decrypted_key_map: dict[str, bytes] = dict()
+    for key in keys:
+        key_id = key['cle_id']
+        secret_key_base64 = key['cle_secrete_base64']
+        secret_key_base64 += "=" * ((4 - len(secret_key_base64) % 4) % 4)  # Padding
+        key_bytes: bytes = binascii.a2b_base64(secret_key_base64)
+        decrypted_key_map[key_id] = key_bytes
+    return decrypted_key_map
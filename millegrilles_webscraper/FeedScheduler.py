@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import math
+import time
+
+from asyncio import TaskGroup
+from typing import Optional
+
+from millegrilles_webscraper.Context import WebScraperContext
+
+DEFAULT_TICK = 1.0  # Seconds per slot of the timer wheel, scrapes start at most one tick late
+DEFAULT_WHEEL_SIZE = 512  # Slots of the timer wheel, later scrapes wait for more turns in their slot
+
+
+class FeedRecord:
+    """
+    Scheduling state of a feed, kept small: one record per feed, no task or timer of its own.
+    """
+    __slots__ = ('feed_id', 'scraper', 'tick', 'slot', 'queued', 'running', 'removed')
+
+    def __init__(self, feed_id: str, scraper):
+        self.feed_id = feed_id
+        self.scraper = scraper
+        self.tick = 0                     # Tick of the next scrape
+        self.slot: Optional[int] = None   # Slot of the timer wheel holding the record, None when not scheduled
+        self.queued = False               # Due, waiting for a worker
+        self.running = False
+        self.removed = False
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel. A record due at tick t is kept in slot t % size, each advance only visits the slots of the
+    elapsed ticks. Records due more than one turn ahead stay in their slot until their tick.
+    """
+
+    def __init__(self, tick: float = DEFAULT_TICK, size: int = DEFAULT_WHEEL_SIZE, now: float = 0.0):
+        self.__tick = tick
+        self.__slots: list[set[FeedRecord]] = [set() for _ in range(size)]
+        self.__current = math.floor(now / tick)  # Last tick processed
+        self.__count = 0
+
+    def __len__(self) -> int:
+        return self.__count
+
+    def schedule(self, record: FeedRecord, due: float):
+        """
+        :param due: Time of the scrape (time.monotonic()). Never fires before, at most one tick after.
+        """
+        self.cancel(record)
+        tick = max(math.ceil(due / self.__tick), self.__current + 1)
+        record.tick = tick
+        record.slot = tick % len(self.__slots)
+        self.__slots[record.slot].add(record)
+        self.__count += 1
+
+    def cancel(self, record: FeedRecord):
+        if record.slot is not None:
+            self.__slots[record.slot].discard(record)
+            record.slot = None
+            self.__count -= 1
+
+    def advance(self, now: float) -> list[FeedRecord]:
+        """
+        :return: Records due at or before now, removed from the wheel
+        """
+        target = math.floor(now / self.__tick)
+        if target <= self.__current:
+            return []
+        size = len(self.__slots)
+        if target - self.__current >= size:
+            slots = range(size)  # More than a turn elapsed, every slot is visited once
+        else:
+            slots = (t % size for t in range(self.__current + 1, target + 1))
+
+        due = list()
+        for slot in slots:
+            records = self.__slots[slot]
+            fired = [r for r in records if r.tick <= target]
+            for record in fired:
+                records.discard(record)
+                record.slot = None
+            due.extend(fired)
+        self.__count -= len(due)
+        self.__current = target
+        return due
+
+
+class FeedSchedulerStats:
+
+    def __init__(self, feeds: int, scheduled: int, queued: int, running: int, scrapes: int, late_seconds: float):
+        self.feeds = feeds
+        self.scheduled = scheduled
+        self.queued = queued
+        self.running = running
+        self.scrapes = scrapes
+        self.late_seconds = late_seconds
+
+    def to_dict(self) -> dict:
+        return {
+            'feeds': self.feeds,
+            'scheduled': self.scheduled,
+            'queued': self.queued,
+            'running': self.running,
+            'scrapes': self.scrapes,
+            'late_seconds': round(self.late_seconds, 3),
+        }
+
+
+class FeedScheduler:
+    """
+    Runs the scrapes of all the feeds with a fixed number of workers. Feeds are FeedRecords in a TimerWheel, a due
+    feed goes to the queue of the workers and is scheduled again with the delay returned by scraper.run_once().
+
+    A feed is in the wheel, queued or running, never twice. A new feed is scraped right away.
+    """
+
+    def __init__(self, context: WebScraperContext, workers: int,
+                 tick: float = DEFAULT_TICK, wheel_size: int = DEFAULT_WHEEL_SIZE):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__context = context
+        self.__workers = workers
+        self.__tick = tick
+        self.__wheel = TimerWheel(tick, wheel_size, time.monotonic())
+        self.__records: dict[str, FeedRecord] = dict()
+        self.__queue: asyncio.Queue[Optional[FeedRecord]] = asyncio.Queue()
+        self.__running = 0
+        self.__scrapes = 0
+        self.__late_seconds = 0.0
+
+    async def run(self):
+        async with TaskGroup() as group:
+            for _ in range(self.__workers):
+                group.create_task(self.__worker())
+            group.create_task(self.__tick_thread())
+
+    async def __tick_thread(self):
+        try:
+            while self.__context.stopping is False:
+                now = time.monotonic()
+                for record in self.__wheel.advance(now):
+                    self.__late_seconds += max(0.0, now - record.tick * self.__tick)
+                    self.__enqueue(record)
+                await self.__context.wait(self.__tick)
+        finally:
+            for _ in range(self.__workers):
+                self.__queue.put_nowait(None)  # Stops the workers
+
+    async def __worker(self):
+        while True:
+            record = await self.__queue.get()
+            if record is None:
+                return
+            record.queued = False
+            if record.removed:
+                continue
+
+            record.running = True
+            self.__running += 1
+            delay = None
+            try:
+                delay = await record.scraper.run_once()
+            except Exception:
+                self.__logger.exception("Error scraping feed %s" % record.feed_id)
+            finally:
+                record.running = False
+                self.__running -= 1
+                self.__scrapes += 1
+
+            if delay is not None and record.removed is False and self.__context.stopping is False:
+                self.__wheel.schedule(record, time.monotonic() + delay)
+
+    def __enqueue(self, record: FeedRecord):
+        if record.queued is False:
+            record.queued = True
+            self.__queue.put_nowait(record)
+
+    def add(self, feed_id: str, scraper):
+        """
+        Adds a feed, scraped as soon as a worker is available.
+        """
+        if feed_id in self.__records:
+            raise ValueError('Feed %s already scheduled' % feed_id)
+        record = FeedRecord(feed_id, scraper)
+        self.__records[feed_id] = record
+        self.__enqueue(record)
+
+    def remove(self, feed_id: str):
+        """
+        Removes a feed. A scrape in progress finishes, the feed is not scheduled again.
+        :return: Scraper of the feed, None when unknown
+        """
+        record = self.__records.pop(feed_id, None)
+        if record is None:
+            return None
+        record.removed = True
+        self.__wheel.cancel(record)
+        return record.scraper
+
+    def get(self, feed_id: str):
+        record = self.__records.get(feed_id)
+        if record is None:
+            return None
+        return record.scraper
+
+    def feed_ids(self) -> set[str]:
+        return set(self.__records.keys())
+
+    def stats(self) -> FeedSchedulerStats:
+        return FeedSchedulerStats(len(self.__records), len(self.__wheel), self.__queue.qsize(), self.__running,
+                                  self.__scrapes, self.__late_seconds)
+
+    def log_stats(self):
+        stats = self.stats()
+        self.__logger.info("Feed scheduler: %d feeds, %d scheduled, %d queued, %d running, %d scrapes, "
+                           "late %.3f s" % (stats.feeds, stats.scheduled, stats.queued, stats.running,
+                                            stats.scrapes, stats.late_seconds))
@@ -0,0 +1,177 @@
+import datetime
+import email.utils
+import logging
+import random
+import time
+
+from typing import Optional
+from urllib.parse import urlparse
+
+import aiohttp
+
+FAILURE_THRESHOLD = 5  # Consecutive failures before the circuit of a host opens
+BASE_BACKOFF = 30.0  # Seconds the circuit stays open the first time, doubles each time it opens again
+MAX_BACKOFF = 6 * 3600.0
+BACKOFF_JITTER = 0.2  # Random fraction added to the backoff so feeds of a host do not retry together
+
+# Responses meaning the host can not answer now. Other statuses (e.g. 404) are answers.
+FAILURE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_STATUSES = {429, 503}  # Statuses sent with Retry-After
+
+
+class HostOpenError(aiohttp.ClientError):
+    """ The circuit of the host is open, the request was not sent. """
+
+    def __init__(self, host: str, retry_in: float):
+        super().__init__('Host %s unavailable, retry in %.0f seconds' % (host, retry_in))
+        self.host = host
+        self.retry_in = retry_in
+
+
+class HostState:
+
+    def __init__(self, host: str):
+        self.host = host
+        self.failures = 0  # Consecutive failures
+        self.trips = 0  # Consecutive times the circuit opened, resets on success
+        self.open_until: Optional[float] = None
+        self.probing = False  # A request is testing the host after the circuit reopened
+        self.last_status: Optional[int] = None
+
+    @property
+    def open(self) -> bool:
+        return self.open_until is not None
+
+
+class HostHealthStats:
+
+    def __init__(self, hosts: int, open_hosts: int, rejected: int, trips: int):
+        self.hosts = hosts
+        self.open_hosts = open_hosts
+        self.rejected = rejected
+        self.trips = trips
+
+    def to_dict(self) -> dict:
+        return {'hosts': self.hosts, 'open_hosts': self.open_hosts, 'rejected': self.rejected, 'trips': self.trips}
+
+
+class HostHealthRegistry:
+    """
+    Health of the hosts shared by all feeds. Rate limit responses (429, 503 with Retry-After) open the circuit of
+    the host right away, other failures (5xx, connection errors, timeouts) open it after FAILURE_THRESHOLD
+    consecutive failures. While open, requests to the host are rejected without using the network. When the delay
+    expires a single request probes the host: a success closes the circuit, a failure opens it again with an
+    exponential backoff.
+    """
+
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, base_backoff: float = BASE_BACKOFF,
+                 max_backoff: float = MAX_BACKOFF):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__failure_threshold = failure_threshold
+        self.__base_backoff = base_backoff
+        self.__max_backoff = max_backoff
+        self.__hosts: dict[str, HostState] = dict()
+        self.__rejected = 0
+        self.__trips = 0
+
+    def retry_in(self, host: str) -> float:
+        """
+        :return: Seconds before a request to the host can be sent, 0 when it can be sent now
+        """
+        state = self.__hosts.get(host)
+        if state is None or state.open_until is None:
+            return 0.0
+        remaining = state.open_until - time.monotonic()
+        if remaining > 0:
+            return remaining
+        if state.probing:
+            return self.__base_backoff  # Wait for the result of the probe
+        return 0.0
+
+    def acquire(self, host: str):
+        """
+        Call before sending a request. The first request after the delay expires is the probe.
+        :raises HostOpenError: The circuit of the host is open
+        """
+        retry_in = self.retry_in(host)
+        if retry_in > 0:
+            self.__rejected += 1
+            raise HostOpenError(host, retry_in)
+        state = self.__hosts.get(host)
+        if state is not None and state.open:
+            state.probing = True
+
+    def release(self, host: str):
+        """ Call when a request ends without a result (cancelled), frees the probe. """
+        state = self.__hosts.get(host)
+        if state is not None:
+            state.probing = False
+
+    def success(self, host: str, status: int):
+        state = self.__hosts.get(host)
+        if state is None:
+            return  # Healthy hosts are not tracked
+        if state.open:
+            self.__logger.info("Host %s available again (HTTP %d)" % (host, status))
+        del self.__hosts[host]
+
+    def failure(self, host: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        """
+        :param status: Response status, None for connection errors and timeouts
+        :param retry_after: Delay requested by the host in seconds (Retry-After header)
+        """
+        state = self.__hosts.get(host)
+        if state is None:
+            state = HostState(host)
+            self.__hosts[host] = state
+        state.failures += 1
+        state.last_status = status
+        state.probing = False
+
+        if status in RATE_LIMIT_STATUSES or state.open or state.failures >= self.__failure_threshold:
+            if retry_after is not None:
+                delay = min(self.__max_backoff, retry_after) + random.uniform(0, BACKOFF_JITTER * self.__base_backoff)
+            else:
+                backoff = min(self.__max_backoff, self.__base_backoff * (2 ** state.trips))
+                delay = backoff * (1 + random.uniform(0, BACKOFF_JITTER))
+            state.open_until = time.monotonic() + delay
+            state.trips += 1
+            self.__trips += 1
+            self.__logger.warning("Host %s unavailable (%s, %d failures), circuit open for %.0f seconds" %
+                                  (host, status or 'error', state.failures, delay))
+
+    def response(self, host: str, status: int, retry_after: Optional[str] = None):
+        """ Records the status of a response. """
+        if status in FAILURE_STATUSES:
+            self.failure(host, status, parse_retry_after(retry_after))
+        else:
+            self.success(host, status)
+
+    def stats(self) -> HostHealthStats:
+        open_hosts = sum(1 for s in self.__hosts.values() if s.open)
+        return HostHealthStats(len(self.__hosts), open_hosts, self.__rejected, self.__trips)
+
+
+def url_host(url: str) -> str:
+    return urlparse(url).netloc.lower()
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """
+    :param value: Retry-After header, delay in seconds or http date
+    :return: Delay in seconds, None when missing or invalid
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(int(value)))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (date - datetime.datetime.now(tz=datetime.timezone.utc)).total_seconds())
@@ -0,0 +1,143 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import tempfile
+import zlib
+
+from typing import Optional, TypedDict
+
+CHUNK_SIZE = 1024 * 64
+INDEX_FILENAME = 'index.jsonl'
+BLOBS_DIRECTORY = 'blobs'
+
+# Credentials and session cookies are never written to disk: dropped from the recorded response headers, only a
+# digest of their value is kept in the request key
+SENSITIVE_HEADERS = {'authorization', 'proxy-authorization', 'cookie', 'set-cookie'}
+
+
+class HttpCaptureRecord(TypedDict):
+    key: list       # Request key with the sensitive header values replaced by their digest
+    url: str
+    status: int
+    reason: Optional[str]
+    headers: list[list[str]]
+    blob: str       # blake2b digest of the body, name of the compressed blob
+    size: int
+    recorded: int
+
+
+class HttpCaptureStore:
+    """
+    Content-addressed store of recorded http exchanges. Bodies are saved once per digest, compressed. The index is
+    an append-only jsonl file, the last record of a request key wins on replay.
+    """
+
+    def __init__(self, directory: str):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__directory = pathlib.Path(directory)
+        self.__index: dict[str, HttpCaptureRecord] = dict()
+
+    def __len__(self):
+        return len(self.__index)
+
+    def load(self):
+        path_index = pathlib.Path(self.__directory, INDEX_FILENAME)
+        try:
+            with open(path_index, 'rt') as fp:
+                for line in fp:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    record: HttpCaptureRecord = json.loads(line)
+                    self.__index[_index_key(record['key'])] = record
+        except FileNotFoundError:
+            pass
+        self.__logger.info("Loaded %d recorded http exchanges from %s" % (len(self.__index), self.__directory))
+
+    def lookup(self, key: tuple) -> Optional[HttpCaptureRecord]:
+        return self.__index.get(_index_key(_stored_key(key)))
+
+    def record(self, key: tuple, url: str, status: int, reason: Optional[str], headers: list[list[str]], reader) -> HttpCaptureRecord:
+        """
+        Saves an exchange. Blocking, run in an executor.
+        :param key: Request key, see HttpClient.request_key
+        :param headers: Response headers, the sensitive headers are not saved
+        :param reader: File-like reader positioned at the start of the body
+        """
+        path_blobs = pathlib.Path(self.__directory, BLOBS_DIRECTORY)
+        path_blobs.mkdir(parents=True, exist_ok=True)
+
+        # Compress to a work file while hashing, rename to the digest
+        digester = hashlib.blake2b(digest_size=32)
+        compressor = zlib.compressobj()
+        size = 0
+        with tempfile.NamedTemporaryFile('wb', dir=path_blobs, suffix='.work', delete=False) as output:
+            path_work = pathlib.Path(output.name)
+            while True:
+                chunk = reader.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digester.update(chunk)
+                output.write(compressor.compress(chunk))
+                size += len(chunk)
+            output.write(compressor.flush())
+
+        blob = digester.hexdigest()
+        path_blob = self.__blob_path(blob)
+        if path_blob.exists():
+            path_work.unlink()
+        else:
+            path_blob.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(path_work, path_blob)
+
+        record: HttpCaptureRecord = {
+            'key': _stored_key(key),
+            'url': url,
+            'status': status,
+            'reason': reason,
+            'headers': [[k, v] for k, v in headers if k.lower() not in SENSITIVE_HEADERS],
+            'blob': blob,
+            'size': size,
+            'recorded': int(datetime.datetime.now(tz=datetime.timezone.utc).timestamp()),
+        }
+        with open(pathlib.Path(self.__directory, INDEX_FILENAME), 'at') as fp:
+            fp.write(json.dumps(record) + '\n')
+        self.__index[_index_key(record['key'])] = record
+
+        return record
+
+    def read_blob(self, record: HttpCaptureRecord, writer):
+        """
+        Decompresses the body of a record. Blocking, run in an executor.
+        :param writer: Function called with each chunk of the body
+        """
+        decompressor = zlib.decompressobj()
+        with open(self.__blob_path(record['blob']), 'rb') as fp:
+            while True:
+                chunk = fp.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                writer(decompressor.decompress(chunk))
+        writer(decompressor.flush())
+
+    def __blob_path(self, blob: str) -> pathlib.Path:
+        return pathlib.Path(self.__directory, BLOBS_DIRECTORY, blob[0:2], blob)
+
+
+def _stored_key(key: tuple) -> list:
+    """ :return: Request key as saved in the index, with the digest of the sensitive header values """
+    url, vary = key
+    stored_vary = list()
+    for name, value in vary:
+        if name in SENSITIVE_HEADERS:
+            value = 'blake2b:' + hashlib.blake2b(value.encode('utf-8'), digest_size=32).hexdigest()
+        stored_vary.append([name, value])
+    return [url, stored_vary]
+
+
+def _index_key(stored_key: list) -> str:
+    url, vary = stored_key
+    return json.dumps([url, [list(h) for h in vary]])
@@ -0,0 +1,474 @@
+import asyncio
+import logging
+import os
+import pathlib
+import tempfile
+import time
+
+import aiohttp
+
+from multidict import CIMultiDict, CIMultiDictProxy
+from typing import Optional
+from yarl import URL
+
+from millegrilles_webscraper.ContentEncoding import ContentDecoder, UnsupportedEncodingError, accept_encoding, \
+    content_coding
+from millegrilles_webscraper.Context import WebScraperContext
+from millegrilles_webscraper.FeedCosts import COST_DOWNLOADED_BYTES
+from millegrilles_webscraper.HttpCapture import HttpCaptureStore, HttpCaptureRecord
+from millegrilles_webscraper.HostHealth import HostHealthRegistry, HostHealthStats, url_host
+
+CHUNK_SIZE = 1024 * 64
+COALESCE_TTL = 30  # Seconds a completed download is shared with new requests for the same key
+PURGE_INTERVAL = 10
+
+CAPTURE_MODE_RECORD = 'record'
+CAPTURE_MODE_REPLAY = 'replay'
+CAPTURE_DIRECTORY = 'http_capture'
+
+# Request headers that change the response content. Other headers are not part of the coalescing key.
+VARY_HEADERS = {'user-agent', 'accept', 'accept-language', 'accept-encoding', 'authorization', 'cookie'}
+
+
+def _default_timeout() -> aiohttp.ClientTimeout:
+    return aiohttp.ClientTimeout(total=90, connect=5, sock_read=10)
+
+
+class HttpBodyTooLargeError(aiohttp.ClientError):
+    """ The response body is larger than the maximum size of the request, the download was aborted. """
+
+
+class HttpUnsupportedEncodingError(aiohttp.ClientError):
+    """ The response body has a Content-Encoding that cannot be decoded, the download was aborted. """
+
+
+class SpoolReader:
+    """
+    File-like reader over a spooled response. Each reader has its own position, many readers can share a spool.
+    """
+
+    def __init__(self, content, raw: bool = False):
+        self.__content = content
+        self.__raw = raw
+        self.__position = 0
+        self.__closed = False
+
+    def __size(self) -> int:
+        return self.__content.raw_size if self.__raw else self.__content.size
+
+    def read(self, size: int = -1) -> bytes:
+        remaining = self.__size() - self.__position
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size <= 0:
+            return b''
+        fileno = self.__content.raw_fileno() if self.__raw else self.__content.fileno()
+        data = os.pread(fileno, size, self.__position)
+        self.__position += len(data)
+        return data
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            self.__position = offset
+        elif whence == os.SEEK_CUR:
+            self.__position += offset
+        elif whence == os.SEEK_END:
+            self.__position = self.__size() + offset
+        else:
+            raise ValueError('Invalid whence value: %s' % whence)
+        return self.__position
+
+    def tell(self) -> int:
+        return self.__position
+
+    def close(self):
+        if self.__closed is False:
+            self.__closed = True
+            self.__content.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class HttpResponseContent:
+    """
+    Response of a GET request spooled to a temporary file. The content is shared by all coalesced requests.
+
+    The content is decoded (gzip, br, ...) as it is received. The transport encoded bytes are also kept when the
+    response was encoded, open_raw() reads them to store the content without compressing it again.
+    """
+
+    def __init__(self, url: str, status: int, reason: Optional[str], headers: CIMultiDictProxy,
+                 request_info: aiohttp.RequestInfo, history: tuple = (), max_size: Optional[int] = None):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.request_info = request_info
+        self.history = history
+        self.max_size = max_size
+        self.size = 0
+        self.raw_size = 0
+        self.encoding: Optional[str] = None  # Transport encoding of the raw content, None when not encoded
+        self.__spool = tempfile.TemporaryFile('wb+')
+        self.__raw_spool: Optional[tempfile.TemporaryFile] = None
+        self.__decoder: Optional[ContentDecoder] = None
+        self.__readers = 0
+        self.__expired = False
+
+    @staticmethod
+    def from_response(url: str, response: aiohttp.ClientResponse, max_size: Optional[int] = None):
+        content = HttpResponseContent(url, response.status, response.reason, response.headers,
+                                      response.request_info, response.history, max_size)
+        try:
+            encoding = content_coding(response.headers.get('Content-Encoding'))
+        except UnsupportedEncodingError as e:
+            content.expire()
+            raise HttpUnsupportedEncodingError('Content of %s: %s' % (url, e))
+        if encoding is not None:
+            content.encoding = encoding
+            content.__decoder = ContentDecoder(encoding, content.write)
+            content.__raw_spool = tempfile.TemporaryFile('wb+')
+        return content
+
+    @staticmethod
+    def from_capture(url: str, record: HttpCaptureRecord, max_size: Optional[int] = None):
+        headers = CIMultiDictProxy(CIMultiDict([(k, v) for k, v in record['headers']]))
+        request_url = URL(url)
+        request_info = aiohttp.RequestInfo(request_url, 'GET', CIMultiDictProxy(CIMultiDict()), request_url)
+        return HttpResponseContent(url, record['status'], record['reason'], headers, request_info,
+                                   max_size=max_size)
+
+    @property
+    def ok(self) -> bool:
+        return 200 <= self.status < 300
+
+    def raise_for_status(self):
+        if not self.ok:
+            raise aiohttp.ClientResponseError(
+                self.request_info, self.history, status=self.status, message=self.reason or '', headers=self.headers)
+
+    def fileno(self) -> int:
+        return self.__spool.fileno()
+
+    def raw_fileno(self) -> int:
+        return self.__raw_spool.fileno()
+
+    def write(self, chunk: bytes):
+        """ Appends decoded content. Blocking.
+        :raises HttpBodyTooLargeError: The content exceeds max_size
+        """
+        if self.max_size is not None and self.size + len(chunk) > self.max_size:
+            raise HttpBodyTooLargeError('Content of %s larger than %d bytes' % (self.url, self.max_size))
+        self.__spool.write(chunk)
+        self.size += len(chunk)
+
+    def write_received(self, chunk: bytes):
+        """ Appends content as received, decoded when the response is encoded. Blocking. """
+        if self.__decoder is None:
+            self.write(chunk)
+            return
+        if self.max_size is not None and self.raw_size + len(chunk) > self.max_size:
+            raise HttpBodyTooLargeError('Content of %s larger than %d bytes' % (self.url, self.max_size))
+        self.__raw_spool.write(chunk)
+        self.raw_size += len(chunk)
+        self.__decoder.decode(chunk)
+
+    def flush(self):
+        if self.__decoder is not None:
+            self.__decoder.flush()
+            self.__raw_spool.flush()
+        self.__spool.flush()
+
+    def open(self) -> SpoolReader:
+        """
+        :return: A new reader positioned at the start of the content. Close the reader when done.
+        """
+        if self.__spool.closed:
+            raise ValueError('Content expired')
+        self.__readers += 1
+        return SpoolReader(self)
+
+    def open_raw(self) -> SpoolReader:
+        """
+        :return: A new reader of the transport encoded content (see encoding). Close the reader when done.
+        """
+        if self.__raw_spool is None:
+            raise ValueError('Content not encoded')
+        if self.__raw_spool.closed:
+            raise ValueError('Content expired')
+        self.__readers += 1
+        return SpoolReader(self, raw=True)
+
+    async def copy_to(self, fp) -> int:
+        """
+        Copies the content to a file.
+        :param fp: Destination file handle
+        :return: Number of bytes copied
+        """
+        len_file = 0
+        with self.open() as reader:
+            while True:
+                chunk = await asyncio.to_thread(reader.read, CHUNK_SIZE)
+                if not chunk:
+                    break
+                await asyncio.to_thread(fp.write, chunk)
+                len_file += len(chunk)
+        return len_file
+
+    async def read_bytes(self) -> bytes:
+        with self.open() as reader:
+            return await asyncio.to_thread(reader.read)
+
+    def release(self):
+        self.__readers -= 1
+        if self.__expired and self.__readers <= 0:
+            self.__close()
+
+    def expire(self):
+        """ Closes the spool once all readers are done. """
+        self.__expired = True
+        if self.__readers <= 0:
+            self.__close()
+
+    def __close(self):
+        self.__spool.close()
+        if self.__raw_spool is not None:
+            self.__raw_spool.close()
+
+
+class HttpClientStats:
+
+    def __init__(self, hits: int, misses: int, inflight: int, cached: int):
+        self.hits = hits
+        self.misses = misses
+        self.inflight = inflight
+        self.cached = cached
+
+    def to_dict(self) -> dict:
+        return {'hits': self.hits, 'misses': self.misses, 'inflight': self.inflight, 'cached': self.cached}
+
+
+class HttpCaptureMissError(aiohttp.ClientError):
+    """ Replay mode, no recorded exchange for the request. """
+
+
+class HttpDownloadAbandonedError(aiohttp.ClientError):
+    """ The request sharing its download was cancelled (e.g. its scrape deadline expired), retry later. """
+
+
+class HttpClient:
+    """
+    Shared HTTP layer for the scrapers. Concurrent or recent (within the ttl) GET requests on the same url and
+    vary headers share a single download.
+
+    Requests to a host that is rate limiting or failing are rejected with HostOpenError until the host can be
+    tried again (see HostHealthRegistry).
+
+    In record mode, all exchanges are saved to the capture store under dir_data. In replay mode, responses are
+    served from the capture store with a simulated latency and the network is never used.
+    """
+
+    def __init__(self, context: WebScraperContext, coalesce_ttl: float = COALESCE_TTL,
+                 host_health: Optional[HostHealthRegistry] = None):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__context = context
+        self.__coalesce_ttl = coalesce_ttl
+        self.__session: Optional[aiohttp.ClientSession] = None
+        self.__host_health = host_health or HostHealthRegistry()
+        self.__accept_encoding = accept_encoding()
+
+        configuration = context.configuration
+        self.__max_body_size: int = configuration.max_body_size
+        self.__capture_mode: Optional[str] = configuration.http_capture_mode
+        self.__capture_latency: float = configuration.http_capture_latency
+        self.__capture_store: Optional[HttpCaptureStore] = None
+        if self.__capture_mode is not None:
+            if self.__capture_mode not in (CAPTURE_MODE_RECORD, CAPTURE_MODE_REPLAY):
+                raise ValueError('Invalid http capture mode: %s' % self.__capture_mode)
+            self.__capture_store = HttpCaptureStore(str(pathlib.Path(configuration.dir_data, CAPTURE_DIRECTORY)))
+            self.__capture_store.load()
+            self.__logger.info("HTTP capture mode: %s" % self.__capture_mode)
+
+        self.__inflight: dict[tuple, asyncio.Future] = dict()
+        self.__completed: dict[tuple, tuple[float, HttpResponseContent]] = dict()
+        self.__hits = 0
+        self.__misses = 0
+
+    async def run(self):
+        try:
+            while self.__context.stopping is False:
+                self.purge()
+                await self.__context.wait(PURGE_INTERVAL)
+        finally:
+            self.purge(expire_all=True)
+            if self.__session is not None:
+                await self.__session.close()
+                self.__session = None
+
+    def __get_session(self) -> aiohttp.ClientSession:
+        if self.__session is None or self.__session.closed:
+            # Responses are decoded by HttpResponseContent, keeping the transport encoded bytes
+            self.__session = aiohttp.ClientSession(auto_decompress=False)
+        return self.__session
+
+    async def get(self, url: str, headers: Optional[dict] = None,
+                  timeout: Optional[aiohttp.ClientTimeout] = None, max_size: Optional[int] = None) -> HttpResponseContent:
+        """
+        GET the url, joining an in-flight or recently completed download of the same url when available.
+        :param url: Url to download
+        :param headers: Request headers
+        :param timeout: Request timeout, defaults to 90 seconds total.
+        :param max_size: Maximum size of the body (encoded and decoded), defaults to MAX_BODY_SIZE. A shared
+                         download is aborted at the limit of the request that started it.
+        :return: Spooled response content. The response status is not checked.
+        :raises HostOpenError: The host is unavailable, the request was not sent
+        :raises HttpBodyTooLargeError: The body is larger than max_size
+        """
+        if max_size is None:
+            max_size = self.__max_body_size
+        key = request_key(url, headers)
+
+        cached = self.__completed.get(key)
+        if cached is not None:
+            expiry, content = cached
+            if expiry > time.monotonic():
+                self.__hits += 1
+                return _check_size(content, max_size)
+            del self.__completed[key]
+            content.expire()
+
+        inflight = self.__inflight.get(key)
+        if inflight is not None:
+            self.__hits += 1
+            return _check_size(await asyncio.shield(inflight), max_size)
+
+        host = url_host(url)
+        if self.__capture_mode != CAPTURE_MODE_REPLAY:
+            self.__host_health.acquire(host)
+
+        self.__misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.__inflight[key] = future
+        try:
+            if self.__capture_mode == CAPTURE_MODE_REPLAY:
+                content = await self.__replay(key, url, max_size)
+            else:
+                content = await self.__download(url, host, headers, timeout, max_size)
+                if self.__capture_mode == CAPTURE_MODE_RECORD:
+                    await self.__record(key, content)
+        except asyncio.CancelledError as e:
+            # Other requests joined this download, they are not cancelled
+            future.set_exception(HttpDownloadAbandonedError('Download of %s abandoned' % url))
+            future.exception()
+            raise e
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Mark the exception as retrieved when there are no other waiters
+            raise e
+        else:
+            future.set_result(content)
+            self.__completed[key] = (time.monotonic() + self.__coalesce_ttl, content)
+            return content
+        finally:
+            del self.__inflight[key]
+
+    async def __download(self, url: str, host: str, headers: Optional[dict],
+                         timeout: Optional[aiohttp.ClientTimeout], max_size: int) -> HttpResponseContent:
+        session = self.__get_session()
+        request_headers = CIMultiDict(headers or dict())
+        request_headers.setdefault('Accept-Encoding', self.__accept_encoding)
+        try:
+            async with session.get(url, headers=request_headers, timeout=timeout or _default_timeout()) as response:
+                self.__host_health.response(host, response.status, response.headers.get('Retry-After'))
+                if response.content_length is not None and response.content_length > max_size:
+                    raise HttpBodyTooLargeError('Content of %s is %d bytes, larger than %d bytes' %
+                                                (url, response.content_length, max_size))
+                content = HttpResponseContent.from_response(url, response, max_size)
+                try:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        await self.__context.io_executor.run(content.write_received, chunk)
+                    await self.__context.io_executor.run(content.flush)
+                except BaseException as e:
+                    content.expire()  # Cleanup partial content
+                    raise e
+                # Attributed to the feed that started the download
+                self.__context.costs.add(COST_DOWNLOADED_BYTES, content.raw_size if content.encoding else content.size)
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+            self.__host_health.failure(host)
+            raise e
+        except BaseException as e:
+            self.__host_health.release(host)  # Not a host failure (cancelled, invalid url)
+            raise e
+        return content
+
+    async def __record(self, key: tuple, content: HttpResponseContent):
+        headers = [[k, v] for k, v in content.headers.items()]
+        with content.open() as reader:
+            await self.__context.io_executor.run(self.__capture_store.record, key, content.url, content.status,
+                                                 content.reason, headers, reader)
+
+    async def __replay(self, key: tuple, url: str, max_size: int) -> HttpResponseContent:
+        record = self.__capture_store.lookup(key)
+        if record is None:
+            raise HttpCaptureMissError('No recorded exchange for %s' % url)
+        if self.__capture_latency > 0:
+            await asyncio.sleep(self.__capture_latency)
+        content = HttpResponseContent.from_capture(url, record, max_size)
+        try:
+            await self.__context.io_executor.run(self.__capture_store.read_blob, record, content.write)
+            await self.__context.io_executor.run(content.flush)
+        except BaseException as e:
+            content.expire()
+            raise e
+        return content
+
+    def purge(self, expire_all=False):
+        now = time.monotonic()
+        for key, (expiry, content) in list(self.__completed.items()):
+            if expire_all or expiry <= now:
+                del self.__completed[key]
+                content.expire()
+
+    def host_retry_in(self, url: str) -> float:
+        """
+        :return: Seconds before a request to the host of the url can be sent, 0 when it can be sent now
+        """
+        if self.__capture_mode == CAPTURE_MODE_REPLAY:
+            return 0.0
+        return self.__host_health.retry_in(url_host(url))
+
+    def stats(self) -> HttpClientStats:
+        return HttpClientStats(self.__hits, self.__misses, len(self.__inflight), len(self.__completed))
+
+    def host_stats(self) -> HostHealthStats:
+        return self.__host_health.stats()
+
+    def log_stats(self):
+        stats = self.stats()
+        self.__logger.info("HTTP coalescing: %d hits, %d misses, %d in flight, %d cached" %
+                           (stats.hits, stats.misses, stats.inflight, stats.cached))
+        host_stats = self.host_stats()
+        self.__logger.info("HTTP hosts: %d unhealthy, %d unavailable, %d requests rejected, %d circuit trips" %
+                           (host_stats.hosts, host_stats.open_hosts, host_stats.rejected, host_stats.trips))
+
+
+def _check_size(content: HttpResponseContent, max_size: int) -> HttpResponseContent:
+    """ Shared content was downloaded with the limit of another request. """
+    if content.size > max_size or content.raw_size > max_size:
+        raise HttpBodyTooLargeError('Content of %s larger than %d bytes' % (content.url, max_size))
+    return content
+
+
+def request_key(url: str, headers: Optional[dict] = None) -> tuple:
+    vary = list()
+    if headers:
+        for name, value in headers.items():
+            name = name.lower()
+            if name in VARY_HEADERS:
+                vary.append((name, value))
+        vary.sort()
+    return url, tuple(vary)
@@ -0,0 +1,40 @@
+from typing import Optional
+
+from millegrilles_webscraper.Metrics import MetricsRegistry
+from millegrilles_webscraper.RequestBatcher import RequestBatcher
+
+
+class InstrumentedProducer:
+    """
+    Wraps the bus producer to time each request and command as a bus.<action> stage.
+
+    Lookup requests supported by the batcher (e.g. getFuuidsVolatile) are combined with the lookups of other scrapes,
+    the reply only has its parsed content.
+    """
+
+    def __init__(self, producer, metrics: MetricsRegistry, batcher: Optional[RequestBatcher] = None):
+        self.__producer = producer
+        self.__metrics = metrics
+        self.__batcher = batcher
+
+    async def request(self, *args, **kwargs):
+        if self.__batcher is not None and len(args) >= 3:
+            batched_action = self.__batcher.find_action(args[0], args[1], args[2])
+            if batched_action is not None:
+                return await self.__batcher.request(batched_action, self.__producer, args[0], args[3:], kwargs)
+        with self.__metrics.span('bus.' + _get_action(args, kwargs)):
+            return await self.__producer.request(*args, **kwargs)
+
+    async def command(self, *args, **kwargs):
+        with self.__metrics.span('bus.' + _get_action(args, kwargs)):
+            return await self.__producer.command(*args, **kwargs)
+
+    def __getattr__(self, item):
+        return getattr(self.__producer, item)
+
+
+def _get_action(args: tuple, kwargs: dict) -> str:
+    # Producer signature: (message, domain, action, ...)
+    if len(args) > 2:
+        return args[2]
+    return kwargs.get('action') or 'unknown'
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from typing import Optional
+
+from millegrilles_webscraper.Context import WebScraperContext
+
+SAMPLE_INTERVAL = 0.1
+MAX_STACK_DEPTH = 30
+
+
+class LoopStall:
+
+    def __init__(self, started: float, stack: list[str], feed: Optional[tuple[str, str]]):
+        self.started = started
+        self.stack = stack
+        self.feed = feed
+
+
+class LoopMonitor:
+    """
+    Measures the scheduling delay of the asyncio loop. A watchdog thread captures the stack of the loop thread
+    when it is blocked for longer than the threshold and attributes the stall to the feed being processed.
+    """
+
+    def __init__(self, context: WebScraperContext, threshold: float):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__context = context
+        self.__threshold = threshold
+        self.__heartbeat = time.monotonic()
+        self.__loop_thread_id: Optional[int] = None
+        self.__stall: Optional[LoopStall] = None
+        self.__stall_count = 0
+        self.__stop = threading.Event()
+
+    @property
+    def stall_count(self) -> int:
+        return self.__stall_count
+
+    async def run(self):
+        if not self.__threshold:
+            return  # Disabled
+
+        loop = asyncio.get_running_loop()
+        self.__loop_thread_id = threading.get_ident()
+        self.__heartbeat = time.monotonic()
+        watchdog = threading.Thread(target=self.__watchdog, name='LoopMonitor', daemon=True)
+        watchdog.start()
+
+        metrics = self.__context.metrics
+        try:
+            while self.__context.stopping is False:
+                self.__heartbeat = time.monotonic()
+                start = loop.time()
+                await asyncio.sleep(SAMPLE_INTERVAL)
+                lag = loop.time() - start - SAMPLE_INTERVAL
+                metrics.observe_stage('loop_lag', max(lag, 0.0), feed=('', ''))
+
+                stall = self.__stall
+                if stall is not None:
+                    self.__stall = None
+                    duration = time.monotonic() - stall.started
+                    self.__stall_count += 1
+                    metrics.observe_stage('loop_stall', duration, feed=stall.feed or ('', ''))
+                    self.__logger.warning("Event loop was blocked for %.3f seconds (feed: %s)" % (duration, _feed_str(stall.feed)))
+        finally:
+            self.__stop.set()
+
+    def __watchdog(self):
+        reported_heartbeat: Optional[float] = None
+        while not self.__stop.wait(self.__threshold / 2):
+            heartbeat = self.__heartbeat
+            blocked = time.monotonic() - heartbeat - SAMPLE_INTERVAL
+            if blocked < self.__threshold or reported_heartbeat == heartbeat:
+                continue
+            reported_heartbeat = heartbeat  # Report each stall once
+
+            frame = sys._current_frames().get(self.__loop_thread_id)
+            if frame is None:
+                continue
+            stack = traceback.format_stack(frame, limit=MAX_STACK_DEPTH)
+            feed = _find_feed(frame)
+            self.__stall = LoopStall(heartbeat + SAMPLE_INTERVAL, stack, feed)
+            self.__logger.warning("Event loop blocked for more than %.3f seconds (feed: %s), stack:\n%s" %
+                                  (blocked, _feed_str(feed), ''.join(stack)))
+
+
+def _find_feed(frame) -> Optional[tuple[str, str]]:
+    """
+    Walks the stack to find the scraper running on the loop thread.
+    """
+    while frame is not None:
+        try:
+            instance = frame.f_locals.get('self')
+            feed_id = getattr(instance, 'feed_id', None)
+            if isinstance(feed_id, str):
+                return getattr(instance, 'feed_type', ''), feed_id
+        except Exception:
+            pass  # Frame changed while inspecting it
+        frame = frame.f_back
+    return None
+
+
+def _feed_str(feed: Optional[tuple[str, str]]) -> str:
+    if feed is None:
+        return 'unknown'
+    return '%s (%s)' % (feed[1], feed[0])
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+
+from typing import Optional
+
+
+class MemoryBudgetStats:
+
+    def __init__(self, budget: int, in_use: int, high_water: int, waits: int, oversized: int):
+        self.budget = budget
+        self.in_use = in_use
+        self.high_water = high_water
+        self.waits = waits
+        self.oversized = oversized
+
+    def to_dict(self) -> dict:
+        return {
+            'budget': self.budget,
+            'in_use': self.in_use,
+            'high_water': self.high_water,
+            'waits': self.waits,
+            'oversized': self.oversized,
+        }
+
+
+class MemoryReservation:
+    """
+    Bytes reserved in the MemoryBudget. Use as an async context manager, the bytes are released on exit.
+    """
+
+    def __init__(self, budget, size: int):
+        self.__budget = budget
+        self.__size = size
+        self.__acquired = False
+
+    @property
+    def size(self) -> int:
+        return self.__size
+
+    async def __aenter__(self):
+        await self.__budget.acquire(self.__size)
+        self.__acquired = True
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self.__acquired:
+            self.__acquired = False
+            await self.__budget.release(self.__size)
+
+
+class MemoryBudget:
+    """
+    Governor for the bytes buffered in memory at the same time by all scrapers (downloaded content, ciphertext,
+    serialized and compressed output). Stages reserve the bytes they are about to buffer and wait when the budget
+    is exhausted.
+    """
+
+    def __init__(self, budget: int):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        if budget <= 0:
+            raise ValueError('Memory budget must be greater than 0')
+        self.__budget = budget
+        self.__in_use = 0
+        self.__high_water = 0
+        self.__waits = 0
+        self.__oversized = 0
+        self.__condition = asyncio.Condition()
+
+    @property
+    def budget(self) -> int:
+        return self.__budget
+
+    @property
+    def in_use(self) -> int:
+        return self.__in_use
+
+    @property
+    def high_water(self) -> int:
+        return self.__high_water
+
+    def reserve(self, size: Optional[int]) -> MemoryReservation:
+        """
+        :param size: Number of bytes that will be buffered. None or negative values reserve nothing.
+        :return: Reservation to use with async with.
+        """
+        if size is None or size < 0:
+            size = 0
+        return MemoryReservation(self, size)
+
+    async def acquire(self, size: int):
+        if size > self.__budget:
+            # Reservation can never fit, let it run alone by waiting for the budget to be completely free.
+            self.__oversized += 1
+            self.__logger.debug("Reservation of %d bytes is larger than budget of %d bytes" % (size, self.__budget))
+
+        async with self.__condition:
+            if not self.__fits(size):
+                self.__waits += 1
+                self.__logger.debug("Memory budget exhausted (%d/%d bytes in use), waiting to reserve %d bytes" %
+                                    (self.__in_use, self.__budget, size))
+                await self.__condition.wait_for(lambda: self.__fits(size))
+
+            self.__in_use += size
+            if self.__in_use > self.__high_water:
+                self.__high_water = self.__in_use
+
+    async def release(self, size: int):
+        async with self.__condition:
+            self.__in_use -= size
+            self.__condition.notify_all()
+
+    def __fits(self, size: int) -> bool:
+        if self.__in_use == 0:
+            return True  # Always allow one reservation to proceed, even when oversized
+        return self.__in_use + size <= self.__budget
+
+    def stats(self) -> MemoryBudgetStats:
+        return MemoryBudgetStats(self.__budget, self.__in_use, self.__high_water, self.__waits, self.__oversized)
+
+    def log_stats(self):
+        stats = self.stats()
+        self.__logger.info("Memory budget: %d/%d bytes in use, high-water mark %d bytes, %d waits, %d oversized" %
+                           (stats.in_use, stats.budget, stats.high_water, stats.waits, stats.oversized))
@@ -0,0 +1,191 @@
+import bisect
+import contextvars
+import json
+import logging
+import time
+
+from typing import Callable, Optional
+
+from millegrilles_webscraper.Deadline import current_deadline
+
+# Feed being scraped by the current task, used to label the metrics. Propagated to executor calls.
+current_feed: contextvars.ContextVar[Optional[tuple[str, str]]] = contextvars.ContextVar('current_feed', default=None)
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0)
+BYTES_BUCKETS = (1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000)
+
+STAGE_SECONDS = 'webscraper_stage_seconds'
+STAGE_BYTES = 'webscraper_stage_bytes'
+
+HELP = {
+    STAGE_SECONDS: 'Duration of scrape stages',
+    STAGE_BYTES: 'Bytes processed by scrape stages',
+}
+
+
+def set_current_feed(feed_type: str, feed_id: str) -> contextvars.Token:
+    return current_feed.set((feed_type, feed_id))
+
+
+def reset_current_feed(token: contextvars.Token):
+    current_feed.reset(token)
+
+
+class Histogram:
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Span:
+    """
+    Times a stage. Set bytes to record the number of bytes processed by the stage.
+    """
+
+    def __init__(self, registry, stage: str):
+        self.__registry = registry
+        self.stage = stage
+        self.bytes: Optional[int] = None
+        self.__start: Optional[float] = None
+        self.__deadline = None
+
+    def __enter__(self):
+        self.__deadline = current_deadline.get()
+        if self.__deadline is not None:
+            self.__deadline.enter_stage(self.stage)
+        self.__start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        duration = time.perf_counter() - self.__start
+        if self.__deadline is not None:
+            self.__deadline.exit_stage(self.stage, exc_type)
+        self.__registry.observe_stage(self.stage, duration, self.bytes)
+
+
+class MetricsRegistry:
+    """
+    Aggregates scrape stage durations and byte counts in histograms labelled by stage, feed type and feed id.
+    """
+
+    def __init__(self):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        # Key: (metric name, stage, feed_type, feed_id)
+        self.__histograms: dict[tuple[str, str, str, str], Histogram] = dict()
+        self.__gauges: dict[str, tuple[str, Callable[[], float]]] = dict()
+        self.__last_summary: dict[tuple[str, str], tuple[int, float, float]] = dict()
+        self.__listeners: list[Callable[[str, float, Optional[int], str, str], None]] = list()
+
+    def span(self, stage: str) -> Span:
+        return Span(self, stage)
+
+    def observe_stage(self, stage: str, duration: float, nbytes: Optional[int] = None,
+                      feed: Optional[tuple[str, str]] = None):
+        """
+        :param stage: Name of the stage
+        :param duration: Duration in seconds
+        :param nbytes: Number of bytes processed, optional
+        :param feed: (feed_type, feed_id) labels, defaults to the feed being scraped by the current task
+        """
+        feed_type, feed_id = feed or current_feed.get() or ('', '')
+        self.__histogram(STAGE_SECONDS, SECONDS_BUCKETS, stage, feed_type, feed_id).observe(duration)
+        if nbytes is not None:
+            self.__histogram(STAGE_BYTES, BYTES_BUCKETS, stage, feed_type, feed_id).observe(nbytes)
+        for listener in self.__listeners:
+            listener(stage, duration, nbytes, feed_type, feed_id)
+
+    def add_listener(self, listener: Callable[[str, float, Optional[int], str, str], None]):
+        """
+        :param listener: Called with (stage, duration, nbytes, feed_type, feed_id) for each observation.
+        """
+        self.__listeners.append(listener)
+
+    def register_gauge(self, name: str, value: Callable[[], float], help_text: str):
+        self.__gauges[name] = (help_text, value)
+
+    def __histogram(self, name: str, buckets: tuple, stage: str, feed_type: str, feed_id: str) -> Histogram:
+        key = (name, stage, feed_type, feed_id)
+        histogram = self.__histograms.get(key)
+        if histogram is None:
+            histogram = Histogram(buckets)
+            self.__histograms[key] = histogram
+        return histogram
+
+    def remove_feed(self, feed_id: str):
+        for key in [k for k in self.__histograms.keys() if k[3] == feed_id]:
+            del self.__histograms[key]
+
+    def render_prometheus(self) -> str:
+        lines = list()
+
+        current_name = None
+        for (name, stage, feed_type, feed_id), histogram in sorted(self.__histograms.items()):
+            if name != current_name:
+                current_name = name
+                lines.append('# HELP %s %s' % (name, HELP[name]))
+                lines.append('# TYPE %s histogram' % name)
+            labels = 'stage="%s",feed_type="%s",feed_id="%s"' % (
+                _escape(stage), _escape(feed_type), _escape(feed_id))
+            cumulative = 0
+            for bucket, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels, bucket, cumulative))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (name, labels, histogram.count))
+            lines.append('%s_sum{%s} %s' % (name, labels, histogram.sum))
+            lines.append('%s_count{%s} %d' % (name, labels, histogram.count))
+
+        for name, (help_text, value) in sorted(self.__gauges.items()):
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s gauge' % name)
+            try:
+                lines.append('%s %s' % (name, value()))
+            except Exception:
+                self.__logger.exception("Error reading gauge %s" % name)
+
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> dict:
+        """
+        :return: Activity per stage and feed type since the previous summary.
+        """
+        totals: dict[tuple[str, str], list] = dict()
+        for (name, stage, feed_type, _feed_id), histogram in self.__histograms.items():
+            total = totals.setdefault((stage, feed_type), [0, 0.0, 0.0])
+            if name == STAGE_SECONDS:
+                total[0] += histogram.count
+                total[1] += histogram.sum
+            else:
+                total[2] += histogram.sum
+
+        summary = dict()
+        for (stage, feed_type), (count, seconds, nbytes) in sorted(totals.items()):
+            last_count, last_seconds, last_bytes = self.__last_summary.get((stage, feed_type), (0, 0.0, 0.0))
+            self.__last_summary[(stage, feed_type)] = (count, seconds, nbytes)
+            delta_count = count - last_count
+            if delta_count <= 0:
+                continue
+            stage_summary = summary.setdefault(feed_type or 'none', dict())
+            stage_summary[stage] = {
+                'count': delta_count,
+                'seconds': round(seconds - last_seconds, 3),
+                'bytes': int(nbytes - last_bytes),
+            }
+
+        return summary
+
+    def log_summary(self):
+        summary = self.summary()
+        if len(summary) > 0:
+            self.__logger.info("Metrics summary %s" % json.dumps(summary))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
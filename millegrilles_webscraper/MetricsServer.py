@@ -0,0 +1,48 @@
+import logging
+
+from typing import Optional
+
+from aiohttp import web
+
+from millegrilles_webscraper.Context import WebScraperContext
+
+
+class MetricsServer:
+    """
+    Exposes the metrics in the Prometheus text format on a local http port (optional) and logs periodic summaries.
+    The feed cost report is available as json on /costs.
+    """
+
+    def __init__(self, context: WebScraperContext):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__context = context
+
+    async def run(self):
+        configuration = self.__context.configuration
+        runner: Optional[web.AppRunner] = None
+        if configuration.metrics_port:
+            app = web.Application()
+            app.router.add_get('/metrics', self.handle_metrics)
+            app.router.add_get('/costs', self.handle_costs)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, configuration.metrics_host, configuration.metrics_port)
+            await site.start()
+            self.__logger.info("Metrics available on http://%s:%d/metrics" % (configuration.metrics_host, configuration.metrics_port))
+
+        try:
+            while self.__context.stopping is False:
+                await self.__context.wait(configuration.metrics_log_interval)
+                self.__context.metrics.log_summary()
+                self.__context.costs.log_report()
+        finally:
+            if runner is not None:
+                await runner.cleanup()
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        content = self.__context.metrics.render_prometheus()
+        return web.Response(text=content, content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    async def handle_costs(self, request: web.Request) -> web.Response:
+        return web.json_response(self.__context.costs.report(), headers={'X-Content-Type-Options': 'nosniff'})
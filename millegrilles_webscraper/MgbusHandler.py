@@ -0,0 +1,86 @@
+import asyncio
+import logging
+
+from typing import Optional
+
+from millegrilles_messages.bus.PikaChannel import MilleGrillesPikaChannel
+from millegrilles_messages.bus.PikaQueue import MilleGrillesPikaQueueConsumer, RoutingKey
+from millegrilles_messages.messages import Constantes
+from millegrilles_messages.messages.MessagesModule import MessageWrapper
+
+from millegrilles_webscraper.Context import WebScraperContext
+from millegrilles_webscraper.FeedManager import FeedManager
+from millegrilles_webscraper.scrapers.WebScraper import SCRAPE_DONE, SCRAPE_EMPTY
+
+DOMAIN_WEB_SCRAPER = 'WebScraper'
+COMMAND_SCRAPE_FEED = 'scrapeFeed'
+EVENT_FEED_COSTS = 'feedCosts'
+
+
+class MgbusHandler:
+    """
+    Commands received from the bus. Each instance has an exclusive queue, the instance handling the feed replies.
+
+    commande.WebScraper.scrapeFeed {"feed_id": str}: scrapes the feed now, replies with the status and timings
+    once the content is saved.
+
+    Emits evenement.WebScraper.feedCosts with the feed cost report (FeedCostRegistry.report) every
+    COST_REPORT_INTERVAL seconds when configured.
+    """
+
+    def __init__(self, context: WebScraperContext, feed_manager: FeedManager):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__context = context
+        self.__feed_manager = feed_manager
+
+    async def run(self):
+        channel = MilleGrillesPikaChannel(self.__context, prefetch_count=20)
+        queue = MilleGrillesPikaQueueConsumer(self.__context, self.__on_exclusive_message, None, exclusive=True,
+                                              arguments={'x-message-ttl': 30_000})
+        queue.add_routing_key(RoutingKey(Constantes.SECURITE_PRIVE, f'commande.{DOMAIN_WEB_SCRAPER}.{COMMAND_SCRAPE_FEED}'))
+        channel.add_queue(queue)
+        await self.__context.bus_connector.add_channel(channel)
+
+        interval = self.__context.configuration.cost_report_interval
+        if interval:
+            await self.__emit_costs(interval)
+
+    async def __emit_costs(self, interval: int):
+        while self.__context.stopping is False:
+            await self.__context.wait(interval)
+            if self.__context.stopping:
+                break
+            try:
+                producer = await self.__context.get_producer()
+                await producer.event(self.__context.costs.report(), DOMAIN_WEB_SCRAPER, EVENT_FEED_COSTS,
+                                     exchange=Constantes.SECURITE_PRIVE)
+            except asyncio.CancelledError as e:
+                raise e
+            except Exception:
+                self.__logger.exception("Error emitting the feed cost report")
+
+    async def __on_exclusive_message(self, message: MessageWrapper) -> Optional[dict]:
+        action = message.routage['action']
+        if action == COMMAND_SCRAPE_FEED:
+            return await self.__scrape_feed(message)
+
+        self.__logger.info("Ignoring unsupported action %s" % action)
+        return None
+
+    async def __scrape_feed(self, message: MessageWrapper) -> Optional[dict]:
+        """
+        :return: Result of the scrape, None (no reply) when the feed is not handled by this instance. All the
+                 instances receive the command, only the one scraping the feed replies.
+        """
+        feed_id = message.parsed.get('feed_id')
+        if not feed_id:
+            return {'ok': False, 'err': 'feed_id is required'}
+
+        result = await self.__feed_manager.scrape_now(feed_id)
+        if result is None:
+            self.__logger.debug("Feed %s not handled by this instance, no reply" % feed_id)
+            return None
+
+        response = result.to_dict()
+        response['ok'] = result.status in (SCRAPE_DONE, SCRAPE_EMPTY)
+        return response
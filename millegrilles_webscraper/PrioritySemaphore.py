@@ -0,0 +1,87 @@
+import asyncio
+import heapq
+
+LANE_PRIORITY = 0
+LANE_NORMAL = 1
+
+
+class PriorityLane:
+    """
+    Slot of the PrioritySemaphore acquired in a lane. Use as an async context manager.
+    """
+
+    def __init__(self, semaphore, lane: int):
+        self.__semaphore = semaphore
+        self.__lane = lane
+
+    async def __aenter__(self):
+        await self.__semaphore.acquire(self.__lane)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.__semaphore.release()
+
+
+class PrioritySemaphore:
+    """
+    Semaphore with a priority lane. A released slot goes to the waiters of the priority lane first, then to the
+    other waiters in arrival order. Running holders are never preempted.
+
+    async with semaphore: normal lane, same as asyncio.BoundedSemaphore.
+    async with semaphore.priority(): priority lane.
+    """
+
+    def __init__(self, value: int):
+        if value <= 0:
+            raise ValueError('Semaphore value must be greater than 0')
+        self.__bound = value
+        self.__value = value
+        self.__sequence = 0
+        self.__waiters: list[tuple[int, int, asyncio.Future]] = list()  # Heap of (lane, sequence, future)
+
+    @property
+    def available(self) -> int:
+        return self.__value
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _l, _s, f in self.__waiters if not f.done())
+
+    def locked(self) -> bool:
+        return self.__value == 0
+
+    def priority(self) -> PriorityLane:
+        return PriorityLane(self, LANE_PRIORITY)
+
+    async def acquire(self, lane: int = LANE_NORMAL):
+        if self.__value > 0 and self.waiting == 0:
+            self.__value -= 1
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        self.__sequence += 1
+        heapq.heappush(self.__waiters, (lane, self.__sequence, future))
+        try:
+            await future
+        except asyncio.CancelledError as e:
+            if future.done() and not future.cancelled():
+                # The slot was granted as the waiter was cancelled, pass it on
+                self.release()
+            raise e
+
+    def release(self):
+        while len(self.__waiters) > 0:
+            _lane, _sequence, future = heapq.heappop(self.__waiters)
+            if not future.done():  # Skip cancelled waiters
+                future.set_result(None)
+                return
+        if self.__value >= self.__bound:
+            raise ValueError('PrioritySemaphore released too many times')
+        self.__value += 1
+
+    async def __aenter__(self):
+        await self.acquire()
+        return None
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.release()
@@ -0,0 +1,185 @@
+import asyncio
+import logging
+
+from typing import Optional
+
+from millegrilles_webscraper.Metrics import MetricsRegistry
+
+DEFAULT_BATCH_WINDOW = 0.02  # Seconds a lookup waits for other lookups of the same kind
+BATCH_MAX_KEYS = 1000  # A batch is sent as soon as it holds this many keys
+
+
+class BatchedAction:
+    """
+    Lookup request that can be combined: the keys of the callers (keys_field) are merged in one request, the
+    results (results_field) are split back by key. Messages are combined when their group fields are equal.
+
+    :param result_key: Field of a result holding its key, None when the results are the keys themselves
+    """
+
+    def __init__(self, domain: str, action: str, keys_field: str, results_field: str,
+                 result_key: Optional[str] = None, group_fields: tuple[str, ...] = ()):
+        self.domain = domain
+        self.action = action
+        self.keys_field = keys_field
+        self.results_field = results_field
+        self.result_key = result_key
+        self.group_fields = group_fields
+
+    def accepts(self, message: dict) -> bool:
+        return set(message.keys()) == {self.keys_field, *self.group_fields} \
+            and isinstance(message[self.keys_field], list)
+
+    def split(self, parsed: dict, keys: list[str]) -> dict:
+        """ :return: Reply to a caller, the results of its keys only """
+        if parsed.get('ok') is False or not isinstance(parsed.get(self.results_field), list):
+            return parsed
+        keys = set(keys)
+        if self.result_key is None:
+            results = [r for r in parsed[self.results_field] if r in keys]
+        else:
+            results = [r for r in parsed[self.results_field] if r.get(self.result_key) in keys]
+        reply = dict(parsed)
+        reply[self.results_field] = results
+        return reply
+
+
+BATCHED_ACTIONS = [
+    # Attached files already uploaded, correlations are global
+    BatchedAction('DataCollector', 'getFuuidsVolatile', 'correlations', 'files', result_key='correlation'),
+    # Data ids already saved, scoped to a feed: only lookups of the same feed are combined
+    BatchedAction('DataCollector', 'checkExistingDataIds', 'data_ids', 'missing_ids', group_fields=('feed_id',)),
+]
+
+
+class RequestBatcherStats:
+
+    def __init__(self, requests: int, batches: int):
+        self.requests = requests
+        self.batches = batches
+
+    def to_dict(self) -> dict:
+        return {'requests': self.requests, 'batches': self.batches}
+
+
+class BatchedResponse:
+    """ Reply of a batched request, the parsed content is limited to the keys of the caller. """
+
+    def __init__(self, parsed: dict):
+        self.parsed = parsed
+
+
+class PendingBatch:
+
+    def __init__(self, action: BatchedAction, producer, message: dict, args: tuple, kwargs: dict):
+        self.action = action
+        self.producer = producer
+        self.message = {f: message[f] for f in action.group_fields}
+        self.args = args
+        self.kwargs = kwargs
+        self.keys: dict[str, None] = dict()  # Ordered set
+        self.waiters: list[tuple[list[str], asyncio.Future]] = list()
+        self.task: Optional[asyncio.Task] = None
+
+
+class RequestBatcher:
+    """
+    Combines the lookup requests (BATCHED_ACTIONS) sent by concurrent scrapes within a short window, or up to
+    BATCH_MAX_KEYS keys, in one bus request. Each caller gets the reply for its own keys.
+
+    The combined request is timed as the bus.<action> stage of the feed that opened the batch, callers wait in
+    the batch.<action> stage.
+    """
+
+    def __init__(self, metrics: MetricsRegistry, window: float = DEFAULT_BATCH_WINDOW, max_keys: int = BATCH_MAX_KEYS):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__metrics = metrics
+        self.__window = window
+        self.__max_keys = max_keys
+        self.__actions = {(a.domain, a.action): a for a in BATCHED_ACTIONS}
+        self.__pending: dict[tuple, PendingBatch] = dict()
+        self.__requests = 0
+        self.__batches = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.__window > 0
+
+    def find_action(self, message, domain: str, action: str) -> Optional[BatchedAction]:
+        if not self.enabled or not isinstance(message, dict):
+            return None
+        batched_action = self.__actions.get((domain, action))
+        if batched_action is None or not batched_action.accepts(message):
+            return None
+        return batched_action
+
+    async def request(self, batched_action: BatchedAction, producer, message: dict, args: tuple, kwargs: dict):
+        """
+        :param producer: Producer used to send the batch when this request opens it
+        :param args: Arguments of the producer request after the message, domain and action
+        :param kwargs: Keyword arguments of the producer request (e.g. exchange), only equal ones are combined
+        :return: Reply limited to the keys of the message
+        """
+        try:
+            group_key = (batched_action.domain, batched_action.action, args, tuple(sorted(kwargs.items())),
+                         tuple(message[f] for f in batched_action.group_fields))
+            hash(group_key)
+        except TypeError:
+            # Arguments that cannot be compared, sent alone
+            return await producer.request(message, batched_action.domain, batched_action.action, *args, **kwargs)
+
+        keys = message[batched_action.keys_field]
+        batch = self.__pending.get(group_key)
+        if batch is None:
+            batch = PendingBatch(batched_action, producer, message, args, kwargs)
+            self.__pending[group_key] = batch
+            batch.task = asyncio.create_task(self.__send(group_key, batch, self.__window))
+
+        future = asyncio.get_running_loop().create_future()
+        batch.waiters.append((keys, future))
+        batch.keys.update(dict.fromkeys(keys))
+        self.__requests += 1
+        if len(batch.keys) >= self.__max_keys and self.__pending.get(group_key) is batch:
+            # Full, send without waiting for the end of the window
+            del self.__pending[group_key]
+            batch.task.cancel()
+            batch.task = asyncio.create_task(self.__send(group_key, batch, 0))
+
+        with self.__metrics.span('batch.' + batched_action.action):
+            return await future
+
+    async def __send(self, group_key: tuple, batch: PendingBatch, delay: float):
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if self.__pending.get(group_key) is batch:
+            del self.__pending[group_key]
+
+        action = batch.action
+        message = dict(batch.message)
+        message[action.keys_field] = list(batch.keys.keys())
+        self.__batches += 1
+        self.__logger.debug("Sending %s with %d keys for %d requests" % (action.action, len(batch.keys), len(batch.waiters)))
+        try:
+            with self.__metrics.span('bus.' + action.action):
+                response = await batch.producer.request(message, action.domain, action.action,
+                                                        *batch.args, **batch.kwargs)
+        except BaseException as e:
+            for _keys, future in batch.waiters:
+                if future.done():
+                    continue
+                if isinstance(e, Exception):
+                    future.set_exception(e)
+                else:
+                    future.cancel()
+            if not isinstance(e, Exception):
+                raise e
+            return
+
+        parsed = response.parsed
+        for keys, future in batch.waiters:
+            if not future.done():
+                future.set_result(BatchedResponse(action.split(parsed, keys)))
+
+    def stats(self) -> RequestBatcherStats:
+        """ :return: Number of lookups received and of requests sent """
+        return RequestBatcherStats(self.__requests, self.__batches)
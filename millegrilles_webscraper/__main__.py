@@ -2,7 +2,6 @@ import asyncio
 import logging
 from asyncio import TaskGroup
 from collections.abc import Awaitable
-from concurrent.futures.thread import ThreadPoolExecutor
 
 from millegrilles_messages.bus.BusContext import StopListener, ForceTerminateExecution
 from millegrilles_messages.bus.PikaConnector import MilleGrillesPikaConnector
@@ -10,6 +9,10 @@ from millegrilles_messages.bus.PikaConnector import MilleGrillesPikaConnector
 from millegrilles_webscraper.Configuration import WebScraperConfiguration
 from millegrilles_webscraper.Context import WebScraperContext
 from millegrilles_webscraper.FeedManager import FeedManager
+from millegrilles_webscraper.HttpClient import HttpClient
+from millegrilles_webscraper.LoopMonitor import LoopMonitor
+from millegrilles_webscraper.MetricsServer import MetricsServer
+from millegrilles_webscraper.MgbusHandler import MgbusHandler
 from millegrilles_webscraper.scrapers.AttachedFileHelper import AttachedFileHelper
 
 LOGGER = logging.getLogger(__name__)
@@ -44,28 +47,55 @@ async def main():
 
     except* (ForceTerminateExecution, asyncio.CancelledError):
         pass  # Result of the termination task
+    finally:
+        context.cpu_executor.shutdown(wait=False, cancel_futures=True)
 
 
 async def wiring(context: WebScraperContext) -> list[Awaitable]:
-    # Some threads get used to handle sync events for the duration of the execution. Ensure there are enough.
+    # Blocking calls that do not pick an executor (asyncio.to_thread, libraries) use the I/O executor.
+    # CPU bound work goes to context.cpu_executor, see WebScraperContext.
     loop = asyncio.get_event_loop()
-    loop.set_default_executor(ThreadPoolExecutor(max_workers=10))
+    loop.set_default_executor(context.io_executor)
 
     # Create instances
     bus_connector = MilleGrillesPikaConnector(context)
     context.bus_connector = bus_connector
     feed_manager = FeedManager(context)
+    bus_handler = MgbusHandler(context, feed_manager)
     attached_file_helper = AttachedFileHelper(context)
+    http_client = HttpClient(context)
+    metrics_server = MetricsServer(context)
+    loop_monitor = LoopMonitor(context, context.configuration.loop_stall_threshold)
 
     # Additional wiring
     context.file_handler = attached_file_helper
+    context.http_client = http_client
+    context.metrics.register_gauge('webscraper_http_coalesced_hits', lambda: http_client.stats().hits,
+                                   'Downloads shared with an in-flight or recent request')
+    context.metrics.register_gauge('webscraper_http_coalesced_misses', lambda: http_client.stats().misses,
+                                   'Downloads sent to the network')
+    context.metrics.register_gauge('webscraper_http_hosts_unavailable', lambda: http_client.host_stats().open_hosts,
+                                   'Hosts with an open circuit, requests are not sent')
+    context.metrics.register_gauge('webscraper_feeds_scheduled', lambda: feed_manager.scheduler.stats().scheduled,
+                                   'Feeds waiting for their next scrape in the timer wheel')
+    context.metrics.register_gauge('webscraper_feeds_queued', lambda: feed_manager.scheduler.stats().queued,
+                                   'Feeds due, waiting for a scrape worker')
+    context.metrics.register_gauge('webscraper_feeds_late_seconds_total',
+                                   lambda: feed_manager.scheduler.stats().late_seconds,
+                                   'Time due feeds waited for the scheduler tick')
+    context.metrics.register_gauge('webscraper_loop_stalls', lambda: loop_monitor.stall_count,
+                                   'Number of times the event loop was blocked beyond the threshold')
 
     # Create tasks
     coros = [
         context.run(),
         bus_connector.run(),
         feed_manager.run(),
+        bus_handler.run(),
         attached_file_helper.run(),
+        http_client.run(),
+        metrics_server.run(),
+        loop_monitor.run(),
     ]
 
     return coros
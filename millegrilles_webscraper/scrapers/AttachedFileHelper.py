@@ -1,21 +1,77 @@
 import aiohttp
 import asyncio
 import binascii
+import contextvars
+import datetime
+import hashlib
 import logging
+import os
 import tempfile
 
 from asyncio import TaskGroup
-from typing import Optional, TypedDict
-from urllib.parse import urljoin
+from typing import Awaitable, Callable, Optional, TypedDict
+from io import BytesIO
 
 from millegrilles_messages.chiffrage.Mgs4 import CipherMgs4WithSecret
 from millegrilles_messages.messages import Constantes
 from millegrilles_webscraper.Context import WebScraperContext
-from millegrilles_webscraper.DataStructures import Filehost, AttachedFileInterface, AttachedFile
-
-
-CONST_GET_FILE_READ_SOCK_TIMEOUT = 20       # Timeout if no data read after 20 seconds
-MAX_UPLOAD_SIZE = 100_000_000
+from millegrilles_webscraper.DataStructures import Filehost, AttachedFileInterface, AttachedFile, PackReference
+from millegrilles_webscraper.scrapers import ThumbnailProcessor
+from millegrilles_webscraper.scrapers.AttachedFileIndex import AttachedFileIndex, index_key
+from millegrilles_webscraper.scrapers.FilehostPool import FilehostPool, FilehostUnavailableError
+from millegrilles_webscraper.scrapers.PackFile import PackWriter, read_pack_member, stored_fuuid
+
+
+INDEX_SAVE_INTERVAL = 60
+INDEX_VERIFY_INTERVAL = 86_400              # Check that an indexed fuuid is still on the filehost after a day
+THUMBNAIL_BUFFER_FACTOR = 4                 # Memory reserved for the content and output of a thumbnail, relative to its size
+PACK_MAX_SIZE = 8 * 1024 * 1024             # A pack file is uploaded once it reaches this size
+
+# Pack scope of the current task, small files uploaded in the scope are added to its pack file
+current_pack: contextvars.ContextVar[Optional['PackScope']] = contextvars.ContextVar('current_pack', default=None)
+
+
+class PackScope:
+    """
+    Small files uploaded by a task, grouped in pack files. Use as an async context manager, the last pack file is
+    uploaded on exit. Nested scopes use the outer scope.
+    """
+
+    def __init__(self, upload_pack: Callable[['PackScope'], Awaitable[None]], enabled: bool):
+        self.__upload_pack = upload_pack
+        self.__enabled = enabled
+        self.__token: Optional[contextvars.Token] = None
+        self.lock = asyncio.Lock()
+        self.writer: Optional[PackWriter] = None
+        self.pending: list[tuple[AttachedFile, dict, Optional[str]]] = list()  # (attached file, member, digest)
+        self.members: dict[str, PackReference] = dict()  # Member fuuid: location, once the pack is uploaded
+
+    async def __aenter__(self):
+        outer = current_pack.get()
+        if outer is not None:
+            return outer
+        if self.__enabled:
+            self.__token = current_pack.set(self)
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self.__token is None:
+            return
+        current_pack.reset(self.__token)
+        self.__token = None
+        try:
+            if exc_type is None:
+                async with self.lock:
+                    await self.flush()
+        finally:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+
+    async def flush(self):
+        """ Uploads the current pack file. Call with the lock held. """
+        if self.writer is not None:
+            await self.__upload_pack(self)
 
 
 class AttachedFileHelper(AttachedFileInterface):
@@ -23,136 +79,159 @@ class AttachedFileHelper(AttachedFileInterface):
     def __init__(self, context: WebScraperContext):
         self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
         self.__context = context
-        self.__filehost: Optional[Filehost] = None
-        self.__filehost_ready = asyncio.Event()
-        self.__upload_ready = asyncio.Event()
-        self.__session_semaphore = asyncio.BoundedSemaphore(1)
-        self.__session: Optional[aiohttp.ClientSession] = None
-        self.__filehost_url: Optional[str] = None
+        self.__filehosts = FilehostPool(context)
+        self.__index = AttachedFileIndex(context.configuration.dir_data)
+
+        self.__pack_member_size: Optional[int] = context.configuration.pack_member_size
+        self.__thumbnail_max_dimension: Optional[int] = context.configuration.thumbnail_max_dimension
+        if self.__thumbnail_max_dimension and ThumbnailProcessor.is_available() is False:
+            self.__logger.warning("Pillow is not installed, thumbnails will be uploaded without downscaling")
+            self.__thumbnail_max_dimension = None
 
     @property
-    def ready(self) -> asyncio.Event:
-        return self.__upload_ready
+    def ready(self) -> bool:
+        return self.__filehosts.ready
 
-    async def stop_thread(self):
-        """ Thread that triggers all blocking events on closure """
-        await self.__context.wait()
-        self.__filehost_ready.set()
-        self.__upload_ready.set()
+    @property
+    def filehosts(self) -> FilehostPool:
+        return self.__filehosts
 
     async def run(self):
         async with TaskGroup() as group:
             group.create_task(self.__maintenance_thread())
-            group.create_task(self.__session_thread())
+            group.create_task(self.__filehosts.run())
+            group.create_task(self.__index_thread())
 
     async def __maintenance_thread(self):
         while self.__context.stopping is False:
             try:
-                await self.select_filehost()
-            except asyncio.TimeoutError:
+                await self.select_filehosts()
+            except (asyncio.TimeoutError, ValueError) as e:
+                self.__logger.warning("Error loading filehosts, retry in 15 seconds: %s" % e)
                 # Retry quickly
                 await self.__context.wait(15)
             else:
                 await self.__context.wait(300)
-
-    async def __session_thread(self):
-        while self.__context.stopping is False:
-            filehost = self.__filehost
-
-            if filehost:
-                # Configure SSL connection
-                if filehost.url_external:
-                    filehost_url = filehost.url_external
-                    tls_mode = filehost.tls_external or 'external'
-                elif filehost.url_internal:
-                    filehost_url = filehost.url_internal
-                    tls_mode = 'millegrille'
-                else:
-                    raise ValueError('Unsupported filehost configuration')
-
-                ssl_context = None
-                verify = True
-                if tls_mode == 'millegrille':
-                    ssl_context = self.__context.ssl_context
-                elif tls_mode == 'nocheck':
-                    verify = False
-
-                self.__filehost_url = filehost_url
-
-                # Configure and open client session
-                connector = aiohttp.TCPConnector(ssl_context=ssl_context, verify_ssl=verify)
-                client_timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=CONST_GET_FILE_READ_SOCK_TIMEOUT)
-                async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
-                    try:
-                        while self.__context.stopping is False:
-                            async with self.__session_semaphore:
-                                await self.authenticate(session)
-
-                            # Session is ready
-                            self.__session = session
-                            self.__upload_ready.set()
-
-                            self.__logger.info("Authenticated with filehost %s" % filehost_url)
-                            # Reauthenticate after a while to keep cookie active
-                            await self.__context.wait(600)
-                    except aiohttp.ClientError:
-                        self.__logger.exception("Error connecting to filehost %s" % filehost_url)
-
-                        # Cleanup before wait
-                        self.__session = None  # Ensure session is removed
-                        self.__filehost_url = None
-                        self.__upload_ready.clear()
-
-                        # Wait to reconnect
-                        await self.__context.wait(20)
-                    finally:
-                        # Cleanup
-                        self.__session = None
-                        self.__filehost_url = None
-                        self.__upload_ready.clear()
-            else:
-                await self.__filehost_ready.wait()
-
-    async def select_filehost(self):
+                self.__filehosts.log_stats()
+
+    async def __index_thread(self):
+        await self.__context.io_executor.run(self.__index.load)
+        try:
+            while self.__context.stopping is False:
+                await self.__context.wait(INDEX_SAVE_INTERVAL)
+                await self.__context.io_executor.run(self.__index.save)
+        finally:
+            self.__index.save()
+
+    async def select_filehosts(self):
+        """
+        Loads all the filehosts available to the instance. The filehost of the instance is always included.
+        """
         producer = await self.__context.get_producer()
         response = await producer.request(dict(), 'CoreTopologie', 'getFilehostForInstance', exchange=Constantes.SECURITE_PUBLIC)
         if response.parsed['ok'] is not True:
             raise ValueError('Error getting filehost: %s' % response.parsed.get('err'))
-        filehost_dict = response.parsed['filehost']
-        filehost = Filehost.load_from_dict(filehost_dict)
-
-        self.__filehost = filehost
-        self.__filehost_ready.set()
-
-    async def authenticate(self, session: aiohttp.ClientSession):
-        filehost_url = self.__filehost_url
-        if filehost_url is None:
-            raise ValueError('Filehost not selected')
-
-        url_authenticate = urljoin(filehost_url, '/filehost/authenticate')
-        auth_message = self.__get_auth_message()
-        async with session.post(url_authenticate, json=auth_message) as r:
-            r.raise_for_status()
-
-    def __get_auth_message(self):
-        ca = self.__context.ca
-        auth_message, message_id = self.__context.formatteur.signer_message(
-            Constantes.KIND_COMMANDE, dict(), 'filehost', action='authenticate')
-        auth_message['millegrille'] = ca.certificat_pem
-        return auth_message
+        instance_filehost = Filehost.load_from_dict(response.parsed['filehost'])
+        filehosts = [instance_filehost]
+        self.__filehosts.update(filehosts, remove=False)  # Usable while the other filehosts are loaded
+
+        try:
+            response = await producer.request(dict(), 'CoreTopologie', 'getFilehosts', exchange=Constantes.SECURITE_PUBLIC)
+        except asyncio.TimeoutError:
+            self.__logger.info("Timeout listing filehosts, keeping the current filehosts")
+            return
+        if response.parsed.get('ok') is not True:
+            self.__logger.info("Unable to list filehosts, keeping the current filehosts: %s" % response.parsed.get('err'))
+            return
+
+        for filehost_dict in response.parsed.get('list') or list():
+            filehost = Filehost.load_from_dict(filehost_dict)
+            if filehost.filehost_id == instance_filehost.filehost_id or filehost.deleted:
+                continue
+            if filehost.url_external is None and filehost.instance_id != instance_filehost.instance_id:
+                continue  # Internal url of another instance, not reachable
+            filehosts.append(filehost)
+        self.__filehosts.update(filehosts)
 
     async def upload_file(self, fuuid: str, file_size: int, fp):
-        await asyncio.wait_for(self.ready.wait(), 10)
-        # Upload content
-        async with self.__session_semaphore:
-            self.__logger.debug(f"upload_file {fuuid} ({file_size} bytes) to {self.__filehost_url}")
-            await _upload_content(self.__session, self.__filehost_url, fuuid, file_size, fp)
-
-    async def encrypt_upload_file(self, secret_key: bytes, fp) -> AttachedFile:
+        self.__logger.debug(f"upload_file {fuuid} ({file_size} bytes)")
+        await self.__filehosts.upload(fuuid, file_size, fp)
+
+    async def encrypt_upload_file(self, secret_key: bytes, fp, key_id: Optional[str] = None,
+                                  thumbnail: bool = False, compression: Optional[str] = None,
+                                  key_domains: Optional[list[str]] = None) -> AttachedFile:
+        """
+        Encrypts and uploads a file to the filehost. When key_id is provided, content already uploaded is reused.
+        :param secret_key: Secret encryption key
+        :param fp: File handle at the proper position for reading content
+        :param key_id: Id of the secret key. Required to reuse previously uploaded content.
+        :param thumbnail: Content is an image displayed as a thumbnail, downscale it when configured.
+        :param compression: Content is already compressed (e.g. gzip), saved in the attached file for readers.
+        :param key_domains: Domains of the secret key. Files uploaded by other feeds are reused only when their key
+                            has the same domains, without key_domains only the files of this key are reused.
+        :return: Attached file. The cle_id may differ from key_id when an existing file is reused.
+        """
+        downscale = bool(thumbnail and self.__thumbnail_max_dimension and compression is None)
+
+        digest: Optional[str] = None
+        if key_id is not None:
+            position = fp.tell()
+            with self.__context.metrics.span('hash'):
+                content_digest = await self.__context.cpu_executor.run(_digest_file, fp)
+            fp.seek(position)
+            # Downscaled content is indexed apart from the original, with the parameters used
+            config = self.__context.configuration
+            transform = None
+            if downscale:
+                transform = 'thumbnail:%d:%s:%d' % (self.__thumbnail_max_dimension, config.thumbnail_format,
+                                                    config.thumbnail_quality)
+            digest = index_key(content_digest, key_id, key_domains, transform)
+
+            existing = await self.__find_existing(digest, key_id)
+            if existing is not None:
+                return existing
+
+        if downscale:
+            position = fp.tell()
+            content_size = fp.seek(0, os.SEEK_END) - position
+            fp.seek(position)
+            # Decoded size from the image header, the compressed size says little about it
+            pixels = await self.__context.cpu_executor.run(ThumbnailProcessor.image_pixels, fp)
+            if pixels is not None and pixels <= ThumbnailProcessor.MAX_PIXELS:
+                decoded_size = pixels * ThumbnailProcessor.DECODED_BYTES_PER_PIXEL
+                async with self.__context.memory_budget.reserve(content_size * THUMBNAIL_BUFFER_FACTOR + decoded_size):
+                    return await self.__encrypt_upload_thumbnail(secret_key, fp, key_id, digest)
+            if pixels is not None:
+                self.__logger.info("Thumbnail of %d pixels is too large to downscale, keeping original" % pixels)
+
+        return await self.__encrypt_upload(secret_key, fp, key_id, digest, compression)
+
+    async def __encrypt_upload_thumbnail(self, secret_key: bytes, fp, key_id: Optional[str], digest: Optional[str]) -> AttachedFile:
+        content = await self.__context.io_executor.run(fp.read)
+        config = self.__context.configuration
+        try:
+            with self.__context.metrics.span('thumbnail') as span:
+                span.bytes = len(content)
+                downscaled = await self.__context.cpu_executor.run(ThumbnailProcessor.downscale_image, content,
+                                                                   self.__thumbnail_max_dimension,
+                                                                   config.thumbnail_quality, config.thumbnail_format)
+        except Exception:
+            self.__logger.exception("Error downscaling thumbnail, keeping original")
+            downscaled = None
+
+        if downscaled is not None:
+            self.__logger.debug("Thumbnail downscaled from %d to %d bytes" % (len(content), len(downscaled)))
+            content = downscaled
+
+        return await self.__encrypt_upload(secret_key, BytesIO(content), key_id, digest)
+
+    async def __encrypt_upload(self, secret_key: bytes, fp, key_id: Optional[str], digest: Optional[str],
+                               compression: Optional[str] = None) -> AttachedFile:
         # Encrypt content to temporary output
         cipher = CipherMgs4WithSecret(secret_key)
         with tempfile.TemporaryFile() as tmp_output:
-            await asyncio.to_thread(_encrypt_file, cipher, fp, tmp_output)
+            with self.__context.metrics.span('encrypt'):
+                await self.__context.cpu_executor.run(_encrypt_file, cipher, fp, tmp_output)
 
             # Prepare metadta
             fuuid = cipher.hachage
@@ -162,16 +241,109 @@ class AttachedFileHelper(AttachedFileInterface):
             file_size = cipher.taille_chiffree
             nonce = binascii.b2a_base64(cipher.header, newline=False).decode('utf-8').replace('=', '')
 
-            attached_file: AttachedFile = {'fuuid': fuuid, 'cle_id': None, 'format': 'mgs4', 'nonce': nonce}
+            attached_file: AttachedFile = {'fuuid': fuuid, 'cle_id': key_id, 'format': 'mgs4', 'nonce': nonce}
+            if compression is not None:
+                attached_file['compression'] = compression
 
             # Upload content
             tmp_output.seek(0)  # Rewind file to beginning
-            await asyncio.wait_for(self.ready.wait(), 10)
-            async with self.__session_semaphore:
-                await _upload_content(self.__session, self.__filehost_url, fuuid, file_size, tmp_output)
+            scope = current_pack.get()
+            if scope is not None and file_size <= self.__pack_member_size:
+                await self.__add_to_pack(scope, attached_file, tmp_output, digest)
+                return attached_file  # Indexed once the pack is uploaded
+            await self.__filehosts.upload(fuuid, file_size, tmp_output)
+
+        if digest is not None:
+            self.__index.put(digest, attached_file)
 
         return attached_file
 
+    def pack(self) -> PackScope:
+        """
+        Groups the encrypted files of at most PACK_MEMBER_SIZE bytes uploaded by the current task in pack files.
+        The pack of the returned attached files is set when the pack is uploaded, at the latest when the scope exits.
+        Files are uploaded separately when PACK_MEMBER_SIZE is not configured.
+        """
+        return PackScope(self.__upload_pack, self.__pack_member_size is not None)
+
+    async def __add_to_pack(self, scope: PackScope, attached_file: AttachedFile, src, digest: Optional[str]):
+        async with scope.lock:
+            if scope.writer is None:
+                scope.writer = PackWriter()
+            member = await self.__context.io_executor.run(scope.writer.add, attached_file['fuuid'], src)
+            scope.pending.append((attached_file, member, digest))
+            if scope.writer.size >= PACK_MAX_SIZE:
+                await scope.flush()
+
+    async def __upload_pack(self, scope: PackScope):
+        writer, pending = scope.writer, scope.pending
+        scope.writer, scope.pending = None, list()
+        try:
+            if len(pending) == 1:
+                # A single file is uploaded as-is
+                attached_file, member, digest = pending[0]
+                content = await self.__context.io_executor.run(read_pack_member, writer.file, member)
+                await self.__filehosts.upload(attached_file['fuuid'], len(content), BytesIO(content))
+                if digest is not None:
+                    self.__index.put(digest, attached_file)
+                return
+
+            with self.__context.metrics.span('pack') as span:
+                pack_fuuid, pack_size = await self.__context.cpu_executor.run(writer.finish)
+                span.bytes = pack_size
+            await self.__filehosts.upload(pack_fuuid, pack_size, writer.file)
+        finally:
+            writer.close()
+
+        self.__logger.debug("Uploaded pack %s with %d files (%d bytes)" % (pack_fuuid, len(pending), pack_size))
+        for attached_file, member, digest in pending:
+            reference: PackReference = {'fuuid': pack_fuuid, 'offset': member['offset'], 'size': member['size']}
+            attached_file['pack'] = reference
+            scope.members[attached_file['fuuid']] = reference
+            if digest is not None:
+                self.__index.put(digest, attached_file)
+
+    def confirm_key(self, key_id: str):
+        self.__index.confirm_key(key_id)
+
+    async def __find_existing(self, digest: str, key_id: str) -> Optional[AttachedFile]:
+        entry = self.__index.get(digest, key_id)
+        if entry is None:
+            return None
+
+        now = int(datetime.datetime.now(tz=datetime.timezone.utc).timestamp())
+        if entry['verified'] is None or entry['verified'] + INDEX_VERIFY_INTERVAL < now:
+            try:
+                exists = await self.__filehosts.file_exists(stored_fuuid(entry))
+            except (aiohttp.ClientError, asyncio.TimeoutError, FilehostUnavailableError):
+                self.__logger.info("Unable to verify indexed file %s on filehost, uploading again" % entry['fuuid'])
+                return None
+            if exists is False:
+                self.__logger.debug("Indexed file %s missing from filehost, uploading again" % stored_fuuid(entry))
+                self.__index.remove(digest)
+                return None
+            self.__index.set_verified(digest)
+
+        self.__logger.debug("Reusing attached file %s" % entry['fuuid'])
+        return {
+            'fuuid': entry['fuuid'],
+            'format': entry['format'],
+            'nonce': entry['nonce'],
+            'cle_id': entry['cle_id'],
+            'compression': entry.get('compression'),
+            'pack': entry.get('pack'),
+        }
+
+
+def _digest_file(src) -> str:
+    digester = hashlib.blake2b(digest_size=32)
+    while True:
+        chunk = src.read(64 * 1024)
+        if len(chunk) == 0:
+            break
+        digester.update(chunk)
+    return digester.hexdigest()
+
 
 def _encrypt_file(cipher, src, dest):
     while True:
@@ -182,11 +354,3 @@ def _encrypt_file(cipher, src, dest):
 
     # Finalizer l'ecriture
     dest.write(cipher.finalize())
-
-
-async def _upload_content(session: aiohttp.ClientSession, filehost_url: str, fuuid: str, file_size: int, fp):
-    # One shot upload
-    headers = {'x-fuuid': fuuid, 'Content-Length': str(file_size)}
-    upload_url = urljoin(filehost_url, f'/filehost/files/{fuuid}')
-    response = await session.put(upload_url, headers=headers, data=fp)
-    response.raise_for_status()
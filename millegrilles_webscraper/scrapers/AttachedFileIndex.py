@@ -0,0 +1,146 @@
+import datetime
+import json
+import logging
+import os
+import pathlib
+
+from collections import OrderedDict
+from typing import Optional, TypedDict
+
+from millegrilles_webscraper.DataStructures import AttachedFile, PackReference
+
+INDEX_FILENAME = 'attached_files_index.json'
+MAX_ENTRIES = 50_000
+KEY_SEPARATOR = '|'
+
+
+class AttachedFileIndexEntry(TypedDict):
+    fuuid: str
+    format: str
+    nonce: str
+    cle_id: str
+    compression: Optional[str]
+    pack: Optional[PackReference]
+    key_confirmed: bool     # True when the key was saved by MaitreDesCles
+    verified: Optional[int]  # Last time (epoch seconds) the fuuid was confirmed present on the filehost
+
+
+def index_key(digest: str, key_id: str, key_domains: Optional[list[str]] = None, transform: Optional[str] = None) -> str:
+    """
+    Key of an entry: the digest of the plaintext content scoped by the domains of the decryption key and by the
+    transformation applied before upload (e.g. thumbnail downscaling). Without domains the entry is scoped to the
+    key itself.
+    :param digest: Digest of the plaintext content
+    :param key_id: Id of the key encrypting the content
+    :param key_domains: Domains of the key, files are reused by feeds with keys of the same domains
+    :param transform: Parameters of the transformation of the uploaded content, None when uploaded as-is
+    """
+    if key_domains:
+        scope = 'domains:' + ','.join(sorted(set(key_domains)))
+    else:
+        scope = 'key:' + key_id
+    return KEY_SEPARATOR.join([scope, transform or '', digest])
+
+
+class AttachedFileIndex:
+    """
+    Maps the plaintext content of an attached file (see index_key) to the encrypted file already uploaded to the
+    filehost. Used to reuse files instead of encrypting and uploading the same content again.
+
+    Entries are only reusable once their decryption key has been saved (confirm_key). Unconfirmed entries can
+    be reused by the owner of the key and are dropped on restart.
+    """
+
+    def __init__(self, dir_data: str, max_entries: int = MAX_ENTRIES):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__path = pathlib.Path(dir_data, INDEX_FILENAME)
+        self.__max_entries = max_entries
+        self.__entries: OrderedDict[str, AttachedFileIndexEntry] = OrderedDict()
+        self.__dirty = False
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def load(self):
+        try:
+            with open(self.__path, 'rt') as fp:
+                entries: dict[str, AttachedFileIndexEntry] = json.load(fp)
+        except FileNotFoundError:
+            return
+        except json.JSONDecodeError:
+            self.__logger.warning("Corrupted attached file index %s, starting over" % self.__path)
+            return
+
+        for digest, entry in entries.items():
+            if KEY_SEPARATOR not in digest:
+                continue  # Entry of an older version, not scoped by key domains
+            if entry.get('key_confirmed') is True:
+                self.__entries[digest] = entry
+
+        self.__logger.info("Loaded %d attached file index entries" % len(self.__entries))
+
+    def save(self):
+        if self.__dirty is False:
+            return
+        self.__dirty = False
+        self.__path.parent.mkdir(parents=True, exist_ok=True)
+        path_work = self.__path.with_suffix('.work')
+        with open(path_work, 'wt') as fp:
+            json.dump(self.__entries, fp)
+        os.replace(path_work, self.__path)
+
+    def get(self, digest: str, key_id: Optional[str] = None) -> Optional[AttachedFileIndexEntry]:
+        """
+        :param digest: Key of the entry, see index_key
+        :param key_id: Key id of the caller, allows reusing its own unconfirmed entries.
+        :return: Reusable entry or None
+        """
+        entry = self.__entries.get(digest)
+        if entry is None:
+            return None
+        if entry['key_confirmed'] is not True and entry['cle_id'] != key_id:
+            return None
+        self.__entries.move_to_end(digest)
+        return entry
+
+    def put(self, digest: str, attached_file: AttachedFile):
+        if attached_file.get('cle_id') is None:
+            raise ValueError('The attached file cle_id is required')
+
+        self.__entries[digest] = {
+            'fuuid': attached_file['fuuid'],
+            'format': attached_file['format'],
+            'nonce': attached_file['nonce'],
+            'cle_id': attached_file['cle_id'],
+            'compression': attached_file.get('compression'),
+            'pack': attached_file.get('pack'),
+            'key_confirmed': False,
+            'verified': _now_epoch(),
+        }
+        self.__entries.move_to_end(digest)
+        while len(self.__entries) > self.__max_entries:
+            self.__entries.popitem(last=False)
+        self.__dirty = True
+
+    def remove(self, digest: str):
+        try:
+            del self.__entries[digest]
+            self.__dirty = True
+        except KeyError:
+            pass
+
+    def set_verified(self, digest: str):
+        entry = self.__entries.get(digest)
+        if entry is not None:
+            entry['verified'] = _now_epoch()
+            self.__dirty = True
+
+    def confirm_key(self, key_id: str):
+        for entry in self.__entries.values():
+            if entry['cle_id'] == key_id and entry['key_confirmed'] is not True:
+                entry['key_confirmed'] = True
+                self.__dirty = True
+
+
+def _now_epoch() -> int:
+    return int(datetime.datetime.now(tz=datetime.timezone.utc).timestamp())
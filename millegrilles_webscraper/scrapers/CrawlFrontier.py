@@ -0,0 +1,267 @@
+import base64
+import hashlib
+import heapq
+import json
+import logging
+import math
+import os
+import pathlib
+import zlib
+
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import urlparse
+
+BLOOM_CAPACITY = 100_000
+BLOOM_ERROR_RATE = 0.001
+MAX_FRONTIER = 10_000
+MAX_CONTENT_DIGESTS = 20_000
+
+
+class BloomFilter:
+    """
+    Compact set of strings with false positives (error_rate at capacity) and no false negatives.
+    """
+
+    def __init__(self, capacity: int = BLOOM_CAPACITY, error_rate: float = BLOOM_ERROR_RATE):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.count = 0
+        self.__bits = bytearray((self.size + 7) // 8)
+
+    def __positions(self, value: str):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def __contains__(self, value: str) -> bool:
+        bits = self.__bits
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in self.__positions(value))
+
+    def add(self, value: str) -> bool:
+        """
+        :return: True when the value was not in the filter
+        """
+        bits = self.__bits
+        added = False
+        for p in self.__positions(value):
+            mask = 1 << (p & 7)
+            if not bits[p >> 3] & mask:
+                bits[p >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    @property
+    def saturated(self) -> bool:
+        return self.count >= self.capacity
+
+    def to_dict(self) -> dict:
+        return {
+            'capacity': self.capacity,
+            'error_rate': self.error_rate,
+            'count': self.count,
+            'bits': base64.b64encode(zlib.compress(bytes(self.__bits))).decode('utf-8'),
+        }
+
+    @staticmethod
+    def from_dict(value: dict):
+        bloom = BloomFilter(value['capacity'], value['error_rate'])
+        bits = zlib.decompress(base64.b64decode(value['bits']))
+        if len(bits) != len(bloom.__bits):
+            raise ValueError('Bloom filter size mismatch')
+        bloom.__bits = bytearray(bits)
+        bloom.count = value['count']
+        return bloom
+
+
+class FrontierEntry:
+
+    def __init__(self, priority: int, sequence: int, url: str, depth: int, leaf: bool, referrer: Optional[str]):
+        self.priority = priority
+        self.sequence = sequence
+        self.url = url
+        self.depth = depth
+        self.leaf = leaf
+        self.referrer = referrer
+        self.host = urlparse(url).netloc.lower()
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+    def to_list(self) -> list:
+        return [self.priority, self.sequence, self.url, self.depth, self.leaf, self.referrer]
+
+
+class CrawlFrontier:
+    """
+    Priority ordered urls to fetch with a limit of concurrent fetches per host.
+
+    Urls are deduplicated during a crawl cycle, a new cycle starts when the frontier is empty so hub pages are
+    refreshed. Leaf urls (at the maximum depth) are also remembered in a bloom filter once handled (see done and
+    saved) and are never fetched again. The digest of the saved content deduplicates mirrors.
+    """
+
+    def __init__(self, host_limit: int = 2, max_size: int = MAX_FRONTIER):
+        self.__host_limit = host_limit
+        self.__max_size = max_size
+        self.__heap: list[FrontierEntry] = list()
+        self.__sequence = 0
+        self.__inflight: dict[str, int] = dict()  # host: count
+        self.__inflight_entries: list[FrontierEntry] = list()
+        self.__seen_leaves = BloomFilter()
+        self.__seen_cycle: set[str] = set()
+        self.__content_digests: OrderedDict[str, None] = OrderedDict()
+        self.cycles = 0
+
+    def __len__(self):
+        return len(self.__heap)
+
+    @property
+    def inflight(self) -> int:
+        return len(self.__inflight_entries)
+
+    @property
+    def host_limit(self) -> int:
+        return self.__host_limit
+
+    @host_limit.setter
+    def host_limit(self, value: int):
+        self.__host_limit = value
+
+    def push(self, url: str, depth: int, leaf: bool, referrer: Optional[str] = None) -> bool:
+        """
+        :return: True when the url was added
+        """
+        if url in self.__seen_cycle or (leaf and url in self.__seen_leaves):
+            return False
+        if len(self.__heap) >= self.__max_size:
+            return False
+
+        self.__seen_cycle.add(url)
+        self.__sequence += 1
+        heapq.heappush(self.__heap, FrontierEntry(depth, self.__sequence, url, depth, leaf, referrer))
+        return True
+
+    def pop(self) -> Optional[FrontierEntry]:
+        """
+        :return: Next entry with a host under its concurrency limit, None when no entry is available now.
+        """
+        deferred = list()
+        entry: Optional[FrontierEntry] = None
+        while len(self.__heap) > 0:
+            candidate = heapq.heappop(self.__heap)
+            if self.__inflight.get(candidate.host, 0) < self.__host_limit:
+                entry = candidate
+                break
+            deferred.append(candidate)
+        for candidate in deferred:
+            heapq.heappush(self.__heap, candidate)
+
+        if entry is not None:
+            self.__inflight[entry.host] = self.__inflight.get(entry.host, 0) + 1
+            self.__inflight_entries.append(entry)
+        return entry
+
+    def done(self, entry: FrontierEntry, fetched: bool):
+        """
+        :param fetched: True when the url is not to be fetched again. False when the fetch failed or the page is
+                        still to be saved (see saved), a leaf can be fetched again in the next cycle.
+        """
+        if fetched and entry.leaf:
+            self.__add_leaf(entry.url)
+
+        self.__inflight_entries.remove(entry)
+        count = self.__inflight[entry.host] - 1
+        if count > 0:
+            self.__inflight[entry.host] = count
+        else:
+            del self.__inflight[entry.host]
+
+        if len(self.__heap) == 0 and len(self.__inflight_entries) == 0:
+            # Cycle complete, hub pages can be fetched again
+            self.__seen_cycle.clear()
+            self.cycles += 1
+
+    def saved(self, url: str, leaf: bool, digest: str):
+        """
+        Marks a fetched page as saved: a leaf is not fetched again and its content is known.
+        """
+        if leaf:
+            self.__add_leaf(url)
+        self.add_content_digest(digest)
+
+    def __add_leaf(self, url: str):
+        if self.__seen_leaves.saturated:
+            logging.getLogger(__name__).info("Crawl bloom filter saturated, starting over")
+            self.__seen_leaves = BloomFilter(self.__seen_leaves.capacity, self.__seen_leaves.error_rate)
+        self.__seen_leaves.add(url)
+
+    def content_seen(self, digest: str) -> bool:
+        return digest in self.__content_digests
+
+    def add_content_digest(self, digest: str) -> bool:
+        """
+        :return: True when the content was not seen before
+        """
+        if digest in self.__content_digests:
+            self.__content_digests.move_to_end(digest)
+            return False
+        self.__content_digests[digest] = None
+        while len(self.__content_digests) > MAX_CONTENT_DIGESTS:
+            self.__content_digests.popitem(last=False)
+        return True
+
+    def to_dict(self) -> dict:
+        # Entries being fetched are saved as pending, they are fetched again on resume
+        entries = [e.to_list() for e in self.__heap] + [e.to_list() for e in self.__inflight_entries]
+        return {
+            'sequence': self.__sequence,
+            'cycles': self.cycles,
+            'entries': entries,
+            'seen_cycle': list(self.__seen_cycle),
+            'seen_leaves': self.__seen_leaves.to_dict(),
+            'content_digests': list(self.__content_digests.keys()),
+        }
+
+    def load_dict(self, value: dict):
+        self.__sequence = value['sequence']
+        self.cycles = value['cycles']
+        self.__heap = [FrontierEntry(*e) for e in value['entries']]
+        heapq.heapify(self.__heap)
+        self.__seen_cycle = set(value['seen_cycle'])
+        self.__seen_leaves = BloomFilter.from_dict(value['seen_leaves'])
+        self.__content_digests = OrderedDict((d, None) for d in value['content_digests'])
+
+
+def load_frontier(path: pathlib.Path, frontier: CrawlFrontier) -> bool:
+    """
+    Loads a saved frontier. Blocking.
+    :return: True when the state was loaded
+    """
+    try:
+        with open(path, 'rt') as fp:
+            frontier.load_dict(json.load(fp))
+        return True
+    except FileNotFoundError:
+        return False
+    except (json.JSONDecodeError, KeyError, ValueError, TypeError):
+        logging.getLogger(__name__).warning("Corrupted crawl state %s, starting over" % path)
+        return False
+
+
+def save_frontier(path: pathlib.Path, state: dict):
+    """
+    Saves the frontier with an atomic replace. Blocking.
+    :param state: Result of CrawlFrontier.to_dict(), taken on the event loop
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path_work = path.with_suffix('.work')
+    with open(path_work, 'wt') as fp:
+        json.dump(state, fp)
+    os.replace(path_work, path)
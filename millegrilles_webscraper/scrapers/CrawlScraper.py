@@ -0,0 +1,460 @@
+import asyncio
+import binascii
+import datetime
+import hashlib
+import json
+import logging
+import math
+import pathlib
+import re
+import tempfile
+
+from html.parser import HTMLParser
+from typing import Optional, TypedDict
+from urllib.parse import urljoin, urldefrag, urlparse
+
+from millegrilles_messages.messages.Hachage import hacher_to_digest
+from millegrilles_webscraper.ContentEncoding import PASSTHROUGH_ENCODINGS
+from millegrilles_webscraper.Context import WebScraperContext
+from millegrilles_webscraper.DataCollectorItem import DataCollectorItem, DataCollectorFilesDict
+from millegrilles_webscraper.DataStructures import AttachedFile
+from millegrilles_webscraper.Deadline import current_deadline
+from millegrilles_webscraper.HttpClient import HttpBodyTooLargeError, SpoolReader
+from millegrilles_webscraper.scrapers.CrawlFrontier import CrawlFrontier, load_frontier, save_frontier
+from millegrilles_webscraper.scrapers.DataItemScraper import DataItemScraper
+from millegrilles_webscraper.scrapers.WebScraper import FeedParametersType
+
+CRAWL_DIRECTORY = 'crawl'
+CRAWL_CONCURRENCY = 4  # Pages fetched at the same time by a crawl, see also host_concurrency
+MAX_PARSE_SIZE = 2 * 1024 * 1024  # Bytes of a page parsed for links
+SAVE_INTERVAL = 10  # Pages fetched between saves of the frontier
+DEADLINE_RESERVE = 0.5  # Fraction of the scrape deadline kept to save the fetched pages, no new fetch after
+
+# Outcome of a fetch
+FETCH_RETRY = 'retry'    # Failed or not saved, fetched again in the next cycle
+FETCH_DONE = 'done'      # Nothing to save (error response, duplicate content), a leaf is not fetched again
+FETCH_NEW = 'new'        # New page, a leaf is not fetched again once the page is saved
+
+DEFAULT_MAX_DEPTH = 1
+DEFAULT_MAX_PAGES = 20
+DEFAULT_HOST_CONCURRENCY = 2
+
+VOID_ELEMENTS = {'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'param', 'source',
+                 'track', 'wbr'}
+
+
+class SimpleSelector:
+    """
+    Selector of the form tag, .class, #id or a combination (e.g. div.article). Matches an element.
+    """
+
+    def __init__(self, selector: str):
+        match = re.fullmatch(r'([a-zA-Z0-9_-]*)((?:[.#][a-zA-Z0-9_-]+)*)', selector.strip())
+        if match is None or selector.strip() == '':
+            raise ValueError('Unsupported selector: %s' % selector)
+        self.tag = match.group(1).lower() or None
+        self.classes = set(re.findall(r'\.([a-zA-Z0-9_-]+)', match.group(2)))
+        ids = re.findall(r'#([a-zA-Z0-9_-]+)', match.group(2))
+        self.id = ids[0] if len(ids) > 0 else None
+
+    def matches(self, tag: str, classes: set[str], element_id: Optional[str]) -> bool:
+        if self.tag is not None and self.tag != tag:
+            return False
+        if self.id is not None and self.id != element_id:
+            return False
+        return self.classes.issubset(classes)
+
+
+class PageInfo:
+
+    def __init__(self):
+        self.title: Optional[str] = None
+        self.picture: Optional[str] = None
+        self.links: list[str] = list()
+
+
+class PageParser(HTMLParser):
+    """
+    Extracts the title, og:image and links of a page. With selectors, only the links inside (or on) a matching
+    element are kept.
+    """
+
+    def __init__(self, base_url: str, selectors: list[SimpleSelector]):
+        super().__init__(convert_charrefs=True)
+        self.__base_url = base_url
+        self.__selectors = selectors
+        self.__stack: list[tuple[str, bool]] = list()  # (tag, matches a selector)
+        self.__matched_depth = 0
+        self.__in_title = False
+        self.__title_parts: list[str] = list()
+        self.info = PageInfo()
+
+    def handle_starttag(self, tag, attrs):
+        attributes = dict(attrs)
+        if tag == 'base' and attributes.get('href'):
+            self.__base_url = urljoin(self.__base_url, attributes['href'])
+        elif tag == 'meta' and attributes.get('property') == 'og:image' and self.info.picture is None:
+            content = attributes.get('content')
+            if content:
+                self.info.picture = urljoin(self.__base_url, content)
+        elif tag == 'title' and self.info.title is None:
+            self.__in_title = True
+
+        matched = False
+        if len(self.__selectors) > 0:
+            classes = set((attributes.get('class') or '').split())
+            element_id = attributes.get('id')
+            matched = any(s.matches(tag, classes, element_id) for s in self.__selectors)
+
+        if tag == 'a' and attributes.get('href') and (len(self.__selectors) == 0 or matched or self.__matched_depth > 0):
+            self.info.links.append(urljoin(self.__base_url, attributes['href']))
+
+        if tag not in VOID_ELEMENTS:
+            self.__stack.append((tag, matched))
+            if matched:
+                self.__matched_depth += 1
+
+    def handle_endtag(self, tag):
+        if tag == 'title' and self.__in_title:
+            self.__in_title = False
+            self.info.title = ' '.join(''.join(self.__title_parts).split()) or None
+        # Close up to the matching start tag, tolerates unclosed elements
+        for i in range(len(self.__stack) - 1, -1, -1):
+            if self.__stack[i][0] == tag:
+                for _tag, matched in self.__stack[i:]:
+                    if matched:
+                        self.__matched_depth -= 1
+                del self.__stack[i:]
+                break
+
+    def handle_data(self, data):
+        if self.__in_title:
+            self.__title_parts.append(data)
+
+
+def parse_page(content: bytes, charset: Optional[str], base_url: str, selectors: list[SimpleSelector]) -> PageInfo:
+    """ Blocking, run in a thread. """
+    try:
+        text = content.decode(charset or 'utf-8', errors='replace')
+    except LookupError:
+        text = content.decode('utf-8', errors='replace')
+    parser = PageParser(base_url, selectors)
+    parser.feed(text)
+    parser.close()
+    return parser.info
+
+
+class CrawlPage:
+
+    def __init__(self, url: str, depth: int, leaf: bool, referrer: Optional[str], digest: str, reader: SpoolReader,
+                 size: int, content_type: Optional[str], info: Optional[PageInfo]):
+        self.url = url
+        self.depth = depth
+        self.leaf = leaf
+        self.referrer = referrer
+        self.digest = digest
+        self.reader = reader
+        self.raw_reader: Optional[SpoolReader] = None  # Transport encoded content, stored as-is
+        self.encoding: Optional[str] = None
+        self.size = size
+        self.content_type = content_type
+        self.title = info.title if info else None
+        self.picture = info.picture if info else None
+        self.date = datetime.datetime.now(tz=datetime.timezone.utc)
+
+    def close(self):
+        self.reader.close()
+        if self.raw_reader is not None:
+            self.raw_reader.close()
+
+
+class DataCollectorCrawlClearData(TypedDict):
+    title: Optional[str]
+    snippet: Optional[str]
+    url: str
+    pub_date: int
+    item_source: Optional[str]
+    picture_url: Optional[str]
+    picture_source: Optional[str]
+    depth: int
+    referrer: Optional[str]
+    content_type: Optional[str]
+    size: int
+
+
+class DataCollectorCrawlPage(DataCollectorItem):
+
+    def __init__(self, feed_id: str, page: CrawlPage):
+        super().__init__(feed_id)
+        self.page = page
+
+    def _produce_data_id(self):
+        items_str = json.dumps([self.page.url, self.page.digest])
+        digest_value = hacher_to_digest(items_str, 'blake2s-256')
+        return binascii.hexlify(digest_value).decode('utf-8')
+
+    def produce_data(self) -> DataCollectorCrawlClearData:
+        page = self.page
+        host = urlparse(page.url).netloc
+        return {
+            'title': page.title,
+            'snippet': None,
+            'url': page.url,
+            'pub_date': math.floor(page.date.timestamp()),
+            'item_source': host,
+            'picture_url': page.picture,
+            'picture_source': host if page.picture else None,
+            'depth': page.depth,
+            'referrer': page.referrer,
+            'content_type': page.content_type,
+            'size': page.size,
+        }
+
+
+class CrawlScraper(DataItemScraper):
+    """
+    Crawls from the seed url: links are extracted with the selectors and followed up to max_depth, at most
+    max_pages pages are fetched per poll. Each new page is saved as an item with its content as an attached file.
+    The frontier is saved under dir_data, an interrupted crawl resumes on the next poll or after a restart.
+
+    Feed information: url (seed), max_depth, max_pages, link_selectors (e.g. ["div.article", "#news"]),
+    follow_patterns and exclude_patterns (regular expressions on the absolute url), same_host (default true),
+    host_concurrency.
+    """
+
+    def __init__(self, context: WebScraperContext, feed: FeedParametersType, semaphore: asyncio.BoundedSemaphore):
+        self.__logger = logging.getLogger(f'{__name__}.{self.__class__.__name__}')
+        # Define variables filled by update() before super() call
+        self.__max_depth = DEFAULT_MAX_DEPTH
+        self.__max_pages = DEFAULT_MAX_PAGES
+        self.__host_concurrency = DEFAULT_HOST_CONCURRENCY
+        self.__selectors: list[SimpleSelector] = list()
+        self.__follow_patterns: list[re.Pattern] = list()
+        self.__exclude_patterns: list[re.Pattern] = list()
+        self.__same_host = True
+        self.__configuration_error: Optional[str] = None  # The feed is not crawled while its configuration is invalid
+        self.__frontier: Optional[CrawlFrontier] = None
+
+        super().__init__(context, feed, semaphore)
+
+        self.__state_path = pathlib.Path(context.configuration.dir_data, CRAWL_DIRECTORY, '%s.json' % self.feed_id)
+
+    def update(self, parameters: FeedParametersType):
+        super().update(parameters)
+        info = parameters['decrypted_feed_information']
+        try:
+            max_depth = max(1, int(info.get('max_depth') or DEFAULT_MAX_DEPTH))
+            max_pages = max(1, int(info.get('max_pages') or DEFAULT_MAX_PAGES))
+            host_concurrency = max(1, int(info.get('host_concurrency') or DEFAULT_HOST_CONCURRENCY))
+            selectors = [SimpleSelector(s) for s in info.get('link_selectors') or list()]
+            follow_patterns = [re.compile(p) for p in info.get('follow_patterns') or list()]
+            exclude_patterns = [re.compile(p) for p in info.get('exclude_patterns') or list()]
+        except (ValueError, TypeError, AttributeError, re.error) as e:
+            # Other feeds are not affected, this one is skipped until its configuration is fixed
+            self.__logger.warning("Invalid crawl configuration for feed %s, crawl disabled: %s" % (parameters['feed_id'], e))
+            self.__configuration_error = str(e)
+            return
+
+        self.__configuration_error = None
+        self.__max_depth = max_depth
+        self.__max_pages = max_pages
+        self.__host_concurrency = host_concurrency
+        self.__selectors = selectors
+        self.__follow_patterns = follow_patterns
+        self.__exclude_patterns = exclude_patterns
+        self.__same_host = info.get('same_host') is not False
+        if self.__frontier is not None:
+            self.__frontier.host_limit = self.__host_concurrency
+
+    async def get_content(self, tmp_file: tempfile.TemporaryFile) -> int:
+        if self.__configuration_error is not None:
+            self.__logger.warning("Skipping crawl of feed %s, invalid configuration: %s" % (self.feed_id, self.__configuration_error))
+            return 0
+        return await super().get_content(tmp_file)
+
+    async def process(self, input_file: tempfile.TemporaryFile, output_file: tempfile.TemporaryFile()):
+        frontier = await self.__load_frontier()
+
+        # The seed is fetched on every poll, new links are added to the frontier
+        content = await self._context.io_executor.run(input_file.read, MAX_PARSE_SIZE)
+        with self._context.metrics.span('parse'):
+            info = await self._context.cpu_executor.run(parse_page, content, None, self.url, self.__selectors)
+        added = self.__push_links(frontier, info.links, 1, self.url)
+        self.__logger.debug("Seed %s: %d links, %d added to the frontier" % (self.url, len(info.links), added))
+
+        pages: list[CrawlPage] = list()
+        try:
+            await self.__crawl(frontier, pages)
+
+            items = [DataCollectorCrawlPage(self.feed_id, p) for p in pages]
+            if len(items) > 0:
+                await self._process_content(items)  # Marks the saved pages in the frontier, see _item_saved
+            await self.__save_frontier()
+        finally:
+            for page in pages:
+                page.close()
+
+    def _item_saved(self, item: DataCollectorItem):
+        page: CrawlPage = item.page
+        self.__frontier.saved(page.url, page.leaf, page.digest)
+
+    async def _item_files(self, item: DataCollectorItem) -> list[DataCollectorFilesDict]:
+        page: CrawlPage = item.page
+        if page.raw_reader is not None:
+            # Keep the compressed bytes received from the server
+            page.raw_reader.seek(0)
+            attached_file: AttachedFile = await self._context.file_handler.encrypt_upload_file(
+                self._encryption_key.secret_key, page.raw_reader, self._encryption_key.key_id,
+                compression=page.encoding, key_domains=self._key_domains)
+        else:
+            page.reader.seek(0)
+            attached_file: AttachedFile = await self._context.file_handler.encrypt_upload_file(
+                self._encryption_key.secret_key, page.reader, self._encryption_key.key_id,
+                key_domains=self._key_domains)
+        return [self._file_reference(attached_file)]
+
+    async def __load_frontier(self) -> CrawlFrontier:
+        if self.__frontier is None:
+            frontier = CrawlFrontier(self.__host_concurrency)
+            if await self._context.io_executor.run(load_frontier, self.__state_path, frontier):
+                self.__logger.info("Resuming crawl of feed %s with %d pending urls" % (self.feed_id, len(frontier)))
+            self.__frontier = frontier
+        return self.__frontier
+
+    async def __save_frontier(self):
+        state = self.__frontier.to_dict()
+        await self._context.io_executor.run(save_frontier, self.__state_path, state)
+
+    async def __crawl(self, frontier: CrawlFrontier, pages: list[CrawlPage]):
+        condition = asyncio.Condition()
+        budget = self.__max_pages
+        fetched = 0
+        deadline = current_deadline.get()
+        digests: set[str] = set()  # Content fetched by this crawl
+
+        async def worker():
+            nonlocal budget, fetched
+            while self._context.stopping is False:
+                async with condition:
+                    while True:
+                        if budget <= 0:
+                            return
+                        if deadline is not None and deadline.remaining() < deadline.seconds * DEADLINE_RESERVE:
+                            return  # Pending urls are kept for the next poll
+                        entry = frontier.pop()
+                        if entry is not None:
+                            break
+                        if frontier.inflight == 0:
+                            return  # Frontier is empty
+                        await condition.wait()
+                    budget -= 1
+
+                status = FETCH_RETRY
+                try:
+                    status = await self.__fetch(frontier, entry, pages, digests)
+                except asyncio.CancelledError as e:
+                    raise e
+                except Exception as e:
+                    self.__logger.info("Error crawling %s: %s" % (entry.url, e))
+                finally:
+                    async with condition:
+                        frontier.done(entry, status == FETCH_DONE)
+                        condition.notify_all()
+
+                fetched += 1
+                if fetched % SAVE_INTERVAL == 0:
+                    await self.__save_frontier()
+
+        await asyncio.gather(*[worker() for _ in range(CRAWL_CONCURRENCY)])
+        self.__logger.debug("Crawled %d pages of feed %s, %d new, %d pending" % (fetched, self.feed_id, len(pages), len(frontier)))
+
+    async def __fetch(self, frontier: CrawlFrontier, entry, pages: list[CrawlPage], digests: set[str]) -> str:
+        """
+        :return: FETCH_NEW when a page was added to pages, FETCH_DONE when there is nothing to save, FETCH_RETRY
+                 for a copy of a page not saved yet
+        """
+        with self._context.metrics.span('crawl_fetch') as span:
+            try:
+                content = await self._context.http_client.get(entry.url, headers=self._request_headers(),
+                                                              max_size=self.max_body_size)
+            except HttpBodyTooLargeError as e:
+                self.__logger.info("Crawl of %s: %s" % (entry.url, e))
+                return FETCH_DONE  # Not retried
+            span.bytes = content.size
+        if not content.ok:
+            self.__logger.debug("Crawl of %s: HTTP %s" % (entry.url, content.status))
+            return FETCH_DONE
+
+        reader = content.open()
+        try:
+            digest = await self._context.cpu_executor.run(_digest_reader, reader)
+            # Same content as a saved page, or as a page of this crawl (checked again next cycle once it is saved)
+            duplicate = frontier.content_seen(digest)
+            pending_duplicate = not duplicate and digest in digests
+            digests.add(digest)
+
+            content_type = content.headers.get('Content-Type')
+            info: Optional[PageInfo] = None
+            if (content_type is None or 'html' in content_type) and not ((duplicate or pending_duplicate) and entry.leaf):
+                reader.seek(0)
+                data = await self._context.io_executor.run(reader.read, MAX_PARSE_SIZE)
+                charset = _charset(content_type)
+                info = await self._context.cpu_executor.run(parse_page, data, charset, entry.url, self.__selectors)
+                if not entry.leaf:
+                    # Links of unchanged hubs are followed too, deeper hubs are refreshed on each cycle
+                    self.__push_links(frontier, info.links, entry.depth + 1, entry.url)
+
+            if duplicate:
+                return FETCH_DONE
+            if pending_duplicate:
+                return FETCH_RETRY
+
+            # The page keeps the reader, released after the items are saved
+            page = CrawlPage(entry.url, entry.depth, entry.leaf, entry.referrer, digest, reader, content.size,
+                             content_type, info)
+            reader = None
+            if content.encoding in PASSTHROUGH_ENCODINGS:
+                page.raw_reader = content.open_raw()
+                page.encoding = content.encoding
+            pages.append(page)
+            return FETCH_NEW
+        finally:
+            if reader is not None:
+                reader.close()
+
+    def __push_links(self, frontier: CrawlFrontier, links: list[str], depth: int, referrer: str) -> int:
+        seed_host = urlparse(self.url).netloc.lower()
+        added = 0
+        for link in links:
+            link, _fragment = urldefrag(link)
+            parsed = urlparse(link)
+            if parsed.scheme not in ('http', 'https'):
+                continue
+            if self.__same_host and parsed.netloc.lower() != seed_host:
+                continue
+            if any(p.search(link) for p in self.__exclude_patterns):
+                continue
+            if len(self.__follow_patterns) > 0 and not any(p.search(link) for p in self.__follow_patterns):
+                continue
+            if link == self.url:
+                continue
+            if frontier.push(link, depth, depth >= self.__max_depth, referrer):
+                added += 1
+        return added
+
+
+def _digest_reader(reader) -> str:
+    digester = hashlib.blake2b(digest_size=32)
+    while True:
+        chunk = reader.read(64 * 1024)
+        if len(chunk) == 0:
+            break
+        digester.update(chunk)
+    return digester.hexdigest()
+
+
+def _charset(content_type: Optional[str]) -> Optional[str]:
+    if content_type is None:
+        return None
+    match = re.search(r'charset=([^\s;]+)', content_type, re.IGNORECASE)
+    return match.group(1).strip('"\'') if match else None
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+
+from millegrilles_messages.messages import Constantes
+from millegrilles_messages.chiffrage.Mgs4 import chiffrer_document
+from millegrilles_webscraper.Context import WebScraperContext
+from millegrilles_webscraper.DataCollectorItem import DataCollectorItem, DataCollectorDict, DataCollectorFilesDict
+from millegrilles_webscraper.DataStructures import AttachedFile
+from millegrilles_webscraper.HostHealth import HostOpenError
+from millegrilles_webscraper.HttpClient import HttpBodyTooLargeError
+from millegrilles_webscraper.scrapers.WebScraper import WebScraper, FeedParametersType
+
+
+class DataItemScraper(WebScraper):
+    """
+    Base of the scrapers saving each item of a document separately. Only the items with a data_id unknown to
+    DataCollector are encrypted and saved. The picture_url of an item (produce_data) is uploaded as a thumbnail.
+    """
+
+    def __init__(self, context: WebScraperContext, feed: FeedParametersType, semaphore: asyncio.BoundedSemaphore):
+        super().__init__(context, feed, semaphore)
+        self.__logger = logging.getLogger(f'{__name__}.{self.__class__.__name__}')
+
+    async def _process_content(self, data: list[DataCollectorItem]):
+        # Generate ids to check which have already been produced
+        data_ids = [d.get_data_id() for d in data]
+        producer = await self._context.get_producer()
+        response = await producer.request({"feed_id": self.feed_id, "data_ids": data_ids}, "DataCollector", "checkExistingDataIds", exchange=Constantes.SECURITE_PUBLIC)
+        unknown_ids = set(response.parsed['missing_ids'])
+        missing_ids = set(unknown_ids)
+
+        # Filter out existing ids, keep the first item of duplicates in the document
+        new_items: list[tuple[DataCollectorItem, dict]] = list()
+        for item in data:
+            data_id = item.get_data_id()
+            if data_id in missing_ids:
+                missing_ids.remove(data_id)
+                new_items.append((item, item.produce_data()))
+            elif data_id not in unknown_ids:
+                self._item_saved(item)
+
+        if len(new_items) == 0:
+            self.__logger.debug("No changes to content since last scrape")
+            # Nothing to do
+            return
+
+        self.__logger.debug("Processing %d new items" % len(new_items))
+
+        await self._prepare_key_command(producer)
+
+        # Get thumbnails for all remaining items, small thumbnails are grouped in pack files
+        thumbnail_urls = set([d['picture_url'] for _i, d in new_items if d.get('picture_url')])
+        async with self._context.file_handler.pack():
+            thumbnail_dict = await self._upload_thumbnails(thumbnail_urls)
+
+        # Encrypt content and produce DataCollector item
+        for item, item_data in new_items:
+            with self._context.metrics.span('encrypt'):
+                encrypted_data = chiffrer_document(self._encryption_key.secret_key, self._encryption_key.key_id, item_data)
+            # Rename the data_chiffre field to new standard ciphertext_base64
+            encrypted_data['ciphertext_base64'] = encrypted_data['data_chiffre']
+            del encrypted_data['data_chiffre']
+            data_collector_dict: DataCollectorDict = {
+                'data_id': item.get_data_id(),
+                'feed_id': self.feed_id,
+                'pub_date': item_data['pub_date'],
+                'encrypted_data': encrypted_data,
+            }
+
+            files = await self._item_files(item)
+
+            # Inject thumbnail if present
+            thumbnail = thumbnail_dict.get(item_data.get('picture_url'))
+            if thumbnail:
+                files.append(self._file_reference(thumbnail))
+
+            if len(files) > 0:
+                data_collector_dict['files'] = files
+
+            # Emit item for saving in the DataCollector domain
+            response = await producer.command(data_collector_dict, "DataCollector", "saveDataItem",
+                                              exchange=Constantes.SECURITE_PUBLIC, attachments=self._key_attachments())
+            self._key_save_response(response)
+            if response.parsed.get('ok') is True:
+                self._item_saved(item)
+
+    def _item_saved(self, item: DataCollectorItem):
+        """
+        Override to be notified when an item is known to DataCollector, saved previously or by this scrape.
+        """
+        pass
+
+    async def _item_files(self, item: DataCollectorItem) -> list[DataCollectorFilesDict]:
+        """
+        Override to upload files attached to a new item.
+        :return: References of the uploaded files
+        """
+        return list()
+
+    def _file_reference(self, attached_file: AttachedFile) -> DataCollectorFilesDict:
+        cle_id: str = attached_file['cle_id'] or self._encryption_key.key_id
+        reference: DataCollectorFilesDict = {
+            'fuuid': attached_file['fuuid'],
+            'decryption': {'cle_id': cle_id, 'nonce': attached_file['nonce'], 'format': attached_file['format']}
+        }
+        if attached_file.get('compression') is not None:
+            reference['decryption']['compression'] = attached_file['compression']
+        if attached_file.get('pack') is not None:
+            reference['pack'] = attached_file['pack']
+        return reference
+
+    async def _upload_thumbnails(self, thumbnail_urls: set[str]) -> dict[str, AttachedFile]:
+        thumbnail_dict: dict[str, AttachedFile] = dict()
+        for thumbnail_url in thumbnail_urls:
+            # Feeds sharing thumbnail urls share the download
+            try:
+                with self._context.metrics.span('download_thumbnail') as span:
+                    content = await self._context.http_client.get(thumbnail_url, max_size=self.max_body_size)
+                    span.bytes = content.size
+            except (HostOpenError, HttpBodyTooLargeError) as e:
+                self.__logger.info("Skipping thumbnail %s: %s" % (thumbnail_url, e))
+                continue
+            if content.status != 200:
+                self.__logger.warning("Error loading thumbnail (%s) at %s" % (content.status, thumbnail_url))
+                await asyncio.sleep(0.5)
+                continue
+
+            with content.open() as content_reader:
+                thumbnail_result: AttachedFile = await self._context.file_handler.encrypt_upload_file(
+                    self._encryption_key.secret_key, content_reader, self._encryption_key.key_id, thumbnail=True,
+                    key_domains=self._key_domains)
+            thumbnail_dict[thumbnail_url] = thumbnail_result
+
+        return thumbnail_dict
+
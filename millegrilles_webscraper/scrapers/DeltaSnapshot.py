@@ -0,0 +1,211 @@
+import json
+import logging
+import os
+import pathlib
+import re
+import shutil
+
+from typing import BinaryIO, Callable, Optional, TypedDict
+
+from millegrilles_webscraper.DataStructures import DeltaReference
+
+DELTA_FORMAT = 'mgdelta1'
+DELTA_MAGIC = b'MGD1'
+OP_COPY = 1     # Copy a range of the base: offset, length
+OP_INSERT = 2   # Insert new bytes: length, bytes
+
+# Tokens end after a new line or the end of a tag, minified html and xml still have many tokens
+TOKEN_PATTERN = re.compile(rb'(?<=[\n>])')
+ANCHOR_TOKENS = 4  # Consecutive tokens looked up in the base to start a copy
+
+
+class SnapshotState(TypedDict):
+    data_id: str            # Digest of the content of the snapshot
+    fuuid: str              # Data file of the snapshot
+    keyframe_fuuid: str
+    sequence: int           # 0 for a keyframe
+
+
+def encode_delta(base: bytes, target: bytes) -> bytes:
+    """
+    Encodes target as copies of ranges of base and inserted bytes. Greedy matching on tokens: runs of
+    ANCHOR_TOKENS target tokens are looked up in the base and extended as long as the tokens match, linear time.
+    Blocking, CPU bound.
+    :return: Delta, apply with apply_delta(base, delta)
+    """
+    base_tokens = TOKEN_PATTERN.split(base)
+    target_tokens = TOKEN_PATTERN.split(target)
+
+    base_offsets = [0]
+    for token in base_tokens:
+        base_offsets.append(base_offsets[-1] + len(token))
+
+    anchors: dict[tuple, int] = dict()  # First position of each run of tokens in the base
+    for i in range(len(base_tokens) - ANCHOR_TOKENS, -1, -1):
+        anchors[tuple(base_tokens[i:i + ANCHOR_TOKENS])] = i
+
+    output = bytearray(DELTA_MAGIC)
+    _write_varint(output, len(target))
+
+    insert_start: Optional[int] = None  # First target token of the pending insert
+    next_base: Optional[int] = None  # Base token following the last copy, tried first
+    j = 0
+    while j < len(target_tokens):
+        if next_base is not None and next_base < len(base_tokens) and base_tokens[next_base] == target_tokens[j]:
+            i = next_base
+        else:
+            i = anchors.get(tuple(target_tokens[j:j + ANCHOR_TOKENS]))
+        if i is None:
+            if insert_start is None:
+                insert_start = j
+            next_base = None
+            j += 1
+            continue
+
+        if insert_start is not None:
+            _write_insert(output, b''.join(target_tokens[insert_start:j]))
+            insert_start = None
+        start = i
+        while i < len(base_tokens) and j < len(target_tokens) and base_tokens[i] == target_tokens[j]:
+            i += 1
+            j += 1
+        output.append(OP_COPY)
+        _write_varint(output, base_offsets[start])
+        _write_varint(output, base_offsets[i] - base_offsets[start])
+        next_base = i
+
+    if insert_start is not None:
+        _write_insert(output, b''.join(target_tokens[insert_start:]))
+
+    return bytes(output)
+
+
+def apply_delta(base: bytes, delta: bytes) -> bytes:
+    """
+    :return: Content encoded by the delta
+    :raises ValueError: Invalid delta or wrong base
+    """
+    if delta[:len(DELTA_MAGIC)] != DELTA_MAGIC:
+        raise ValueError('Invalid delta header')
+    position = len(DELTA_MAGIC)
+    target_size, position = _read_varint(delta, position)
+
+    output = bytearray()
+    while position < len(delta):
+        op = delta[position]
+        position += 1
+        if op == OP_COPY:
+            offset, position = _read_varint(delta, position)
+            length, position = _read_varint(delta, position)
+            if offset + length > len(base):
+                raise ValueError('Delta copy outside of the base')
+            output.extend(base[offset:offset + length])
+        elif op == OP_INSERT:
+            length, position = _read_varint(delta, position)
+            output.extend(delta[position:position + length])
+            position += length
+        else:
+            raise ValueError('Invalid delta operation %d' % op)
+
+    if len(output) != target_size:
+        raise ValueError('Delta output size mismatch')
+    return bytes(output)
+
+
+def rebuild_snapshot(fuuid: str, load: Callable[[str], tuple[Optional[DeltaReference], bytes]]) -> bytes:
+    """
+    Reference decoder. Rebuilds the content of any version of a delta chain. Blocking.
+    :param fuuid: Data file of the version
+    :param load: Returns the delta reference (DataFeedFile delta, None for a keyframe) and the decrypted
+                 encrypted_data of a data file
+    :return: Content of the version
+    """
+    deltas: list[bytes] = list()
+    while True:
+        reference, payload = load(fuuid)
+        if reference is None:
+            content = payload  # Keyframe
+            break
+        if reference.get('format') != DELTA_FORMAT:
+            raise ValueError('Unsupported delta format %s' % reference.get('format'))
+        deltas.append(payload)
+        fuuid = reference['base_fuuid']
+
+    for delta in reversed(deltas):
+        content = apply_delta(content, delta)
+    return content
+
+
+class SnapshotStore:
+    """
+    Plaintext of the last version saved by a feed, the base of the next delta. Kept under dir_data.
+    """
+
+    def __init__(self, directory: pathlib.Path, feed_id: str):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__content_path = pathlib.Path(directory, '%s.bin' % feed_id)
+        self.__state_path = pathlib.Path(directory, '%s.json' % feed_id)
+
+    def load_state(self) -> Optional[SnapshotState]:
+        """ Blocking. :return: State of the snapshot, None when missing or corrupted """
+        try:
+            with open(self.__state_path, 'rt') as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return None
+        except (json.JSONDecodeError, OSError):
+            self.__logger.warning("Corrupted snapshot %s, the next version is a keyframe" % self.__state_path)
+            return None
+
+    def load_content(self) -> Optional[bytes]:
+        """ Blocking. :return: Content of the snapshot, None when missing """
+        try:
+            with open(self.__content_path, 'rb') as fp:
+                return fp.read()
+        except OSError:
+            self.__logger.warning("Missing snapshot content %s, the next version is a keyframe" % self.__content_path)
+            return None
+
+    def save(self, state: SnapshotState, content_file: BinaryIO):
+        """
+        Blocking. The content is replaced before the state, a state always matches its content.
+        :param content_file: Content of the version, copied from its start
+        """
+        self.__state_path.parent.mkdir(parents=True, exist_ok=True)
+        self.__state_path.unlink(missing_ok=True)
+        path_work = self.__content_path.with_suffix('.work')
+        content_file.seek(0)
+        with open(path_work, 'wb') as fp:
+            shutil.copyfileobj(content_file, fp)
+        os.replace(path_work, self.__content_path)
+        path_work = self.__state_path.with_suffix('.work')
+        with open(path_work, 'wt') as fp:
+            json.dump(state, fp)
+        os.replace(path_work, self.__state_path)
+
+
+def _write_insert(output: bytearray, content: bytes):
+    output.append(OP_INSERT)
+    _write_varint(output, len(content))
+    output.extend(content)
+
+
+def _write_varint(output: bytearray, value: int):
+    while value >= 0x80:
+        output.append((value & 0x7f) | 0x80)
+        value >>= 7
+    output.append(value)
+
+
+def _read_varint(data: bytes, position: int) -> tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        if position >= len(data):
+            raise ValueError('Truncated delta')
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
@@ -0,0 +1,374 @@
+import aiohttp
+import asyncio
+import logging
+import time
+
+from typing import Optional
+from urllib.parse import urljoin
+
+from millegrilles_messages.messages import Constantes
+from millegrilles_webscraper.Context import WebScraperContext
+from millegrilles_webscraper.DataStructures import Filehost
+from millegrilles_webscraper.Deadline import deadline_timeout
+from millegrilles_webscraper.FeedCosts import COST_STORED_BYTES, COST_UPLOADED_BYTES
+
+CONST_GET_FILE_READ_SOCK_TIMEOUT = 20       # Timeout if no data read after 20 seconds
+REAUTHENTICATE_INTERVAL = 600               # Seconds, keeps the session cookie active
+RECONNECT_DELAY = 5                         # Seconds before reconnecting, doubles up to MAX_RECONNECT_DELAY
+MAX_RECONNECT_DELAY = 120
+READY_TIMEOUT = 10                          # Seconds to wait for a filehost when none is available
+LATENCY_REFERENCE_SIZE = 1024 * 1024        # Latency is normalized to a request of this size
+LATENCY_ALPHA = 0.2                         # Weight of the last request in the latency average
+ERROR_ALPHA = 0.1                           # Weight of the last request in the error rate
+MAX_CONSECUTIVE_ERRORS = 2                  # Errors before the connection is reset
+
+
+class FilehostUnavailableError(Exception):
+    """ No filehost is ready to receive a request. """
+
+
+class FilehostConnection:
+    """
+    Authenticated session with one filehost. The session is re-authenticated periodically and reconnected after
+    errors. The upload latency and error rate of the filehost are tracked to rank it against the others.
+    """
+
+    def __init__(self, context: WebScraperContext, filehost: Filehost, on_ready: asyncio.Condition):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__context = context
+        self.filehost = filehost
+        self.__on_ready = on_ready
+        self.__session: Optional[aiohttp.ClientSession] = None
+        self.__semaphore = asyncio.BoundedSemaphore(1)  # One request at a time on the session
+        self.__reset = asyncio.Event()
+        self.__closed = False
+
+        if filehost.url_external:
+            self.url = filehost.url_external
+            self.__tls_mode = filehost.tls_external or 'external'
+        elif filehost.url_internal:
+            self.url = filehost.url_internal
+            self.__tls_mode = 'millegrille'
+        else:
+            raise ValueError('Unsupported filehost configuration')
+
+        self.latency: Optional[float] = None  # Average seconds per LATENCY_REFERENCE_SIZE request
+        self.error_rate = 0.0
+        self.consecutive_errors = 0
+        self.inflight = 0
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def filehost_id(self) -> str:
+        return self.filehost.filehost_id
+
+    @property
+    def ready(self) -> bool:
+        return self.__session is not None and self.__reset.is_set() is False
+
+    def score(self) -> float:
+        """ :return: Expected cost of the next request, lower is better """
+        latency = self.latency if self.latency is not None else 0.0  # Try new filehosts first
+        return (latency + 0.01) * (1 + self.inflight) * (1 + 10 * self.error_rate)
+
+    def close(self):
+        self.__closed = True
+        self.__reset.set()
+
+    async def run(self):
+        reconnect_delay = RECONNECT_DELAY
+        while self.__context.stopping is False and self.__closed is False:
+            ssl_context = None
+            verify = True
+            if self.__tls_mode == 'millegrille':
+                ssl_context = self.__context.ssl_context
+            elif self.__tls_mode == 'nocheck':
+                verify = False
+
+            connector = aiohttp.TCPConnector(ssl_context=ssl_context, verify_ssl=verify)
+            client_timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=CONST_GET_FILE_READ_SOCK_TIMEOUT)
+            async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+                try:
+                    while self.__context.stopping is False and self.__closed is False:
+                        async with self.__semaphore:
+                            await self.__authenticate(session)
+
+                        # Session is ready
+                        self.__reset.clear()
+                        self.__session = session
+                        self.consecutive_errors = 0
+                        reconnect_delay = RECONNECT_DELAY
+                        async with self.__on_ready:
+                            self.__on_ready.notify_all()
+
+                        self.__logger.info("Authenticated with filehost %s" % self.url)
+                        # Reauthenticate after a while to keep cookie active, or right away after errors
+                        try:
+                            await asyncio.wait_for(self.__reset.wait(), REAUTHENTICATE_INTERVAL)
+                            self.__logger.info("Resetting connection to filehost %s" % self.url)
+                            break
+                        except asyncio.TimeoutError:
+                            pass
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    self.__logger.warning("Error connecting to filehost %s: %s" % (self.url, e))
+                finally:
+                    self.__session = None
+
+            if self.__closed is False:
+                # Wait to reconnect
+                await self.__context.wait(reconnect_delay)
+                reconnect_delay = min(MAX_RECONNECT_DELAY, reconnect_delay * 2)
+
+    async def __authenticate(self, session: aiohttp.ClientSession):
+        url_authenticate = urljoin(self.url, '/filehost/authenticate')
+        auth_message = self.__get_auth_message()
+        async with session.post(url_authenticate, json=auth_message) as r:
+            r.raise_for_status()
+
+    def __get_auth_message(self):
+        ca = self.__context.ca
+        auth_message, message_id = self.__context.formatteur.signer_message(
+            Constantes.KIND_COMMANDE, dict(), 'filehost', action='authenticate')
+        auth_message['millegrille'] = ca.certificat_pem
+        return auth_message
+
+    async def upload(self, fuuid: str, file_size: int, fp):
+        async with self.__request(file_size) as session:
+            # One shot upload
+            headers = {'x-fuuid': fuuid, 'Content-Length': str(file_size)}
+            upload_url = urljoin(self.url, f'/filehost/files/{fuuid}')
+            async with session.put(upload_url, headers=headers, data=fp) as response:
+                response.raise_for_status()
+
+    async def file_exists(self, fuuid: str) -> bool:
+        async with self.__request(0) as session:
+            url = urljoin(self.url, f'/filehost/files/{fuuid}')
+            async with session.head(url) as response:
+                if response.status == 404:
+                    return False
+                response.raise_for_status()
+                return True
+
+    def __request(self, size: int):
+        return _FilehostRequest(self, self.__semaphore, size)
+
+    def _session(self) -> aiohttp.ClientSession:
+        session = self.__session
+        if session is None or self.ready is False:
+            raise FilehostUnavailableError('Filehost %s not ready' % self.url)
+        return session
+
+    def _record(self, duration: float, size: int, error: Optional[BaseException]):
+        self.requests += 1
+        if error is None:
+            self.consecutive_errors = 0
+            self.error_rate = (1 - ERROR_ALPHA) * self.error_rate
+            normalized = duration / (1 + size / LATENCY_REFERENCE_SIZE)
+            if self.latency is None:
+                self.latency = normalized
+            else:
+                self.latency = (1 - LATENCY_ALPHA) * self.latency + LATENCY_ALPHA * normalized
+            return
+
+        self.errors += 1
+        self.consecutive_errors += 1
+        self.error_rate = (1 - ERROR_ALPHA) * self.error_rate + ERROR_ALPHA
+        status = error.status if isinstance(error, aiohttp.ClientResponseError) else None
+        if status in (401, 403) or self.consecutive_errors >= MAX_CONSECUTIVE_ERRORS \
+                or isinstance(error, (aiohttp.ClientConnectionError, asyncio.TimeoutError)):
+            # Stop routing requests here until the session is re-authenticated
+            self.__reset.set()
+
+
+class _FilehostRequest:
+    """ Times a request on a FilehostConnection and records its result. """
+
+    def __init__(self, connection: FilehostConnection, semaphore: asyncio.BoundedSemaphore, size: int):
+        self.__connection = connection
+        self.__semaphore = semaphore
+        self.__size = size
+        self.__start = 0.0
+
+    async def __aenter__(self) -> aiohttp.ClientSession:
+        self.__connection.inflight += 1
+        try:
+            await self.__semaphore.acquire()
+        except BaseException as e:
+            self.__connection.inflight -= 1
+            raise e
+        try:
+            session = self.__connection._session()
+        except BaseException as e:
+            self.__semaphore.release()
+            self.__connection.inflight -= 1
+            raise e
+        self.__start = time.monotonic()
+        return session
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.__semaphore.release()
+        self.__connection.inflight -= 1
+        if not isinstance(exc_val, asyncio.CancelledError):
+            self.__connection._record(time.monotonic() - self.__start, self.__size, exc_val)
+
+
+class FilehostStats:
+
+    def __init__(self, filehost_id: str, url: str, ready: bool, latency: Optional[float], error_rate: float,
+                 requests: int, errors: int):
+        self.filehost_id = filehost_id
+        self.url = url
+        self.ready = ready
+        self.latency = latency
+        self.error_rate = error_rate
+        self.requests = requests
+        self.errors = errors
+
+    def to_dict(self) -> dict:
+        return {
+            'filehost_id': self.filehost_id,
+            'url': self.url,
+            'ready': self.ready,
+            'latency': self.latency,
+            'error_rate': self.error_rate,
+            'requests': self.requests,
+            'errors': self.errors,
+        }
+
+
+class FilehostPool:
+    """
+    Sessions with all the filehosts available to the instance. Each request goes to the ready filehost with the
+    lowest expected cost (latency, requests in progress, error rate). A failed request is retried right away on
+    the next filehost, the failing filehost is skipped until its session is re-authenticated.
+    """
+
+    def __init__(self, context: WebScraperContext):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__context = context
+        self.__connections: dict[str, FilehostConnection] = dict()
+        self.__tasks: dict[str, asyncio.Task] = dict()
+        self.__on_ready = asyncio.Condition()
+
+    @property
+    def ready(self) -> bool:
+        return any(c.ready for c in self.__connections.values())
+
+    async def run(self):
+        try:
+            await self.__context.wait()
+        finally:
+            for connection in self.__connections.values():
+                connection.close()
+            for task in self.__tasks.values():
+                task.cancel()
+            async with self.__on_ready:
+                self.__on_ready.notify_all()
+
+    def update(self, filehosts: list[Filehost], remove: bool = True):
+        """
+        Connects to new filehosts and closes the sessions of the filehosts no longer available.
+        :param remove: When False, the filehosts missing from the list are kept
+        """
+        filehost_ids = set()
+        for filehost in filehosts:
+            filehost_id = filehost.filehost_id
+            filehost_ids.add(filehost_id)
+            existing = self.__connections.get(filehost_id)
+            if existing is not None:
+                if existing.filehost.url_external == filehost.url_external \
+                        and existing.filehost.url_internal == filehost.url_internal:
+                    continue
+                self.__remove(filehost_id)  # Url changed, reconnect
+            try:
+                connection = FilehostConnection(self.__context, filehost, self.__on_ready)
+            except ValueError:
+                self.__logger.warning("Filehost %s has no url, ignored" % filehost_id)
+                continue
+            self.__logger.info("Adding filehost %s (%s)" % (filehost_id, connection.url))
+            self.__connections[filehost_id] = connection
+            self.__tasks[filehost_id] = asyncio.create_task(connection.run())
+
+        if remove is False:
+            return
+        for filehost_id in set(self.__connections.keys()) - filehost_ids:
+            self.__logger.info("Removing filehost %s" % filehost_id)
+            self.__remove(filehost_id)
+
+    def __remove(self, filehost_id: str):
+        connection = self.__connections.pop(filehost_id)
+        connection.close()
+        task = self.__tasks.pop(filehost_id, None)
+        if task is not None:
+            task.cancel()
+
+    async def upload(self, fuuid: str, file_size: int, fp):
+        position = fp.tell()
+
+        async def upload(connection: FilehostConnection):
+            fp.seek(position)
+            self.__context.costs.add(COST_UPLOADED_BYTES, file_size)
+            await connection.upload(fuuid, file_size, fp)
+
+        with self.__context.metrics.span('upload') as span:
+            span.bytes = file_size
+            await self.__route(upload, 'upload of %s' % fuuid)
+        self.__context.costs.add(COST_STORED_BYTES, file_size)
+
+    async def file_exists(self, fuuid: str) -> bool:
+        async def file_exists(connection: FilehostConnection):
+            return await connection.file_exists(fuuid)
+        return await self.__route(file_exists, 'check of %s' % fuuid)
+
+    async def __route(self, request, description: str):
+        """
+        Runs the request on the best ready filehost, fails over to the next ones.
+        """
+        tried: set[str] = set()
+        last_error: Optional[BaseException] = None
+        while True:
+            connection = await self.__select(tried)
+            if connection is None:
+                if last_error is not None:
+                    raise last_error
+                raise FilehostUnavailableError('No filehost available')
+            tried.add(connection.filehost_id)
+            try:
+                return await request(connection)
+            except (aiohttp.ClientError, asyncio.TimeoutError, FilehostUnavailableError) as e:
+                self.__logger.warning("Filehost %s failed %s: %s" % (connection.url, description, e))
+                last_error = e
+
+    async def __select(self, tried: set[str]) -> Optional[FilehostConnection]:
+        """
+        :return: Best ready filehost not tried yet. Waits up to READY_TIMEOUT when no filehost was tried and none is
+                 ready, None when none is available.
+        """
+        def best() -> Optional[FilehostConnection]:
+            candidates = [c for c in self.__connections.values() if c.ready and c.filehost_id not in tried]
+            if len(candidates) == 0:
+                return None
+            return min(candidates, key=lambda c: c.score())
+
+        connection = best()
+        if connection is not None or len(tried) > 0:
+            return connection
+
+        async with self.__on_ready:
+            try:
+                await asyncio.wait_for(self.__on_ready.wait_for(lambda: best() is not None or self.__context.stopping),
+                                       deadline_timeout(READY_TIMEOUT))
+            except asyncio.TimeoutError:
+                return None
+        return best()
+
+    def stats(self) -> list[FilehostStats]:
+        return [FilehostStats(c.filehost_id, c.url, c.ready, c.latency, c.error_rate, c.requests, c.errors)
+                for c in self.__connections.values()]
+
+    def log_stats(self):
+        for s in self.stats():
+            latency = '%.3f s' % s.latency if s.latency is not None else 'n/a'
+            self.__logger.info("Filehost %s (%s): %s, latency %s, error rate %.2f, %d requests, %d errors" % (
+                s.filehost_id, s.url, 'ready' if s.ready else 'not ready', latency, s.error_rate, s.requests, s.errors))
@@ -0,0 +1,148 @@
+import asyncio
+import binascii
+import json
+import logging
+import tempfile
+
+from typing import Optional
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
+
+from millegrilles_messages.messages.Hachage import hacher_to_digest
+from millegrilles_webscraper.Context import WebScraperContext
+from millegrilles_webscraper.scrapers.GoogleTrendsScraper import GoogleTrendsScraper, \
+    DataCollectorGoogleTrendsNewsItem, RegionGroupData
+from millegrilles_webscraper.scrapers.WebScraper import FeedParametersType
+
+
+class DataCollectorMultiRegionNewsItem(DataCollectorGoogleTrendsNewsItem):
+    """
+    News item merged from several regions. The data_id only depends on the url: the date of the item is the
+    earliest group date of the regions where it appears, it changes with the regions of each poll.
+    """
+
+    def get_data_id(self):
+        items_str = json.dumps(['multi_region', self.scraped_item.url])
+        digest_value = hacher_to_digest(items_str, 'blake2s-256')
+        return binascii.hexlify(digest_value).decode('utf-8')
+
+
+class GoogleTrendsMultiRegionScraper(GoogleTrendsScraper):
+    """
+    Google Trends scraper for a list of regions (geo parameter of the RSS url). All regions are fetched
+    concurrently and news items are deduplicated by url across regions before checking data_ids and loading
+    thumbnails. The group of each region where an item appears is kept in the item regions.
+
+    Feed information: url of the trends RSS (its geo parameter is replaced) and geos, the list of regions.
+    """
+
+    def __init__(self, context: WebScraperContext, feed: FeedParametersType, semaphore: asyncio.BoundedSemaphore):
+        self.__logger = logging.getLogger(f'{__name__}.{self.__class__.__name__}')
+        # Define variables filled by update() before super() call
+        self.__geos: list[str] = list()
+        self.__items: Optional[list[DataCollectorMultiRegionNewsItem]] = None
+
+        super().__init__(context, feed, semaphore)
+
+    def update(self, parameters: FeedParametersType):
+        super().update(parameters)
+        geos = parameters['decrypted_feed_information'].get('geos')
+        if geos:
+            self.__geos = [g.strip().upper() for g in geos]
+        else:
+            # Fallback on the region of the url
+            url_geo = dict(parse_qsl(urlparse(self.url).query)).get('geo')
+            self.__logger.warning("No geos configured for feed %s, using region %s of the url" % (parameters['feed_id'], url_geo))
+            self.__geos = [url_geo] if url_geo else list()
+
+    async def get_content(self, tmp_file: tempfile.TemporaryFile) -> int:
+        """
+        Fetches and parses all regions. The merged items are kept for process(), tmp_file is not used.
+        :return: Total number of bytes downloaded for all regions
+        """
+        headers = self._request_headers()
+        region_urls = [(geo, region_url(self.url, geo)) for geo in self.__geos]
+        results = await asyncio.gather(*[self.__fetch_region(url, headers) for _geo, url in region_urls],
+                                       return_exceptions=True)
+
+        len_content = 0
+        region_items: list[tuple[str, list[DataCollectorGoogleTrendsNewsItem]]] = list()
+        errors: list[BaseException] = list()
+        for (geo, url), result in zip(region_urls, results):
+            if isinstance(result, BaseException):
+                errors.append(result)
+                self.__logger.warning("Error fetching region %s (%s): %s" % (geo, url, result))
+                continue
+            items, size = result
+            region_items.append((geo, items))
+            len_content += size
+
+        if len(region_items) == 0 and len(errors) > 0:
+            raise errors[0]  # All regions failed
+
+        self.__items = merge_regions(self.feed_id, region_items)
+        self.__logger.debug("Merged %d items from %d regions" % (len(self.__items), len(region_items)))
+
+        return len_content
+
+    async def __fetch_region(self, url: str, headers: dict) -> tuple[list[DataCollectorGoogleTrendsNewsItem], int]:
+        """
+        Fetches and parses a region as soon as it is downloaded, the content of a completed download can expire
+        (HttpClient.purge) while the slower regions are still downloading.
+        :return: Items of the region and size of the content
+        """
+        content = await self._context.http_client.get(url, headers=headers,
+                                                      max_size=self.max_body_size)
+        content.raise_for_status()
+        with content.open() as reader:
+            items = await self._extract_content(reader)
+        return items, content.size
+
+    async def process(self, input_file: tempfile.TemporaryFile, output_file: tempfile.TemporaryFile()):
+        items = self.__items
+        self.__items = None
+        if items:
+            await self._process_content(items)
+
+
+def region_url(url: str, geo: str) -> str:
+    """
+    :return: The url with its geo query parameter set to geo
+    """
+    parsed = urlparse(url)
+    query = [(k, v) for k, v in parse_qsl(parsed.query) if k != 'geo']
+    query.append(('geo', geo))
+    return urlunparse(parsed._replace(query=urlencode(query)))
+
+
+def merge_regions(feed_id: str, region_items: list[tuple[str, list[DataCollectorGoogleTrendsNewsItem]]]) \
+        -> list[DataCollectorMultiRegionNewsItem]:
+    """
+    Deduplicates news items by url. The item keeps the earliest publication date, the group date of each region
+    is kept in its regions.
+    """
+    merged: dict[str, DataCollectorMultiRegionNewsItem] = dict()
+    for geo, items in region_items:
+        for item in items:
+            scraped_item = item.scraped_item
+            region_group: RegionGroupData = {
+                'geo': geo,
+                'title': scraped_item.group.get('title'),
+                'approx_traffic': scraped_item.group.get('approx_traffic'),
+                'pub_date': scraped_item.group.get('pub_date'),
+            }
+
+            existing = merged.get(scraped_item.url)
+            if existing is None:
+                scraped_item.regions = [region_group]
+                merged[scraped_item.url] = DataCollectorMultiRegionNewsItem(feed_id, scraped_item)
+                continue
+
+            existing_item = existing.scraped_item
+            existing_item.regions.append(region_group)
+            if scraped_item.date is not None and (existing_item.date is None or scraped_item.date < existing_item.date):
+                existing_item.date = scraped_item.date
+            if existing_item.picture is None and scraped_item.picture is not None:
+                existing_item.picture = scraped_item.picture
+                existing_item.picture_source = scraped_item.picture_source
+
+    return list(merged.values())
@@ -5,22 +5,17 @@ import json
 import math
 import tempfile
 
-import aiohttp
 import logging
 
-from io import BytesIO
 from typing import Optional, TypedDict
 
 from xml.etree import ElementTree as ET
 
-from millegrilles_messages.messages import Constantes
-from millegrilles_messages.chiffrage.Mgs4 import chiffrer_document
-from millegrilles_messages.messages.EnveloppeCertificat import EnveloppeCertificat
 from millegrilles_messages.messages.Hachage import hacher_to_digest
 from millegrilles_webscraper.Context import WebScraperContext
-from millegrilles_webscraper.DataCollectorItem import DataCollectorItem, DataCollectorDict
-from millegrilles_webscraper.DataStructures import AttachedFile
-from millegrilles_webscraper.scrapers.WebScraper import WebScraper, FeedParametersType
+from millegrilles_webscraper.DataCollectorItem import DataCollectorItem
+from millegrilles_webscraper.scrapers.DataItemScraper import DataItemScraper
+from millegrilles_webscraper.scrapers.WebScraper import FeedParametersType
 
 
 class GroupData(TypedDict):
@@ -29,6 +24,10 @@ class GroupData(TypedDict):
     pub_date: Optional[int]
 
 
+class RegionGroupData(GroupData):
+    geo: str
+
+
 class ScrapedGoogleTrendsNewsItem:
 
     def __init__(self, group: GroupData, title: str, url: str, date: Optional[datetime.datetime]):
@@ -39,6 +38,7 @@ class ScrapedGoogleTrendsNewsItem:
         self.source: Optional[str] = None
         self.picture: Optional[str] = None
         self.picture_source: Optional[str] = None
+        self.regions: Optional[list[RegionGroupData]] = None
 
 
 class DataCollectorClearData(TypedDict):
@@ -51,6 +51,7 @@ class DataCollectorClearData(TypedDict):
     picture_source: Optional[str]
     # thumbnail: Optional[str]
     group: GroupData
+    regions: Optional[list[RegionGroupData]]
 
 
 class DataCollectorGoogleTrendsNewsItem(DataCollectorItem):
@@ -67,7 +68,7 @@ class DataCollectorGoogleTrendsNewsItem(DataCollectorItem):
         return binascii.hexlify(digest_value).decode('utf-8')
 
     def produce_data(self) -> DataCollectorClearData:
-        return {
+        data: DataCollectorClearData = {
             'title': self.scraped_item.title,
             'snippet': None,  # self.scraped_item.snippet
             'url': self.scraped_item.url,
@@ -78,19 +79,22 @@ class DataCollectorGoogleTrendsNewsItem(DataCollectorItem):
             # 'thumbnail': None,
             'group': self.scraped_item.group,
         }
+        if self.scraped_item.regions is not None:
+            data['regions'] = self.scraped_item.regions
+        return data
 
 
-class GoogleTrendsScraper(WebScraper):
+class GoogleTrendsScraper(DataItemScraper):
 
     def __init__(self, context: WebScraperContext, feed: FeedParametersType, semaphore: asyncio.BoundedSemaphore):
         super().__init__(context, feed, semaphore)
         self.__logger = logging.getLogger(f'{__name__}.{self.__class__.__name__}')
 
     async def process(self, input_file: tempfile.TemporaryFile, output_file: tempfile.TemporaryFile()):
-        parsed_content = await self.__extract_content(input_file)
-        await self.__process_content(parsed_content)
+        parsed_content = await self._extract_content(input_file)
+        await self._process_content(parsed_content)
 
-    async def __extract_content(self, temp_file: tempfile.TemporaryFile) -> list[DataCollectorGoogleTrendsNewsItem]:
+    async def _extract_content(self, temp_file: tempfile.TemporaryFile) -> list[DataCollectorGoogleTrendsNewsItem]:
         parsed_content: ET = ET.parse(temp_file)
 
         ns_ht = 'https://trends.google.com/trending/rss'
@@ -151,98 +155,6 @@ class GoogleTrendsScraper(WebScraper):
 
         return scraped_items_list
 
-    async def __process_content(self, data: list[DataCollectorGoogleTrendsNewsItem]):
-        # Generate ids to check which have already been produced
-        data_ids = [d.get_data_id() for d in data]
-        producer = await self._context.get_producer()
-        response = await producer.request({"feed_id": self.feed_id, "data_ids": data_ids}, "DataCollector", "checkExistingDataIds", exchange=Constantes.SECURITE_PUBLIC)
-        missing_ids = set(response.parsed['missing_ids'])
-
-        # Filter out existing ids
-        data = [d for d in data if d.get_data_id() in missing_ids]
-
-        if len(data) == 0:
-            self.__logger.debug("No changes to content since last scrape")
-            # Nothing to do
-            return
-
-        self.__logger.debug("Processing %d new items" % len(data))
-
-        if self._encryption_key_submitted is False and self._key_command is None:
-            idmg = self._context.ca.idmg
-            fiche_response = await producer.request({'idmg': idmg}, 'CoreTopologie', 'ficheMillegrille', exchange=Constantes.SECURITE_PUBLIC)
-            encryption_keys = fiche_response.parsed['chiffrage']
-            certs = [EnveloppeCertificat.from_pem('\n'.join(c)) for c in encryption_keys]
-            encrypted_keys = self._encryption_key.produce_keymaster_content(certs)
-            key_command, _message_id = self._context.formatteur.signer_message(
-                Constantes.KIND_COMMANDE, encrypted_keys, 'MaitreDesCles', action='ajouterCleDomaines')
-            self._key_command = key_command
-
-        # Get thumbnails for all remaining items
-        thumbnail_urls = set([d.scraped_item.picture for d in data])
-        thumbnail_dict: dict[str, AttachedFile] = dict()
-        async with aiohttp.ClientSession() as session:
-            for thumbnail_url in thumbnail_urls:
-                async with session.get(thumbnail_url) as response:
-                    if response.status == 200:
-                        content_bytes = await response.content.read()
-                        # content_base64 = binascii.b2a_base64(content_bytes, newline=False)
-                        # content_base64 = content_base64.decode('utf-8').replace('=', '')
-                        # thumbnail_dict[thumbnail_url] = content_base64
-                    else:
-                        self.__logger.warning("Error loading thumbnail (%s) at %s" % (response.status, thumbnail_url))
-                        await asyncio.sleep(0.5)
-                        continue
-
-                content_bytes_io = BytesIO(content_bytes)
-                thumbnail_result: AttachedFile = await self._context.file_handler.encrypt_upload_file(self._encryption_key.secret_key, content_bytes_io)
-                thumbnail_result['cle_id'] = self._encryption_key.key_id
-                thumbnail_dict[thumbnail_url] = thumbnail_result
-
-        # Encrypt content and produce DataCollector item
-        for item in data:
-            item_data = item.produce_data()
-
-            encrypted_data = chiffrer_document(self._encryption_key.secret_key, self._encryption_key.key_id, item_data)
-            # Rename the data_chiffre field to new standard ciphertext_base64
-            encrypted_data['ciphertext_base64'] = encrypted_data['data_chiffre']
-            del encrypted_data['data_chiffre']
-            data_collector_dict: DataCollectorDict = {
-                'data_id': item.get_data_id(),
-                'feed_id': self.feed_id,
-                'pub_date': item_data['pub_date'],
-                'encrypted_data': encrypted_data,
-            }
-
-            # Inject thumbnail if present
-            picture_url = item_data['picture_url']
-            thumbnail = thumbnail_dict.get(picture_url)
-            if thumbnail:
-                cle_id: str = thumbnail['cle_id'] or self._encryption_key.key_id
-                data_collector_dict['files'] = [
-                    {
-                        'fuuid': thumbnail['fuuid'],
-                        'decryption': {'cle_id': cle_id, 'nonce': thumbnail['nonce'], 'format': thumbnail['format']}
-                    }
-                ]
-
-            # Emit item for saving in the DataCollector domain
-            attachments: Optional[dict[str, dict]] = None
-            if self._key_command:
-                attachments = {'key': self._key_command}
-
-            response = await producer.command(data_collector_dict, "DataCollector", "saveDataItem",
-                                              exchange=Constantes.SECURITE_PUBLIC, attachments=attachments)
-
-            if self._encryption_key_submitted is False and response.parsed['ok'] is True:
-                # Key saved successfully
-                self._key_command = None
-                self._encryption_key_submitted = True
-
-            pass
-
-        pass
-
 
 def parse_date(date_str: str) -> datetime.datetime:
     return datetime.datetime.strptime(date_str, '%a, %d %b %Y %H:%M:%S %z')
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import re
+
+from collections import OrderedDict
+from typing import Optional
+from urllib.parse import urljoin
+
+try:
+    from lxml import etree, html
+    from lxml.cssselect import CSSSelector
+except ImportError:
+    etree = None
+    html = None
+    CSSSelector = None
+
+MAX_CACHED_RULES = 256
+URL_FIELDS = {'url', 'picture_url'}
+CSS_ATTRIBUTE = re.compile(r'^(.*?)\s*@([A-Za-z_][\w:.-]*)$')
+
+# Compiled rules by version (digest of the rules), shared by the feeds using the same rules
+_compiled_rules: OrderedDict[str, 'CompiledRules'] = OrderedDict()
+
+
+def is_available() -> bool:
+    return etree is not None
+
+
+class CompiledSelector:
+    """
+    Selector of an extraction rule. CSS by default, with an optional @attribute suffix (e.g. "a.link@href").
+    The prefix "xpath:" uses an XPath expression relative to the item (e.g. "xpath:.//time/@datetime").
+    """
+
+    def __init__(self, selector: str):
+        self.selector = selector
+        self.attribute: Optional[str] = None
+        if selector.startswith('xpath:'):
+            self.xpath = etree.XPath(selector[len('xpath:'):])
+        else:
+            css = selector[len('css:'):] if selector.startswith('css:') else selector
+            match = CSS_ATTRIBUTE.match(css)
+            if match is not None:
+                css, self.attribute = match.group(1), match.group(2)
+            self.xpath = CSSSelector(css) if css else None
+
+    def elements(self, element) -> list:
+        if self.xpath is None:
+            return [element]  # Attribute of the element itself, e.g. "@href"
+        result = self.xpath(element)
+        if isinstance(result, list):
+            return result
+        return [result]
+
+    def first_value(self, element) -> Optional[str]:
+        for result in self.elements(element):
+            value = _value(result, self.attribute)
+            if value:
+                return value
+        return None
+
+
+class CompiledRules:
+    """
+    Extraction rules from the feed information:
+    {"items": "article.story", "fields": {"title": "h2", "url": "a@href", "date": "time@datetime"}, "id": ["url"]}
+    Fields url and picture_url are made absolute. The id fields identify an item (default: url, then title).
+    """
+
+    def __init__(self, rules: dict, version: str):
+        self.version = version
+        items = rules.get('items')
+        if not items:
+            raise ValueError('Extraction rules require an items selector')
+        fields = rules.get('fields')
+        if not fields:
+            raise ValueError('Extraction rules require fields')
+        self.items = CompiledSelector(items)
+        self.fields: dict[str, CompiledSelector] = {name: CompiledSelector(s) for name, s in fields.items()}
+        self.id_fields: list[str] = rules.get('id') or [f for f in ('url', 'title') if f in self.fields]
+        if len(self.id_fields) == 0:
+            raise ValueError('Extraction rules require id fields')
+
+
+def rules_version(rules: dict) -> str:
+    return hashlib.blake2s(json.dumps(rules, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def compile_rules(rules: dict) -> CompiledRules:
+    """
+    :return: Compiled rules, from the cache when the same rules (version) were already compiled
+    """
+    if etree is None:
+        raise ImportError('lxml and cssselect are required for html extraction')
+
+    version = rules_version(rules)
+    compiled = _compiled_rules.get(version)
+    if compiled is not None:
+        _compiled_rules.move_to_end(version)
+        return compiled
+
+    compiled = CompiledRules(rules, version)
+    _compiled_rules[version] = compiled
+    while len(_compiled_rules) > MAX_CACHED_RULES:
+        _compiled_rules.popitem(last=False)
+    return compiled
+
+
+def extract_items(content: bytes, rules: CompiledRules, base_url: str) -> list[dict[str, Optional[str]]]:
+    """
+    Parses a html document and extracts the fields of each item. Blocking, run in a thread.
+    :return: Fields of each item in document order
+    """
+    if len(content.strip()) == 0:
+        return list()
+    document = html.document_fromstring(content)
+    items = list()
+    for element in rules.items.elements(document):
+        values = dict()
+        for name, selector in rules.fields.items():
+            value = selector.first_value(element)
+            if value is not None and name in URL_FIELDS:
+                value = urljoin(base_url, value)
+            values[name] = value
+        items.append(values)
+    return items
+
+
+def _value(result, attribute: Optional[str]) -> Optional[str]:
+    if isinstance(result, str):
+        value = str(result)  # XPath string results (attributes, text())
+    elif attribute is not None:
+        value = result.get(attribute)
+    elif hasattr(result, 'text_content'):
+        value = result.text_content()
+    else:
+        return None
+    if value is None:
+        return None
+    return ' '.join(value.split()) or None
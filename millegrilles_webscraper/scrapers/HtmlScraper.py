@@ -1,30 +1,109 @@
 import asyncio
+import binascii
 import datetime
-import feedparser
+import json
 import logging
+import math
+import os
+import tempfile
 
-from typing import Optional
+from typing import Optional, TypedDict
+from urllib.parse import urlparse
 
+from millegrilles_messages.messages.Hachage import hacher_to_digest
 from millegrilles_webscraper.Context import WebScraperContext
-from millegrilles_webscraper.scrapers.WebScraper import WebScraper
+from millegrilles_webscraper.DataCollectorItem import DataCollectorItem
+from millegrilles_webscraper.scrapers.DataItemScraper import DataItemScraper
+from millegrilles_webscraper.scrapers.HtmlExtraction import CompiledRules, compile_rules, extract_items
+from millegrilles_webscraper.scrapers.RssScraper import parse_feed_date
+from millegrilles_webscraper.scrapers.WebScraper import FeedParametersType
 
+PARSE_BUFFER_FACTOR = 10  # Memory reserved for the parsed document tree, relative to the document size
 
-class HtmlScraper(WebScraper):
+# Fields mapped to the item data, the other extracted fields are kept under 'fields'
+ITEM_FIELDS = {'title', 'snippet', 'url', 'date', 'author', 'picture_url'}
 
-    def __init__(self, context: WebScraperContext, url: str, semaphore: asyncio.BoundedSemaphore, refresh_rate: Optional[datetime.timedelta] = None):
-        super().__init__(context, url, semaphore, refresh_rate)
+
+class DataCollectorHtmlClearData(TypedDict):
+    title: Optional[str]
+    snippet: Optional[str]
+    url: Optional[str]
+    pub_date: int
+    item_source: Optional[str]
+    author: Optional[str]
+    picture_url: Optional[str]
+    picture_source: Optional[str]
+    fields: dict[str, Optional[str]]
+
+
+class DataCollectorHtmlItem(DataCollectorItem):
+
+    def __init__(self, feed_id: str, values: dict[str, Optional[str]], id_fields: list[str], page_url: str,
+                 scrape_date: datetime.datetime):
+        super().__init__(feed_id)
+        self.values = values
+        self.__id_fields = id_fields
+        self.__page_url = page_url
+        self.__scrape_date = scrape_date
+
+    def _produce_data_id(self):
+        items_str = json.dumps([self.values.get(f) for f in self.__id_fields])
+        digest_value = hacher_to_digest(items_str, 'blake2s-256')
+        return binascii.hexlify(digest_value).decode('utf-8')
+
+    def produce_data(self) -> DataCollectorHtmlClearData:
+        values = self.values
+        date = parse_feed_date(values.get('date')) or self.__scrape_date
+        source = urlparse(values.get('url') or self.__page_url).netloc
+        picture_url = values.get('picture_url')
+        return {
+            'title': values.get('title'),
+            'snippet': values.get('snippet'),
+            'url': values.get('url'),
+            'pub_date': math.floor(date.timestamp()),
+            'item_source': source,
+            'author': values.get('author'),
+            'picture_url': picture_url,
+            'picture_source': source if picture_url else None,
+            'fields': {k: v for k, v in values.items() if k not in ITEM_FIELDS},
+        }
+
+
+class HtmlScraper(DataItemScraper):
+    """
+    Extracts items from a html page with declarative rules, each item is saved separately.
+
+    Feed information: url, extraction (see HtmlExtraction.CompiledRules), e.g.
+    {"items": "article.story", "fields": {"title": "h2", "url": "a@href", "date": "time@datetime"}}
+    The rules are compiled when the feed is updated and shared by the feeds with the same rules.
+    """
+
+    def __init__(self, context: WebScraperContext, feed: FeedParametersType, semaphore: asyncio.BoundedSemaphore):
         self.__logger = logging.getLogger(f'{__name__}.{self.__class__.__name__}')
+        # Define variables filled by update() before super() call
+        self.__rules: Optional[CompiledRules] = None
+        super().__init__(context, feed, semaphore)
 
-    async def scrape(self):
-        self.__logger.debug(f"Scraping {self.url}")
-        result = await asyncio.to_thread(feedparser.parse, self.url, etag=self.etag, modified=self.last_update)
-        print("Result\n%s" % result)
+    def update(self, parameters: FeedParametersType):
+        super().update(parameters)
+        rules = parameters['decrypted_feed_information'].get('extraction')
+        if rules is None:
+            raise ValueError('Feed %s has no extraction rules' % parameters['feed_id'])
+        self.__rules = compile_rules(rules)
 
-        pass
+    async def process(self, input_file: tempfile.TemporaryFile, output_file: tempfile.TemporaryFile()):
+        rules = self.__rules
+        input_size = os.fstat(input_file.fileno()).st_size
+        async with self._context.memory_budget.reserve(input_size * PARSE_BUFFER_FACTOR):
+            with self._context.metrics.span('parse') as span:
+                span.bytes = input_size
+                content = await self._context.io_executor.run(input_file.read)
+                extracted = await self._context.cpu_executor.run(extract_items, content, rules, self.url)
+            del content
 
-    async def generate_pdf(self):
-        # chromium --headless --disable-gpu --run-all-compositor-stages-before-draw
-        # --virtual-time-budget=10000
-        # --print-to-pdf="article_X.pdf"
-        # https://www.theglobeandmail.com/business/article-td-bank-posts-lower-profit-beats-estimates-with-loan-loss-provisions/
-        pass
\ No newline at end of file
+        scrape_date = datetime.datetime.now(tz=datetime.timezone.utc)
+        items = [DataCollectorHtmlItem(self.feed_id, v, rules.id_fields, self.url, scrape_date) for v in extracted
+                 if any(v.get(f) for f in rules.id_fields)]
+        self.__logger.debug("Extracted %d items from %s" % (len(items), self.url))
+        if len(items) > 0:
+            await self._process_content(items)
@@ -0,0 +1,129 @@
+import json
+import os
+import struct
+import tempfile
+
+from typing import Optional
+
+from millegrilles_messages.messages.Hachage import Hacheur
+from millegrilles_webscraper.DataStructures import PackReference
+
+CHUNK_SIZE = 64 * 1024
+
+PACK_MAGIC = b'MGPK'
+PACK_VERSION = 1
+PACK_HEADER = PACK_MAGIC + bytes([PACK_VERSION])
+# Footer: offset of the index (8 bytes), length of the index (4 bytes), magic (4 bytes)
+PACK_FOOTER = struct.Struct('>QI4s')
+
+
+class PackWriter:
+    """
+    Pack file: small encrypted files concatenated in a single filehost object.
+
+    Layout: header (MGPK, version), members, index (json list of {fuuid, offset, size}), footer. Each member is
+    encrypted separately, with its own nonce, and can be read with a range request using its offset and size.
+    The pack fuuid is the blake2b-512 digest of the whole pack, like the other filehost objects.
+    """
+
+    def __init__(self):
+        self.__file = tempfile.TemporaryFile()
+        self.__file.write(PACK_HEADER)
+        self.__members: list[dict] = list()
+
+    def __len__(self):
+        return len(self.__members)
+
+    @property
+    def size(self) -> int:
+        return self.__file.tell()
+
+    def add(self, fuuid: str, src) -> dict:
+        """
+        Appends an encrypted file.
+        :param fuuid: Fuuid of the encrypted file
+        :param src: Encrypted content, read to the end
+        :return: Index entry of the member
+        """
+        offset = self.__file.tell()
+        while True:
+            chunk = src.read(CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+            self.__file.write(chunk)
+        member = {'fuuid': fuuid, 'offset': offset, 'size': self.__file.tell() - offset}
+        self.__members.append(member)
+        return member
+
+    def finish(self) -> tuple[str, int]:
+        """
+        Writes the index and footer.
+        :return: Pack fuuid and size. The pack file is positioned at the start for the upload.
+        """
+        index_offset = self.__file.tell()
+        index = json.dumps(self.__members).encode('utf-8')
+        self.__file.write(index)
+        self.__file.write(PACK_FOOTER.pack(index_offset, len(index), PACK_MAGIC))
+        pack_size = self.__file.tell()
+
+        self.__file.seek(0)
+        digester = Hacheur('blake2b-512', 'base58btc')
+        while True:
+            chunk = self.__file.read(CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+            digester.update(chunk)
+        self.__file.seek(0)
+
+        return digester.finalize(), pack_size
+
+    @property
+    def file(self):
+        return self.__file
+
+    def close(self):
+        self.__file.close()
+
+
+def read_pack_index(fp) -> list[dict]:
+    """
+    :param fp: Seekable pack file
+    :return: Index entries ({fuuid, offset, size}) of the members
+    :raises ValueError: Not a pack file
+    """
+    pack_size = fp.seek(0, os.SEEK_END)
+    if pack_size < len(PACK_HEADER) + PACK_FOOTER.size:
+        raise ValueError('Pack file too small')
+    fp.seek(pack_size - PACK_FOOTER.size)
+    index_offset, index_size, magic = PACK_FOOTER.unpack(fp.read(PACK_FOOTER.size))
+    if magic != PACK_MAGIC or index_offset + index_size + PACK_FOOTER.size != pack_size:
+        raise ValueError('Invalid pack footer')
+    fp.seek(index_offset)
+    return json.loads(fp.read(index_size))
+
+
+def read_pack_member(fp, reference: PackReference) -> bytes:
+    """
+    :param fp: Seekable pack file
+    :param reference: Location of the member
+    :return: Encrypted content of the member
+    """
+    fp.seek(reference['offset'])
+    content = fp.read(reference['size'])
+    if len(content) != reference['size']:
+        raise ValueError('Pack member truncated')
+    return content
+
+
+def pack_range_header(reference: PackReference) -> dict:
+    """ :return: Request headers to fetch only the member from the filehost """
+    start = reference['offset']
+    return {'Range': 'bytes=%d-%d' % (start, start + reference['size'] - 1)}
+
+
+def stored_fuuid(attached_file: dict) -> str:
+    """ :return: Fuuid of the filehost object holding the file, the pack for members of a pack """
+    reference: Optional[PackReference] = attached_file.get('pack')
+    if reference is not None:
+        return reference['fuuid']
+    return attached_file['fuuid']
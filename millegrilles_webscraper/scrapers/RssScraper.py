@@ -0,0 +1,212 @@
+import asyncio
+import binascii
+import datetime
+import email.utils
+import json
+import logging
+import math
+import tempfile
+
+from typing import Optional, TypedDict
+
+from xml.etree import ElementTree as ET
+
+from millegrilles_messages.messages.Hachage import hacher_to_digest
+from millegrilles_webscraper.Context import WebScraperContext
+from millegrilles_webscraper.DataCollectorItem import DataCollectorItem
+from millegrilles_webscraper.scrapers.DataItemScraper import DataItemScraper
+from millegrilles_webscraper.scrapers.WebScraper import FeedParametersType
+
+NS_ATOM = 'http://www.w3.org/2005/Atom'
+NS_RSS1 = 'http://purl.org/rss/1.0/'
+NS_MEDIA = 'http://search.yahoo.com/mrss/'
+NS_DC = 'http://purl.org/dc/elements/1.1/'
+NS_CONTENT = 'http://purl.org/rss/1.0/modules/content/'
+
+ITEM_TAGS = {'item', '{%s}item' % NS_RSS1, '{%s}entry' % NS_ATOM}
+CHANNEL_TITLE_TAGS = {'title', '{%s}title' % NS_RSS1, '{%s}title' % NS_ATOM}
+
+
+class ScrapedRssItem:
+
+    def __init__(self):
+        self.guid: Optional[str] = None
+        self.title: Optional[str] = None
+        self.url: Optional[str] = None
+        self.date: Optional[datetime.datetime] = None
+        self.summary: Optional[str] = None
+        self.author: Optional[str] = None
+        self.source: Optional[str] = None
+        self.picture: Optional[str] = None
+
+
+class DataCollectorRssClearData(TypedDict):
+    title: Optional[str]
+    snippet: Optional[str]
+    url: Optional[str]
+    pub_date: int
+    item_source: Optional[str]
+    author: Optional[str]
+    picture_url: Optional[str]
+    picture_source: Optional[str]
+
+
+class DataCollectorRssItem(DataCollectorItem):
+
+    def __init__(self, feed_id: str, scraped_item: ScrapedRssItem, scrape_date: datetime.datetime):
+        super().__init__(feed_id)
+        self.scraped_item = scraped_item
+        self.__scrape_date = scrape_date
+
+    def _produce_data_id(self):
+        # The guid identifies the item, the date changes when the item is updated by the publisher
+        item = self.scraped_item
+        timestamp = math.floor(item.date.timestamp()) if item.date else None
+        items = [item.guid or item.url or item.title, timestamp]
+        items_str = json.dumps(items)
+        digest_value = hacher_to_digest(items_str, 'blake2s-256')
+        return binascii.hexlify(digest_value).decode('utf-8')
+
+    def produce_data(self) -> DataCollectorRssClearData:
+        item = self.scraped_item
+        date = item.date or self.__scrape_date
+        return {
+            'title': item.title,
+            'snippet': item.summary,
+            'url': item.url,
+            'pub_date': math.floor(date.timestamp()),
+            'item_source': item.source,
+            'author': item.author,
+            'picture_url': item.picture,
+            'picture_source': item.source if item.picture else None,
+        }
+
+
+class RssScraper(DataItemScraper):
+    """
+    RSS 2.0, RSS 1.0 and Atom feeds. Each item is saved separately, items already known to DataCollector are
+    skipped. The document is parsed incrementally, items are released once extracted.
+    """
+
+    def __init__(self, context: WebScraperContext, feed: FeedParametersType, semaphore: asyncio.BoundedSemaphore):
+        super().__init__(context, feed, semaphore)
+        self.__logger = logging.getLogger(f'{__name__}.{self.__class__.__name__}')
+
+    async def process(self, input_file: tempfile.TemporaryFile, output_file: tempfile.TemporaryFile()):
+        with self._context.metrics.span('parse'):
+            scraped_items = await self._context.cpu_executor.run(parse_feed, input_file)
+
+        scrape_date = datetime.datetime.now(tz=datetime.timezone.utc)
+        items = [DataCollectorRssItem(self.feed_id, i, scrape_date) for i in scraped_items
+                 if i.guid or i.url or i.title]
+        self.__logger.debug("Parsed %d items from %s" % (len(items), self.url))
+        if len(items) > 0:
+            await self._process_content(items)
+
+
+def parse_feed(fp) -> list[ScrapedRssItem]:
+    """
+    Parses a RSS or Atom document. Blocking, run in a thread.
+    :param fp: File with the document
+    :return: Items in document order
+    """
+    items: list[ScrapedRssItem] = list()
+    channel_title: Optional[str] = None
+    depth = 0
+    item_depth: Optional[int] = None
+
+    for event, element in ET.iterparse(fp, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            if item_depth is None and element.tag in ITEM_TAGS:
+                item_depth = depth
+            continue
+
+        depth -= 1
+        if item_depth is not None:
+            if depth + 1 == item_depth:
+                # End of the item element, extract and release it
+                item = _parse_item(element)
+                item.source = channel_title
+                items.append(item)
+                element.clear()
+                item_depth = None
+        elif channel_title is None and element.tag in CHANNEL_TITLE_TAGS and depth <= 2:
+            # Title of the rss channel (depth 2) or atom feed (depth 1)
+            channel_title = _text(element)
+
+    return items
+
+
+def _parse_item(element: ET.Element) -> ScrapedRssItem:
+    item = ScrapedRssItem()
+    for child in element:
+        tag = child.tag
+        if tag.startswith('{%s}' % NS_RSS1):
+            tag = tag[len(NS_RSS1) + 2:]
+
+        if tag in ('title', '{%s}title' % NS_ATOM):
+            item.title = _text(child)
+        elif tag in ('guid', '{%s}id' % NS_ATOM):
+            item.guid = _text(child)
+        elif tag == 'link':
+            item.url = _text(child)
+        elif tag == '{%s}link' % NS_ATOM:
+            rel = child.get('rel', 'alternate')
+            if rel == 'alternate' and item.url is None:
+                item.url = child.get('href')
+            elif rel == 'enclosure' and _is_image(child.get('type')) and item.picture is None:
+                item.picture = child.get('href')
+        elif tag in ('pubDate', '{%s}date' % NS_DC):
+            item.date = item.date or parse_feed_date(_text(child))
+        elif tag in ('{%s}published' % NS_ATOM, '{%s}updated' % NS_ATOM):
+            # Keep the publication date when both are present
+            date = parse_feed_date(_text(child))
+            if date is not None and (item.date is None or tag == '{%s}published' % NS_ATOM):
+                item.date = date
+        elif tag in ('description', '{%s}summary' % NS_ATOM):
+            item.summary = _text(child)
+        elif tag in ('{%s}encoded' % NS_CONTENT, '{%s}content' % NS_ATOM):
+            item.summary = item.summary or _text(child)
+        elif tag in ('author', '{%s}creator' % NS_DC):
+            item.author = _text(child)
+        elif tag == '{%s}author' % NS_ATOM:
+            item.author = _text(child.find('{%s}name' % NS_ATOM))
+        elif tag == '{%s}thumbnail' % NS_MEDIA:
+            item.picture = item.picture or child.get('url')
+        elif tag in ('{%s}content' % NS_MEDIA, 'enclosure'):
+            if child.get('medium') == 'image' or _is_image(child.get('type')):
+                item.picture = item.picture or child.get('url')
+        elif tag == '{%s}group' % NS_MEDIA:
+            thumbnail = child.find('{%s}thumbnail' % NS_MEDIA)
+            if thumbnail is not None:
+                item.picture = item.picture or thumbnail.get('url')
+    return item
+
+
+def _text(element: Optional[ET.Element]) -> Optional[str]:
+    if element is None or element.text is None:
+        return None
+    return element.text.strip() or None
+
+
+def _is_image(mimetype: Optional[str]) -> bool:
+    return mimetype is not None and mimetype.startswith('image/')
+
+
+def parse_feed_date(value: Optional[str]) -> Optional[datetime.datetime]:
+    """
+    Parses RFC 822 (RSS) and ISO 8601 (Atom, Dublin Core) dates.
+    """
+    if value is None:
+        return None
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        try:
+            date = datetime.datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date
@@ -0,0 +1,91 @@
+import logging
+
+from io import BytesIO
+from typing import Optional
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+LOGGER = logging.getLogger(__name__)
+
+SUPPORTED_FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG'}
+MAX_PIXELS = 16_000_000  # Larger images are not decoded, a small compressed file can hold a huge image
+DECODED_BYTES_PER_PIXEL = 4
+HEADER_READ_SIZE = 256 * 1024  # Bytes read to find the dimensions of an image, metadata included
+
+
+def is_available() -> bool:
+    return Image is not None
+
+
+def image_pixels(fp) -> Optional[int]:
+    """
+    Reads the dimensions of an image from its header, the pixels are not decoded. Blocking, run in an executor.
+    :param fp: File handle positioned at the start of the image, restored on return
+    :return: Number of pixels, None when the content is not a supported image or its header was not found
+    """
+    if Image is None:
+        raise ImportError('Pillow is required to read images')
+    position = fp.tell()
+    try:
+        header = fp.read(HEADER_READ_SIZE)
+    finally:
+        fp.seek(position)
+    try:
+        with Image.open(BytesIO(header)) as image:
+            width, height = image.size
+            return width * height
+    except Exception:
+        return None
+
+
+def downscale_image(content: bytes, max_dimension: int, quality: int, image_format: str = 'webp') -> Optional[bytes]:
+    """
+    Resizes an image to fit in max_dimension and re-encodes it. Blocking, run in an executor.
+    :param content: Original image bytes
+    :param max_dimension: Maximum width and height of the output
+    :param quality: Encoder quality (1-100)
+    :param image_format: Output format, webp or jpeg
+    :return: Re-encoded image, or None when the original should be kept (not an image, animated, more than
+             MAX_PIXELS or not smaller).
+    """
+    if Image is None:
+        raise ImportError('Pillow is required to downscale images')
+
+    pil_format = SUPPORTED_FORMATS.get(image_format)
+    if pil_format is None:
+        raise ValueError('Unsupported image format: %s' % image_format)
+
+    try:
+        image = Image.open(BytesIO(content))
+    except Exception:
+        LOGGER.debug("Content is not a supported image, keeping original")
+        return None
+
+    with image:
+        if getattr(image, 'is_animated', False):
+            return None  # Keep animations as-is
+        width, height = image.size
+        if width * height > MAX_PIXELS:
+            LOGGER.debug("Image of %dx%d pixels is too large to decode, keeping original" % (width, height))
+            return None
+
+        # Let the JPEG decoder skip pixels when the image is much larger than the target
+        image.draft('RGB', (max_dimension, max_dimension))
+        image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+
+        if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        elif image.mode not in ('RGB', 'RGBA', 'L'):
+            image = image.convert('RGBA')
+
+        output = BytesIO()
+        image.save(output, pil_format, quality=quality)
+
+    output_bytes = output.getvalue()
+    if len(output_bytes) >= len(content):
+        return None  # Original is smaller
+
+    return output_bytes
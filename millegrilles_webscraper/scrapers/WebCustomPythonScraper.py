@@ -1,6 +1,8 @@
 import asyncio
 import datetime
 import logging
+import os
+import pathlib
 import tempfile
 import pytz
 import json
@@ -10,31 +12,47 @@ from typing import Optional
 
 from millegrilles_messages.messages import Constantes
 from millegrilles_messages.chiffrage.Mgs4 import chiffrer_mgs4_bytes_secrete, chiffrer_document
-from millegrilles_messages.messages.EnveloppeCertificat import EnveloppeCertificat
 from millegrilles_messages.messages.Hachage import Hacheur, hacher, hacher_fichier
 from millegrilles_webscraper.Context import WebScraperContext
 from millegrilles_webscraper.DataStructures import DataCollectorTransaction, DataFeedFile, AttachedFile, \
-    CustomProcessOutput
+    CustomProcessOutput, DeltaReference
+from millegrilles_webscraper.scrapers.DeltaSnapshot import DELTA_FORMAT, SnapshotState, SnapshotStore, encode_delta
+from millegrilles_webscraper.scrapers.PackFile import stored_fuuid
 from millegrilles_webscraper.scrapers.WebScraper import WebScraper, FeedParametersType
 
 CHUNK_SIZE = 1024 * 64
 
+# Copies of the input held in memory at the peak of _generate_output_content: input bytes, ciphertext,
+# base64 ciphertext in the json output and the compressed output.
+OUTPUT_BUFFER_FACTOR = 5
+
+SNAPSHOT_DIRECTORY = 'snapshots'
+DEFAULT_KEYFRAME_INTERVAL = 24  # Versions of a delta chain, a full keyframe starts the next chain
+DELTA_MAX_RATIO = 0.5  # A delta larger than this fraction of the content is replaced by a keyframe
+DELTA_BUFFER_FACTOR = 6  # Memory held while encoding a delta (base, content, tokens), relative to the content size
+
 
 class WebCustomPythonScraper(WebScraper):
     """
     Web Scraper that loads the content of a feed and saves it to a filehost and the DataCollector domain.
     The input content is encrypted and saved in a JSON file, that file is uploaded. It's reference information is
     saved as a transaction in DataCollector.
+
+    Delta mode (feed information delta: true, keyframe_interval): the previous version is kept under dir_data and
+    the content is saved as a delta against it, with a full keyframe every keyframe_interval versions. The delta
+    reference of the DataFeedFile chains each version to its base, see DeltaSnapshot.rebuild_snapshot.
     """
 
     def __init__(self, context: WebScraperContext, feed: FeedParametersType, semaphore: asyncio.BoundedSemaphore):
         self.__logger = logging.getLogger(f'{__name__}.{self.__class__.__name__}')
         # Define variables filled by update() before super() call
         self.__processing_method: Optional = None
+        self.__delta = False
+        self.__keyframe_interval = DEFAULT_KEYFRAME_INTERVAL
 
         super().__init__(context, feed, semaphore)
 
-        pass
+        self.__snapshots = SnapshotStore(pathlib.Path(context.configuration.dir_data, SNAPSHOT_DIRECTORY), self.feed_id)
 
     def update(self, parameters: FeedParametersType):
         super().update(parameters)
@@ -51,10 +69,21 @@ class WebCustomPythonScraper(WebScraper):
             self.__processing_method = None
             raise e
 
+        info = parameters['decrypted_feed_information']
+        self.__delta = info.get('delta') is True
+        self.__keyframe_interval = max(1, int(info.get('keyframe_interval') or DEFAULT_KEYFRAME_INTERVAL))
+
     async def process(self, input_file: tempfile.TemporaryFile, output_file: tempfile.TemporaryFile):
         transaction = await self._parse_and_process_file(input_file)
         input_file.seek(0)  # Reposition input to beginning
 
+        snapshot_state: Optional[SnapshotState] = None
+        if self.__delta:
+            snapshot_state = await self._context.io_executor.run(self.__snapshots.load_state)
+            if snapshot_state is not None and snapshot_state['data_id'] == transaction['data_id']:
+                self.__logger.debug("Content of %s unchanged since the last version, skipping" % self.url)
+                return
+
         # Optional intermediate processing step
         attached_files: Optional[list[AttachedFile]] = None
         encrypted_files_map: Optional[dict] = None
@@ -64,7 +93,14 @@ class WebCustomPythonScraper(WebScraper):
             values = {}
             try:
                 exec(self.__processing_method, values)
-                output = await values['process'](self._context, self._encryption_key, input_file)
+                with self._context.metrics.span('custom_process'):
+                    # Small files uploaded by the custom code are grouped in pack files
+                    async with self._context.file_handler.pack() as pack_scope:
+                        output = await values['process'](self._context, self._encryption_key, input_file)
+                if output.files is not None:
+                    for f in output.files:
+                        if f.pack is None and f.fuuid in pack_scope.members:
+                            f.pack = pack_scope.members[f.fuuid]  # Member of a pack uploaded when the scope exited
                 transaction['pub_date_start'] = int(output.pub_date_start.timestamp() * 1000.0)
                 transaction['pub_date_end'] = int(output.pub_date_end.timestamp() * 1000.0)
 
@@ -87,8 +123,18 @@ class WebCustomPythonScraper(WebScraper):
                 self.__logger.exception("Error during custom process")
                 raise e
 
+        delta: Optional[DeltaReference] = None
+        delta_file: Optional[tempfile.TemporaryFile] = None
+        if self.__delta:
+            delta, delta_file = await self.__encode_delta(snapshot_state, input_file)
+
         # Generate the output content for the new DataCollector transaction and for filehost.
-        fuuid, file_size = await self._generate_output_content(transaction, input_file, output_file, attached_files, encrypted_files_map)
+        try:
+            fuuid, file_size = await self._generate_output_content(transaction, delta_file or input_file, output_file,
+                                                                   attached_files, encrypted_files_map, delta)
+        finally:
+            if delta_file is not None:
+                delta_file.close()
 
         # Upload output file to filehost
         output_file.seek(0)
@@ -100,28 +146,23 @@ class WebCustomPythonScraper(WebScraper):
 
         producer = await self._context.get_producer()
 
-        if self._encryption_key_submitted is False and self._key_command is None:
-            idmg = self._context.ca.idmg
-            fiche_response = await producer.request({'idmg': idmg}, 'CoreTopologie', 'ficheMillegrille', exchange=Constantes.SECURITE_PUBLIC)
-            encryption_keys = fiche_response.parsed['chiffrage']
-            certs = [EnveloppeCertificat.from_pem('\n'.join(c)) for c in encryption_keys]
-            encrypted_keys = self._encryption_key.produce_keymaster_content(certs)
-            key_command, _message_id = self._context.formatteur.signer_message(
-                Constantes.KIND_COMMANDE, encrypted_keys, 'MaitreDesCles', action='ajouterCleDomaines')
-            self._key_command = key_command
+        await self._prepare_key_command(producer)
 
         # Emit item for saving in the DataCollector domain
-        attachments: Optional[dict[str, dict]] = None
-        if self._key_command:
-            attachments = {'key': self._key_command}
-
+        attachments = self._key_attachments()
         response = await producer.command(transaction, "DataCollector", "saveDataItemV2",
                                           exchange=Constantes.SECURITE_PUBLIC, attachments=attachments)
-
-        if self._encryption_key_submitted is False and response.parsed['ok'] is True:
-            # Key saved successfully
-            self._key_command = None
-            self._encryption_key_submitted = True
+        self._key_save_response(response)
+
+        if self.__delta and response.parsed.get('ok') is True:
+            # The saved version is the base of the next delta
+            state: SnapshotState = {
+                'data_id': transaction['data_id'],
+                'fuuid': fuuid,
+                'keyframe_fuuid': delta['keyframe_fuuid'] if delta is not None else fuuid,
+                'sequence': delta['sequence'] if delta is not None else 0,
+            }
+            await self._context.io_executor.run(self.__snapshots.save, state, input_file)
 
         if output is not None and output.files is not None and len(output.files) > 0:
             # Save a list of attached file references in volatile DB storage to allow reusing them instead of saving
@@ -135,6 +176,7 @@ class WebCustomPythonScraper(WebScraper):
                     "cle_id": f.cle_id,
                     "nonce": f.nonce,
                     "compression": f.compression,
+                    "pack": f.pack,
                 })
 
             files_command = {"files": file_correlations}
@@ -147,19 +189,60 @@ class WebCustomPythonScraper(WebScraper):
             else:
                 self.__logger.error("Error saving data file: %s" % response.parsed)
 
+    async def __encode_delta(self, snapshot_state: Optional[SnapshotState], input_file: tempfile.TemporaryFile) \
+            -> tuple[Optional[DeltaReference], Optional[tempfile.TemporaryFile]]:
+        """
+        The snapshot and the input are only loaded in memory while the delta is encoded.
+        :return: Delta reference and file with the delta against the snapshot, (None, None) for a keyframe
+        """
+        if snapshot_state is None or snapshot_state['sequence'] + 1 >= self.__keyframe_interval:
+            return None, None
+
+        input_size = os.fstat(input_file.fileno()).st_size
+        async with self._context.memory_budget.reserve(input_size * DELTA_BUFFER_FACTOR):
+            snapshot_content = await self._context.io_executor.run(self.__snapshots.load_content)
+            if snapshot_content is None:
+                return None, None
+            input_file.seek(0)
+            content = await self._context.io_executor.run(input_file.read)
+            input_file.seek(0)
+            with self._context.metrics.span('delta') as span:
+                span.bytes = len(content)
+                delta_bytes = await self._context.cpu_executor.run(encode_delta, snapshot_content, content)
+            del snapshot_content, content  # Release memory
+
+        if len(delta_bytes) > input_size * DELTA_MAX_RATIO:
+            self.__logger.debug("Delta of %s too large (%d of %d bytes), saving a keyframe" %
+                                (self.url, len(delta_bytes), input_size))
+            return None, None
+
+        delta_file = tempfile.TemporaryFile()
+        await self._context.io_executor.run(delta_file.write, delta_bytes)
+        delta_file.seek(0)
+        delta: DeltaReference = {
+            'format': DELTA_FORMAT,
+            'base_fuuid': snapshot_state['fuuid'],
+            'keyframe_fuuid': snapshot_state['keyframe_fuuid'],
+            'sequence': snapshot_state['sequence'] + 1,
+        }
+        return delta, delta_file
+
     async def _parse_and_process_file(self, input_file: tempfile.TemporaryFile) -> DataCollectorTransaction:
         """
         This is the main processing step.
         :param input_file:
         :return:
         """
-        digester = Hacheur('blake2s-256', 'base64')
-        while True:
-            chunk = await asyncio.to_thread(input_file.read, CHUNK_SIZE)
-            if not chunk:
-                break
-            digester.update(chunk)
-        data_digest = digester.finalize()[1:]  # Remove multibase char
+        with self._context.metrics.span('hash') as span:
+            span.bytes = 0
+            digester = Hacheur('blake2s-256', 'base64')
+            while True:
+                chunk = await self._context.io_executor.run(input_file.read, CHUNK_SIZE)
+                if not chunk:
+                    break
+                digester.update(chunk)
+                span.bytes += len(chunk)
+            data_digest = digester.finalize()[1:]  # Remove multibase char
         input_file.seek(0)
 
         now = datetime.datetime.now(tz=pytz.UTC)
@@ -181,13 +264,31 @@ class WebCustomPythonScraper(WebScraper):
 
     async def _generate_output_content(self, transaction: DataCollectorTransaction, input_file: tempfile.TemporaryFile,
                                        output_file: tempfile.TemporaryFile, attached_files: Optional[list[AttachedFile]] = None,
-                                       encrypted_files_map: Optional[dict] = None) -> (str, int):
+                                       encrypted_files_map: Optional[dict] = None,
+                                       delta: Optional[DeltaReference] = None) -> (str, int):
+        """
+        :param input_file: Content to encrypt, the delta when delta is provided
+        :param delta: Reference to the base of the delta
+        """
+        # Reserve the memory needed to buffer the content until it is written to the output file
+        input_size = os.fstat(input_file.fileno()).st_size
+        async with self._context.memory_budget.reserve(input_size * OUTPUT_BUFFER_FACTOR):
+            return await self.__generate_output_content(transaction, input_file, output_file, attached_files,
+                                                        encrypted_files_map, delta)
+
+    async def __generate_output_content(self, transaction: DataCollectorTransaction, input_file: tempfile.TemporaryFile,
+                                        output_file: tempfile.TemporaryFile, attached_files: Optional[list[AttachedFile]] = None,
+                                        encrypted_files_map: Optional[dict] = None,
+                                        delta: Optional[DeltaReference] = None) -> (str, int):
 
         # Encrypt the input data
-        input_file_bytes: Optional[bytes] = await asyncio.to_thread(input_file.read)
+        input_file_bytes: Optional[bytes] = await self._context.io_executor.run(input_file.read)
         input_file.seek(0)
 
-        cipher, cipher_info = await asyncio.to_thread(chiffrer_mgs4_bytes_secrete, self._encryption_key.secret_key, input_file_bytes)
+        with self._context.metrics.span('encrypt') as span:
+            span.bytes = len(input_file_bytes)
+            cipher, cipher_info = await self._context.cpu_executor.run(chiffrer_mgs4_bytes_secrete,
+                                                                       self._encryption_key.secret_key, input_file_bytes)
         del input_file_bytes  # Release memory
         cipher_info['cle_id'] = self._encryption_key.key_id
 
@@ -201,6 +302,8 @@ class WebCustomPythonScraper(WebScraper):
             "files": attached_files,
             "encrypted_files_map": encrypted_files_map,
         }
+        if delta is not None:
+            data_feed_file['delta'] = delta
 
         # Add information to transaction
         transaction['key_ids'].append(self._encryption_key.key_id)
@@ -208,19 +311,27 @@ class WebCustomPythonScraper(WebScraper):
         key_ids = transaction['key_ids']
         if attached_files is not None:
             for attached_file in attached_files:
-                attached_fuuids.append(attached_file['fuuid'])
+                fuuid = stored_fuuid(attached_file)  # Members of a pack are kept with the pack
+                if fuuid not in attached_fuuids:
+                    attached_fuuids.append(fuuid)
                 cle_id = attached_file['cle_id']
                 if cle_id not in key_ids:
                     key_ids.append(cle_id)
             transaction['attached_fuuids'] = attached_fuuids
 
         # Prepare output bytes, compress and produce fuuid
-        output_file_bytes = json.dumps(data_feed_file).encode('utf-8')
-        output_file_bytes = await asyncio.to_thread(zlib.compress, output_file_bytes)
-        fuuid = await asyncio.to_thread(hacher, output_file_bytes, 'blake2b-512', 'base58btc')
+        metrics = self._context.metrics
+        with metrics.span('serialize'):
+            output_file_bytes = json.dumps(data_feed_file).encode('utf-8')
+        with metrics.span('compress') as span:
+            span.bytes = len(output_file_bytes)
+            output_file_bytes = await self._context.cpu_executor.run(zlib.compress, output_file_bytes)
+        with metrics.span('hash') as span:
+            span.bytes = len(output_file_bytes)
+            fuuid = await self._context.cpu_executor.run(hacher, output_file_bytes, 'blake2b-512', 'base58btc')
         transaction['data_fuuid'] = fuuid
 
         # Save to output file
-        await asyncio.to_thread(output_file.write, output_file_bytes)
+        await self._context.io_executor.run(output_file.write, output_file_bytes)
 
         return fuuid, len(output_file_bytes)
@@ -5,16 +5,28 @@ import asyncio
 import datetime
 import tempfile
 import pathlib
+import time
 
 from typing import Optional, TypedDict
 
 import pytz
 
-from millegrilles_messages.chiffrage.EncryptionKey import generate_new_secret
+from millegrilles_messages.chiffrage.EncryptionKey import EncryptionKey, generate_new_secret
+from millegrilles_messages.messages import Constantes
+from millegrilles_messages.messages.EnveloppeCertificat import EnveloppeCertificat
 from millegrilles_webscraper.Context import WebScraperContext
+from millegrilles_webscraper.Deadline import ScrapeDeadline, set_current_deadline, reset_current_deadline
+from millegrilles_webscraper.HttpClient import HttpBodyTooLargeError
+from millegrilles_webscraper.Metrics import set_current_feed, reset_current_feed
+from millegrilles_webscraper.PrioritySemaphore import PrioritySemaphore
 
 CHUNK_SIZE = 1024 * 64
 
+SCRAPE_DONE = 'done'
+SCRAPE_EMPTY = 'empty'
+SCRAPE_TIMEOUT = 'timeout'
+SCRAPE_ERROR = 'error'
+
 
 class FeedInformation(TypedDict):
     name: str
@@ -36,27 +48,66 @@ class FeedParametersType(TypedDict):
     deleted: bool
 
 
+class ScrapeResult:
+    """
+    Status and timings of an on-demand scrape. Times are from time.monotonic().
+    """
+
+    def __init__(self, feed_id: str):
+        self.feed_id = feed_id
+        self.status: Optional[str] = None
+        self.error: Optional[str] = None
+        self.size = 0
+        self.requested = time.monotonic()
+        self.started: Optional[float] = None
+        self.downloaded: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.done = asyncio.Event()
+
+    def complete(self, status: str):
+        if self.done.is_set():
+            return
+        self.status = status
+        self.finished = time.monotonic()
+        self.done.set()
+
+    def to_dict(self) -> dict:
+        def duration_ms(start: Optional[float], end: Optional[float]) -> Optional[int]:
+            if start is None or end is None:
+                return None
+            return round((end - start) * 1000)
+
+        return {
+            'feed_id': self.feed_id,
+            'status': self.status,
+            'error': self.error,
+            'size': self.size,
+            'queue_ms': duration_ms(self.requested, self.started),
+            'download_ms': duration_ms(self.started, self.downloaded),
+            'process_ms': duration_ms(self.downloaded, self.finished),
+            'total_ms': duration_ms(self.requested, self.finished),
+        }
+
+
 class WebScraper:
 
     def __init__(self, context: WebScraperContext, feed: FeedParametersType, semaphore: asyncio.BoundedSemaphore):
         self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
-        self.__stop_event = asyncio.Event()
+        self.__stopped = False
         self._context = context
         self.__semaphore = semaphore
+        self.__scrape_lock = asyncio.Lock()  # One scrape of the feed at a time (scheduled or on demand)
+        self.__on_demand_tasks: set[asyncio.Task] = set()
         self.__feed = feed
 
         self.__url = feed['decrypted_feed_information']['url']
         self.__refresh_rate = None
+        self.__deadline: Optional[float] = None
+        self.__max_body_size: Optional[int] = None
         self.__last_update: Optional[datetime.datetime] = None
         self.__etag: Optional[str] = None
 
-        ca_certificate = context.ca
-        domains = ['DataCollector']
-        domain = self.__feed.get('domain')
-        if domain and domain != 'DataCollector':
-            domains.append(domain)
-
-        self._encryption_key = generate_new_secret(ca_certificate, domains)
+        self.__encryption_key: Optional[EncryptionKey] = None  # Generated on first use, see _encryption_key
         self._encryption_key_submitted = False
         self._key_command: Optional[dict] = None
 
@@ -67,58 +118,130 @@ class WebScraper:
     def feed_id(self):
         return self.__feed['feed_id']
 
+    @property
+    def feed_type(self) -> str:
+        return self.__feed.get('feed_type') or ''
+
+    @property
+    def _encryption_key(self) -> EncryptionKey:
+        """
+        Secret key of the feed for the items and files it saves, generated the first time it is needed. Feeds that
+        never save anything do not hold a key.
+        """
+        if self.__encryption_key is None:
+            self.__encryption_key = generate_new_secret(self._context.ca, self._key_domains)
+        return self.__encryption_key
+
+    @property
+    def _key_domains(self) -> list[str]:
+        """ :return: Domains allowed to decrypt the content saved by the feed """
+        domains = ['DataCollector']
+        domain = self.__feed.get('domain')
+        if domain and domain != 'DataCollector':
+            domains.append(domain)
+        return domains
+
     def update_poll_rate(self, rate: Optional[datetime.timedelta]):
         self.__refresh_rate = rate
 
-    async def run(self):
+    @property
+    def deadline_seconds(self) -> float:
+        """
+        :return: Time budget of a scrape. The deadline of the feed, else its poll rate, capped by the configuration.
+        """
+        maximum = self._context.scrape_deadline_seconds
+        if self.__deadline:
+            return min(self.__deadline, maximum)
         if self.__refresh_rate:
-            # Runs until stopped at the defined refresh_rate
-            while self.__stop_event.is_set() is False:
-                try:
-                    await self.__scrape()
-                except asyncio.TimeoutError:
-                    self.__logger.warning(f"Timeout while processing {self.url}")
-                except aiohttp.ClientResponseError as cre:
-                    if cre.status == 429:
-                        self.__logger.warning("Received HTTP 429 on %s, sleeping for a while" % self.url)
-                        try:
-                            if self.__refresh_rate.seconds < 3600:
-                                await asyncio.wait_for(self.__stop_event.wait(), 3600)
-                                return  # Closing
-                        except asyncio.TimeoutError:
-                            continue  # Retry
-                    else:
-                        raise cre
-                try:
-                    await asyncio.wait_for(self.__stop_event.wait(), self.__refresh_rate.seconds)
-                    return  # Closing
-                except asyncio.TimeoutError:
-                    pass
-        else:
-            # Runs once and exits
+            return min(self.__refresh_rate.total_seconds(), maximum)
+        return maximum
+
+    @property
+    def max_body_size(self) -> int:
+        """
+        :return: Maximum bytes of a downloaded body. The limit of the feed, capped by the configuration.
+        """
+        maximum = self._context.configuration.max_body_size
+        if self.__max_body_size:
+            return min(int(self.__max_body_size), maximum)
+        return maximum
+
+    async def run(self):
+        """
+        Scrapes the feed at its refresh rate until stopped, once when it has no refresh rate.
+        The FeedManager does not use this method, its FeedScheduler calls run_once() for all the feeds.
+        """
+        while self.__stopped is False:
+            wait_seconds = await self.run_once()
+            if wait_seconds is None:
+                return
+            await self._context.wait(wait_seconds)
+
+    async def run_once(self) -> Optional[float]:
+        """
+        Scrapes the feed, skipped when its host is unavailable. Errors of a periodic feed are logged.
+        :return: Seconds until the next scrape, None when the feed has no refresh rate
+        """
+        if not self.__refresh_rate:
+            await self.__scrape()
+            return None
+
+        wait_seconds = self.__refresh_rate.total_seconds()
+        retry_in = self._context.http_client.host_retry_in(self.url)
+        if retry_in > 0:
+            # The host is rate limiting or failing, skip the fetch without taking a scrape slot
+            self.__logger.info("Host of %s unavailable for %.0f seconds, skipping scrape" % (self.url, retry_in))
+            return max(wait_seconds, retry_in)
+
+        try:
             await self.__scrape()
+        except asyncio.TimeoutError:
+            self.__logger.warning(f"Timeout while processing {self.url}")
+        except aiohttp.ClientError as e:
+            # Includes HTTP 429, the host health registry holds the delay for all the feeds of the host
+            self.__logger.warning("Error fetching %s: %s" % (self.url, e))
+            wait_seconds = max(wait_seconds, self._context.http_client.host_retry_in(self.url))
+        except Exception:
+            self.__logger.exception("Error scraping %s" % self.url)
+        return wait_seconds
 
     async def stop(self):
-        self.__stop_event.set()
-
-    async def __scrape(self):
-        async with self.__semaphore:
-            self.__logger.debug(f"Scraping START on {self.url}")
-
-            try:
-                with tempfile.TemporaryFile('wb+') as temp_input_file:
-                    len_file = await self.get_content(temp_input_file)
-                    if len_file > 0:
-                        self.__logger.debug(f"Scraped {len_file} bytes, processing latest {self.url}")
-                        temp_input_file.seek(0)  # Reposition file pointer to start processing
-                        with tempfile.TemporaryFile('wb+') as temp_output_file:
-                            await self.process(temp_input_file, temp_output_file)
-                    else:
-                        self.__logger.debug(f"No content found for {self.url}, skipping")
-
-                self.__logger.info(f"Scraping DONE on {self.url}")
-            except asyncio.TimeoutError:
-                self.__logger.warning(f"Timeout when fetching web content on {self.url}")
+        self.__stopped = True
+
+    async def scrape_now(self) -> ScrapeResult:
+        """
+        Scrapes the feed immediately, ahead of the scheduled scrapes waiting for the feed semaphore. Downloads still
+        go through the shared http client and the throttle still applies before the slot is released.
+        :return: Result once the content is processed, the throttle runs after the result is returned.
+        """
+        result = ScrapeResult(self.feed_id)
+        task = asyncio.create_task(self.__scrape_on_demand(result))
+        self.__on_demand_tasks.add(task)  # Keep a reference until the throttle is done
+        task.add_done_callback(self.__on_demand_tasks.discard)
+        try:
+            await result.done.wait()
+        except asyncio.CancelledError as e:
+            task.cancel()
+            raise e
+        return result
+
+    async def __scrape_on_demand(self, result: ScrapeResult):
+        try:
+            await self.__scrape(result)
+        except Exception as e:
+            self.__logger.warning("On demand scrape of %s failed: %s" % (self.url, e))
+            result.error = str(e)
+        finally:
+            result.complete(SCRAPE_ERROR)  # No effect when already completed
+
+    async def __scrape(self, result: Optional[ScrapeResult] = None):
+        lane = self.__semaphore
+        if result is not None and isinstance(lane, PrioritySemaphore):
+            lane = lane.priority()
+
+        async with lane:
+            async with self.__scrape_lock:
+                await self.__scrape_content(result)
 
             throttle = self._context.scrape_throttle_seconds
             if throttle:
@@ -126,6 +249,58 @@ class WebScraper:
                 self.__logger.debug(f"Throttling after {self.url}")
                 await self._context.wait(throttle)
 
+    async def __scrape_content(self, result: Optional[ScrapeResult]):
+        self.__logger.debug(f"Scraping START on {self.url}")
+        if result is not None:
+            result.started = time.monotonic()
+
+        # Label the metrics of all stages with this feed
+        metrics = self._context.metrics
+        feed_token = set_current_feed(self.feed_type, self.feed_id)
+        deadline = ScrapeDeadline(self.deadline_seconds)
+        deadline_token = set_current_deadline(deadline)
+        status = SCRAPE_DONE
+        try:
+            async with asyncio.timeout(deadline.seconds) as scope:
+                with metrics.span('scrape'):
+                    with tempfile.TemporaryFile('wb+') as temp_input_file:
+                        with metrics.span('download') as span:
+                            len_file = await self.get_content(temp_input_file)
+                            span.bytes = len_file
+                        if result is not None:
+                            result.downloaded = time.monotonic()
+                            result.size = len_file
+                        if len_file > 0:
+                            self.__logger.debug(f"Scraped {len_file} bytes, processing latest {self.url}")
+                            temp_input_file.seek(0)  # Reposition file pointer to start processing
+                            with tempfile.TemporaryFile('wb+') as temp_output_file:
+                                with metrics.span('process'), self._context.costs.sample_allocations():
+                                    await self.process(temp_input_file, temp_output_file)
+                        else:
+                            self.__logger.debug(f"No content found for {self.url}, skipping")
+                            status = SCRAPE_EMPTY
+
+            self.__logger.info(f"Scraping DONE on {self.url}")
+        except asyncio.TimeoutError as e:
+            status = SCRAPE_TIMEOUT
+            if scope.expired():
+                stage = deadline.stage or 'scrape'
+                self.__logger.warning("Deadline of %g seconds expired during stage %s on %s" %
+                                      (deadline.seconds, stage, self.url))
+                metrics.observe_stage('deadline.' + stage, deadline.elapsed())
+                if result is not None:
+                    result.error = 'Deadline expired during stage %s' % stage
+            else:
+                self.__logger.warning(f"Timeout when fetching web content on {self.url}")
+                if result is not None:
+                    result.error = str(e) or None
+        finally:
+            reset_current_deadline(deadline_token)
+            reset_current_feed(feed_token)
+
+        if result is not None:
+            result.complete(status)
+
     async def get_content(self, tmp_file: tempfile.TemporaryFile) -> int:
         len_file = 0
 
@@ -133,30 +308,34 @@ class WebScraper:
             # Process local file
             local_path_str = self.url[len("file://"):]
             local_filename = pathlib.Path(local_path_str)
+            max_size = self.max_body_size
             with open(local_filename, 'rb') as fp:
                 while True:
                     chunk = fp.read(CHUNK_SIZE)
                     if not chunk:
                         break
-                    tmp_file.write(chunk)
                     len_file += len(chunk)
+                    if len_file > max_size:
+                        raise HttpBodyTooLargeError('Content of %s larger than %d bytes' % (self.url, max_size))
+                    tmp_file.write(chunk)
         else:
-            session_timeout = aiohttp.ClientTimeout(total=90, connect=5, sock_read=10)
-            headers = dict()
-            try:
-                headers['user-agent'] = self.__feed['decrypted_feed_information']['user_agent']
-                # headers['user-agent'] = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:138.0) Gecko/20100101 Firefox/138.0'
-            except KeyError:
-                pass
-            async with aiohttp.ClientSession(headers=headers, timeout=session_timeout) as session:
-                async with session.get(self.url) as response:
-                    response.raise_for_status()
-                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
-                        await asyncio.to_thread(tmp_file.write, chunk)
-                        len_file += len(chunk)
+            # Feeds on the same url share the download
+            content = await self._context.http_client.get(self.url, headers=self._request_headers(),
+                                                          max_size=self.max_body_size)
+            content.raise_for_status()
+            len_file = await content.copy_to(tmp_file)
 
         return len_file
 
+    def _request_headers(self) -> dict:
+        headers = dict()
+        try:
+            headers['user-agent'] = self.__feed['decrypted_feed_information']['user_agent']
+            # headers['user-agent'] = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:138.0) Gecko/20100101 Firefox/138.0'
+        except KeyError:
+            pass
+        return headers
+
     @property
     def url(self) -> str:
         return self.__url
@@ -170,6 +349,8 @@ class WebScraper:
         return self.__last_update
 
     def update(self, parameters: FeedParametersType):
+        self.__deadline = parameters['decrypted_feed_information'].get('deadline')
+        self.__max_body_size = parameters['decrypted_feed_information'].get('max_body_size')
         poll_rate_update = parameters.get('poll_rate')
         if poll_rate_update:
             if poll_rate_update < 120:
@@ -185,5 +366,36 @@ class WebScraper:
         self.__last_update = datetime.datetime.now(tz=pytz.UTC)
         self.__etag = etag
 
+    async def _prepare_key_command(self, producer):
+        """
+        Signs the command saving the feed encryption key with the keymaster, once. The command is attached to the
+        saved items until DataCollector accepts one of them.
+        """
+        if self._encryption_key_submitted is False and self._key_command is None:
+            idmg = self._context.ca.idmg
+            fiche_response = await producer.request({'idmg': idmg}, 'CoreTopologie', 'ficheMillegrille', exchange=Constantes.SECURITE_PUBLIC)
+            encryption_keys = fiche_response.parsed['chiffrage']
+            certs = [EnveloppeCertificat.from_pem('\n'.join(c)) for c in encryption_keys]
+            encrypted_keys = self._encryption_key.produce_keymaster_content(certs)
+            key_command, _message_id = self._context.formatteur.signer_message(
+                Constantes.KIND_COMMANDE, encrypted_keys, 'MaitreDesCles', action='ajouterCleDomaines')
+            self._key_command = key_command
+
+    def _key_attachments(self) -> Optional[dict[str, dict]]:
+        """ :return: Attachments of the next save command, None when the key is already saved """
+        if self._key_command:
+            return {'key': self._key_command}
+        return None
+
+    def _key_save_response(self, response):
+        """
+        Marks the key as saved when a save command with the key attached succeeded.
+        """
+        if self._encryption_key_submitted is False and response.parsed['ok'] is True:
+            # Key saved successfully
+            self._key_command = None
+            self._encryption_key_submitted = True
+            self._context.file_handler.confirm_key(self._encryption_key.key_id)
+
     async def process(self, temp_input_file: tempfile.TemporaryFile, temp_output_file: tempfile.TemporaryFile()):
         raise NotImplementedError('Must be implemented')
@@ -0,0 +1,195 @@
+"""
+Microbenchmarks for the CPU functions called on every scrape: hashing, encryption, compression and serialization.
+
+Save a baseline:      python3 test/BenchmarkCpuHotPath.py --save baseline.json
+Compare with it:      python3 test/BenchmarkCpuHotPath.py --compare baseline.json
+The compare mode exits with code 1 when a benchmark is slower than the baseline by more than the threshold.
+"""
+import argparse
+import binascii
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import zlib
+
+from typing import Callable, Optional
+
+from millegrilles_messages.chiffrage.Mgs4 import chiffrer_mgs4_bytes_secrete, chiffrer_document, CipherMgs4WithSecret
+from millegrilles_messages.messages.Hachage import Hacheur, hacher
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000, 10_000_000, 100_000_000]
+MIN_DURATION = 0.5      # Seconds spent on each benchmark/size
+MIN_ITERATIONS = 3
+MAX_ITERATIONS = 1_000
+
+
+def generate_payload(size: int) -> bytes:
+    """ Html-like content, compressible like a real page. Deterministic for a given size. """
+    line = b'<div class="item"><a href="https://news.example.com/%d">Lorem ipsum dolor sit amet %d</a></div>\n'
+    parts = list()
+    total = 0
+    i = 0
+    while total < size:
+        part = line % (i, i * 7919 % 100_003)
+        parts.append(part)
+        total += len(part)
+        i += 1
+    return b''.join(parts)[:size]
+
+
+def bench_hacheur_streaming(payload: bytes, secret_key: bytes):
+    digester = Hacheur('blake2s-256', 'base64')
+    for i in range(0, len(payload), CHUNK_SIZE):
+        digester.update(payload[i:i + CHUNK_SIZE])
+    digester.finalize()
+
+
+def bench_hacher(payload: bytes, secret_key: bytes):
+    hacher(payload, 'blake2b-512', 'base58btc')
+
+
+def bench_chiffrer_mgs4_bytes(payload: bytes, secret_key: bytes):
+    chiffrer_mgs4_bytes_secrete(secret_key, payload)
+
+
+def bench_cipher_mgs4_streaming(payload: bytes, secret_key: bytes):
+    cipher = CipherMgs4WithSecret(secret_key)
+    for i in range(0, len(payload), CHUNK_SIZE):
+        cipher.update(payload[i:i + CHUNK_SIZE])
+    cipher.finalize()
+
+
+def bench_chiffrer_document(payload: bytes, secret_key: bytes):
+    chiffrer_document(secret_key, 'benchmark', {'title': 'Benchmark', 'content': payload.decode('utf-8')})
+
+
+def bench_zlib_compress(payload: bytes, secret_key: bytes):
+    zlib.compress(payload)
+
+
+def bench_json_dumps_data_feed_file(payload: bytes, secret_key: bytes):
+    json.dumps(_data_feed_file(payload)).encode('utf-8')
+
+
+def _data_feed_file(payload: bytes) -> dict:
+    # Same shape as the DataFeedFile produced by WebCustomPythonScraper, ciphertext is base64 in the json
+    return {
+        "feed_id": "benchmark",
+        "data_id": "benchmark",
+        "save_date": 1_700_000_000_000,
+        "encrypted_data": {
+            "format": "mgs4",
+            "nonce": "benchmark",
+            "cle_id": "benchmark",
+            "ciphertext_base64": binascii.b2a_base64(payload, newline=False).decode('utf-8'),
+        },
+        "pub_start_date": None,
+        "pub_end_date": 1_700_000_000_000,
+        "files": None,
+        "encrypted_files_map": None,
+    }
+
+
+BENCHMARKS: dict[str, Callable[[bytes, bytes], None]] = {
+    'hacheur_blake2s_streaming': bench_hacheur_streaming,
+    'hacher_blake2b_base58btc': bench_hacher,
+    'chiffrer_mgs4_bytes_secrete': bench_chiffrer_mgs4_bytes,
+    'cipher_mgs4_streaming': bench_cipher_mgs4_streaming,
+    'chiffrer_document': bench_chiffrer_document,
+    'zlib_compress': bench_zlib_compress,
+    'json_dumps_data_feed_file': bench_json_dumps_data_feed_file,
+}
+
+
+def run_benchmark(function: Callable[[bytes, bytes], None], payload: bytes, secret_key: bytes) -> dict:
+    function(payload, secret_key)  # Warmup
+    durations = list()
+    start = time.perf_counter()
+    while len(durations) < MAX_ITERATIONS:
+        iteration_start = time.perf_counter()
+        function(payload, secret_key)
+        durations.append(time.perf_counter() - iteration_start)
+        if len(durations) >= MIN_ITERATIONS and time.perf_counter() - start >= MIN_DURATION:
+            break
+
+    median = statistics.median(durations)
+    return {
+        'iterations': len(durations),
+        'min': min(durations),
+        'median': median,
+        'mb_per_sec': len(payload) / median / 1_000_000 if median > 0 else None,
+    }
+
+
+def run_all(names: list[str], sizes: list[int]) -> dict:
+    secret_key = os.urandom(32)
+    results = dict()
+    for size in sizes:
+        payload = generate_payload(size)
+        for name in names:
+            result = run_benchmark(BENCHMARKS[name], payload, secret_key)
+            key = '%s@%d' % (name, size)
+            results[key] = result
+            print("%-45s %10d iter  median %10.3f ms  %8.1f MB/s" % (
+                key, result['iterations'], result['median'] * 1000, result['mb_per_sec'] or 0))
+            sys.stdout.flush()
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list[str]:
+    regressions = list()
+    print("\nComparison with baseline (threshold %.0f%%)" % (threshold * 100))
+    for key, result in results.items():
+        base: Optional[dict] = baseline['results'].get(key)
+        if base is None:
+            continue
+        ratio = result['median'] / base['median'] if base['median'] > 0 else 1.0
+        flag = ''
+        if ratio > 1.0 + threshold:
+            flag = 'REGRESSION'
+            regressions.append(key)
+        elif ratio < 1.0 - threshold:
+            flag = 'faster'
+        print("%-45s %+7.1f%% %s" % (key, (ratio - 1.0) * 100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU hot path microbenchmarks")
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help="Payload sizes in bytes")
+    parser.add_argument('--benchmarks', nargs='+', default=list(BENCHMARKS.keys()), choices=BENCHMARKS.keys())
+    parser.add_argument('--save', help="Save results as a json baseline")
+    parser.add_argument('--compare', help="Compare results with a json baseline")
+    parser.add_argument('--threshold', type=float, default=0.10, help="Relative slowdown flagged as a regression")
+    args = parser.parse_args()
+
+    results = run_all(args.benchmarks, args.sizes)
+
+    if args.save:
+        baseline = {
+            'date': datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'results': results,
+        }
+        with open(args.save, 'wt') as fp:
+            json.dump(baseline, fp, indent=2)
+        print("Baseline saved to %s" % args.save)
+
+    if args.compare:
+        with open(args.compare, 'rt') as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline, args.threshold)
+        if len(regressions) > 0:
+            print("%d regression(s): %s" % (len(regressions), ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
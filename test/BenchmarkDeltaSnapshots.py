@@ -0,0 +1,117 @@
+"""
+Stores successive versions of a page as in WebCustomPythonScraper delta mode (keyframe, then deltas against the
+previous version) and compares the compressed bytes with full snapshots. Every version is then rebuilt with the
+reference decoder (rebuild_snapshot) and compared with the original.
+
+Versions are the files of a directory in name order (e.g. saved polls of a feed), or synthetic RSS documents where
+a few items change between polls.
+
+Usage: python3 test/BenchmarkDeltaSnapshots.py [--versions-dir DIR] [--versions 48] [--items 6000] [--changes 10]
+"""
+import argparse
+import pathlib
+import random
+import time
+import zlib
+
+from typing import Optional
+
+from millegrilles_webscraper.DataStructures import DeltaReference
+from millegrilles_webscraper.scrapers.DeltaSnapshot import DELTA_FORMAT, encode_delta, rebuild_snapshot
+from millegrilles_webscraper.scrapers.WebCustomPythonScraper import DEFAULT_KEYFRAME_INTERVAL, DELTA_MAX_RATIO
+
+
+def synthetic_versions(count: int, items: int, changes: int) -> list[bytes]:
+    rng = random.Random(1)
+    words = ['alpha', 'beta', 'gamma', 'delta', 'news', 'story', 'market', 'weather', 'sports']
+
+    def item(n: int) -> str:
+        description = ' '.join(rng.choice(words) for _ in range(40))
+        return ('<item><title>Title %d</title><link>https://example.com/%d</link>'
+                '<description>%s</description><pubDate>%d</pubDate></item>' % (n, n, description, n))
+
+    current = [item(n) for n in range(items)]
+    versions = list()
+    next_item = items
+    for _ in range(count):
+        versions.append(('<rss><channel>%s</channel></rss>' % ''.join(current)).encode('utf-8'))
+        # New items at the top, oldest items dropped, a few items edited
+        current = [item(n) for n in range(next_item, next_item + changes)] + current[:-changes]
+        next_item += changes
+        for _ in range(changes):
+            position = rng.randrange(len(current))
+            current[position] = current[position].replace('</title>', ' (updated)</title>', 1)
+    return versions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Delta snapshots compared with full snapshots")
+    parser.add_argument('--versions-dir', type=pathlib.Path, help="Directory of saved versions, in name order")
+    parser.add_argument('--versions', type=int, default=48)
+    parser.add_argument('--items', type=int, default=6000)
+    parser.add_argument('--changes', type=int, default=10, help="Items added and edited between versions")
+    parser.add_argument('--keyframe-interval', type=int, default=DEFAULT_KEYFRAME_INTERVAL)
+    args = parser.parse_args()
+
+    if args.versions_dir is not None:
+        versions = [f.read_bytes() for f in sorted(args.versions_dir.iterdir()) if f.is_file()]
+    else:
+        versions = synthetic_versions(args.versions, args.items, args.changes)
+
+    # Stored payloads by fuuid, as saved in the encrypted_data of the DataFeedFile
+    stored: dict[str, tuple[Optional[DeltaReference], bytes]] = dict()
+    full_bytes = 0
+    stored_bytes = 0
+    keyframes = 0
+    encode_durations = list()
+
+    previous: Optional[bytes] = None
+    previous_fuuid: Optional[str] = None
+    keyframe_fuuid: Optional[str] = None
+    sequence = 0
+    for number, content in enumerate(versions):
+        fuuid = 'version%04d' % number
+        full_bytes += len(zlib.compress(content))
+
+        delta_bytes = None
+        if previous is not None and sequence + 1 < args.keyframe_interval:
+            start = time.perf_counter()
+            delta_bytes = encode_delta(previous, content)
+            encode_durations.append(time.perf_counter() - start)
+            if len(delta_bytes) > len(content) * DELTA_MAX_RATIO:
+                delta_bytes = None
+
+        if delta_bytes is None:
+            keyframes += 1
+            sequence = 0
+            keyframe_fuuid = fuuid
+            stored[fuuid] = (None, content)
+            stored_bytes += len(zlib.compress(content))
+        else:
+            sequence += 1
+            reference: DeltaReference = {'format': DELTA_FORMAT, 'base_fuuid': previous_fuuid,
+                                         'keyframe_fuuid': keyframe_fuuid, 'sequence': sequence}
+            stored[fuuid] = (reference, delta_bytes)
+            stored_bytes += len(zlib.compress(delta_bytes))
+
+        previous = content
+        previous_fuuid = fuuid
+
+    start = time.perf_counter()
+    for number, content in enumerate(versions):
+        if rebuild_snapshot('version%04d' % number, stored.__getitem__) != content:
+            raise ValueError('Version %d rebuilt with a different content' % number)
+    rebuild_duration = time.perf_counter() - start
+
+    print("Versions          : %d (%d keyframes), %.0f KB average" % (
+        len(versions), keyframes, sum(len(v) for v in versions) / len(versions) / 1024))
+    print("Full snapshots    : %d bytes compressed" % full_bytes)
+    print("Delta snapshots   : %d bytes compressed (%.1f%%)" % (stored_bytes, 100.0 * stored_bytes / full_bytes))
+    if len(encode_durations) > 0:
+        print("Delta encoding    : mean %.1f ms, max %.1f ms" % (
+            1000 * sum(encode_durations) / len(encode_durations), 1000 * max(encode_durations)))
+    print("Rebuild           : all versions verified in %.2f s" % rebuild_duration)
+
+
+if __name__ == '__main__':
+    main()
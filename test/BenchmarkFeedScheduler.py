@@ -0,0 +1,151 @@
+"""
+Per-feed memory and scheduling overhead of the feed execution models, without scrapes (no network, no bus):
+
+- tasks: one long-lived task per feed waiting on an asyncio.Event with a wait_for timer, as WebScraper.run().
+- wheel: FeedScheduler, FeedRecords in the timer wheel and a few workers calling run_once().
+
+The feeds are stubs whose run_once() returns their poll rate. Reported per model: memory allocated per feed
+(tracemalloc), event loop lag and process CPU while the feeds are polled, and how late the scrapes start.
+
+Usage: python3 test/BenchmarkFeedScheduler.py --feeds 50000 --idle 30 [--model wheel]
+"""
+import argparse
+import asyncio
+import gc
+import random
+import time
+import tracemalloc
+
+from asyncio import TaskGroup
+from typing import Optional
+
+from millegrilles_webscraper.FeedScheduler import FeedScheduler
+
+from ScaleFeedManager import measure_loop
+from LoadHarness import percentile
+
+
+class BenchmarkContext:
+    """ Stopping flag and wait() of the WebScraperContext used by the scheduler """
+
+    def __init__(self):
+        self.stopping = False
+        self.__stop_event = asyncio.Event()
+
+    async def wait(self, seconds: float):
+        try:
+            await asyncio.wait_for(self.__stop_event.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    def stop(self):
+        self.stopping = True
+        self.__stop_event.set()
+
+
+class StubFeed:
+    """ Feed polled every poll_rate seconds, records how late each scrape starts """
+
+    def __init__(self, feed_id: str, poll_rate: float, lateness: list[float]):
+        self.feed_id = feed_id
+        self.poll_rate = poll_rate
+        self.__lateness = lateness
+        self.__due: Optional[float] = None
+        self.__stop_event: Optional[asyncio.Event] = None
+
+    async def run_once(self) -> float:
+        now = time.monotonic()
+        if self.__due is not None:
+            self.__lateness.append(max(0.0, now - self.__due))
+        self.__due = now + self.poll_rate
+        await asyncio.sleep(0)
+        return self.poll_rate
+
+    async def run(self):
+        """ Task model, same loop as WebScraper.run() before the FeedScheduler """
+        self.__stop_event = asyncio.Event()
+        while self.__stop_event.is_set() is False:
+            wait_seconds = await self.run_once()
+            try:
+                await asyncio.wait_for(self.__stop_event.wait(), wait_seconds)
+                return
+            except asyncio.TimeoutError:
+                pass
+
+    def stop(self):
+        if self.__stop_event is not None:
+            self.__stop_event.set()
+
+
+async def run_benchmark(args: argparse.Namespace, model: str):
+    rng = random.Random(args.seed)
+    lateness: list[float] = list()
+    context = BenchmarkContext()
+    feeds = [StubFeed('feed%06d' % i, rng.uniform(args.poll_min, args.poll_max), lateness) for i in range(args.feeds)]
+
+    gc.collect()
+    tracemalloc.start(1)
+    snapshot_before = tracemalloc.take_snapshot()
+
+    async with TaskGroup() as group:
+        scheduler = None
+        if model == 'wheel':
+            scheduler = FeedScheduler(context, args.workers)
+            for feed in feeds:
+                scheduler.add(feed.feed_id, feed)
+            group.create_task(scheduler.run())
+        else:
+            for feed in feeds:
+                group.create_task(feed.run())
+
+        # Initial scrape of all the feeds
+        await asyncio.sleep(args.warmup)
+        gc.collect()
+        snapshot_after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        allocated = sum(s.size_diff for s in snapshot_after.compare_to(snapshot_before, 'filename'))
+        lateness.clear()
+
+        lags, cpu = await measure_loop(args.idle)
+
+        context.stop()
+        for feed in feeds:
+            feed.stop()
+
+    print("Model             : %s (%d feeds%s)" % (model, args.feeds,
+                                                    ', %d workers' % args.workers if scheduler else ''))
+    print("Allocated         : %.1f MB (%.0f bytes/feed)" % (allocated / 1024 / 1024, allocated / args.feeds))
+    print("Loop lag          : p50 %.2f ms, p99 %.2f ms, max %.2f ms" % (
+        percentile(lags, 50) * 1000, percentile(lags, 99) * 1000, max(lags) * 1000))
+    print("CPU usage         : %.1f%% over %.0f s" % (cpu * 100 / args.idle, args.idle))
+    if len(lateness) > 0:
+        print("Scrapes           : %d, late p50 %.1f ms, p99 %.1f ms, max %.1f ms" % (
+            len(lateness), percentile(lateness, 50) * 1000, percentile(lateness, 99) * 1000,
+            max(lateness) * 1000))
+    if scheduler is not None:
+        print("Scheduler         : %s" % scheduler.stats().to_dict())
+    print()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Feed execution models compared at scale")
+    parser.add_argument('--feeds', type=int, default=50_000, help="Number of feeds")
+    parser.add_argument('--model', choices=['tasks', 'wheel', 'both'], default='both')
+    parser.add_argument('--workers', type=int, default=4, help="Scheduler workers (wheel model)")
+    parser.add_argument('--poll-min', type=float, default=5, help="Shortest poll rate in seconds")
+    parser.add_argument('--poll-max', type=float, default=60, help="Longest poll rate in seconds")
+    parser.add_argument('--warmup', type=float, default=3, help="Seconds for the initial scrape of all the feeds")
+    parser.add_argument('--idle', type=float, default=30, help="Seconds measuring the polling overhead")
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    models = ['tasks', 'wheel'] if args.model == 'both' else [args.model]
+    for model in models:
+        asyncio.run(run_benchmark(args, model))
+
+
+if __name__ == '__main__':
+    main()
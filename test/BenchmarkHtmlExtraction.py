@@ -0,0 +1,119 @@
+import argparse
+import random
+import statistics
+import time
+
+from urllib.parse import urljoin
+
+from bs4 import BeautifulSoup
+
+from millegrilles_webscraper.scrapers.HtmlExtraction import compile_rules, extract_items
+
+BASE_URL = 'https://news.example.com/section/'
+
+RULES = {
+    'items': 'article.story',
+    'fields': {
+        'title': 'h2.headline',
+        'snippet': 'p.summary',
+        'url': 'a.link@href',
+        'date': 'time@datetime',
+        'author': 'xpath:.//span[@class="byline"]/text()',
+        'picture_url': 'img@src',
+    },
+}
+
+ARTICLE_TEMPLATE = """
+<article class="story" data-rank="%(index)d">
+  <div class="media"><img src="/images/%(index)d.jpg" alt="Picture %(index)d"></div>
+  <div class="body">
+    <h2 class="headline"><a class="link" href="/story/%(index)d">Story number %(index)d about %(topic)s</a></h2>
+    <p class="summary">%(summary)s</p>
+    <div class="meta"><span class="byline">Reporter %(author)d</span> <time datetime="2025-05-%(day)02dT10:00:00Z">May %(day)d</time></div>
+  </div>
+</article>
+"""
+
+TOPICS = ['markets', 'elections', 'weather', 'hockey', 'science', 'health', 'transit']
+WORDS = 'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt'.split()
+
+
+def generate_page(items: int, seed: int = 0) -> bytes:
+    """
+    Listing page with navigation and a sidebar around the articles, similar to a news section front.
+    """
+    rng = random.Random(seed)
+    parts = ['<!DOCTYPE html><html><head><title>Section</title></head><body>']
+    parts.append('<nav>%s</nav>' % ''.join('<a href="/nav/%d">Nav %d</a>' % (i, i) for i in range(60)))
+    parts.append('<main>')
+    for index in range(items):
+        parts.append(ARTICLE_TEMPLATE % {
+            'index': index,
+            'topic': rng.choice(TOPICS),
+            'summary': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(20, 60))),
+            'author': rng.randint(1, 40),
+            'day': rng.randint(1, 28),
+        })
+    parts.append('</main><aside>%s</aside>' % ''.join('<div class="ad"><p>Ad %d</p></div>' % i for i in range(30)))
+    parts.append('</body></html>')
+    return ''.join(parts).encode('utf-8')
+
+
+def extract_beautifulsoup(content: bytes, features: str) -> list[dict]:
+    """
+    Same extraction written like a custom_code script.
+    """
+    soup = BeautifulSoup(content, features)
+    items = list()
+    for article in soup.select('article.story'):
+        headline = article.select_one('h2.headline')
+        summary = article.select_one('p.summary')
+        link = article.select_one('a.link')
+        time_elem = article.select_one('time')
+        byline = article.select_one('span.byline')
+        img = article.select_one('img')
+        items.append({
+            'title': ' '.join(headline.get_text().split()) if headline else None,
+            'snippet': ' '.join(summary.get_text().split()) if summary else None,
+            'url': urljoin(BASE_URL, link['href']) if link and link.get('href') else None,
+            'date': time_elem.get('datetime') if time_elem else None,
+            'author': byline.get_text().strip() if byline else None,
+            'picture_url': urljoin(BASE_URL, img['src']) if img and img.get('src') else None,
+        })
+    return items
+
+
+def run(name: str, func, content: bytes, iterations: int) -> list[dict]:
+    durations = list()
+    result = None
+    for _ in range(iterations):
+        start = time.perf_counter()
+        result = func(content)
+        durations.append(time.perf_counter() - start)
+    print("%-22s: mean %7.2f ms, median %7.2f ms, %6.1f pages/sec" % (
+        name, statistics.mean(durations) * 1000, statistics.median(durations) * 1000, len(durations) / sum(durations)))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the html extraction rules against BeautifulSoup")
+    parser.add_argument('--items', type=int, default=100, help="Articles in the generated page")
+    parser.add_argument('--iterations', type=int, default=50)
+    args = parser.parse_args()
+
+    content = generate_page(args.items)
+    print("Page              : %d bytes, %d articles" % (len(content), args.items))
+
+    start = time.perf_counter()
+    rules = compile_rules(RULES)
+    print("Compile rules     : %.2f ms (cached afterwards)" % ((time.perf_counter() - start) * 1000))
+
+    expected = run('lxml compiled rules', lambda c: extract_items(c, rules, BASE_URL), content, args.iterations)
+    for features in ('html.parser', 'lxml'):
+        result = run('bs4 %s' % features, lambda c: extract_beautifulsoup(c, features), content, args.iterations)
+        if result != expected:
+            raise AssertionError('Extraction with bs4 %s differs from the compiled rules' % features)
+
+
+if __name__ == '__main__':
+    main()
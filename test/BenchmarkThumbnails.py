@@ -0,0 +1,55 @@
+import argparse
+import pathlib
+import statistics
+import time
+
+from millegrilles_webscraper.scrapers import ThumbnailProcessor
+
+IMAGE_SUFFIXES = {'.jpg', '.jpeg', '.png', '.webp', '.gif'}
+
+
+def benchmark(corpus: pathlib.Path, max_dimension: int, quality: int, image_format: str):
+    files = sorted([f for f in corpus.iterdir() if f.suffix.lower() in IMAGE_SUFFIXES])
+    if len(files) == 0:
+        raise ValueError('No images found in %s' % corpus)
+
+    total_original = 0
+    total_output = 0
+    kept_original = 0
+    durations = list()
+
+    for image_file in files:
+        content = image_file.read_bytes()
+        start = time.perf_counter()
+        output = ThumbnailProcessor.downscale_image(content, max_dimension, quality, image_format)
+        durations.append(time.perf_counter() - start)
+
+        total_original += len(content)
+        if output is None:
+            kept_original += 1
+            total_output += len(content)
+        else:
+            total_output += len(output)
+
+    print("Images            : %d (%d kept as original)" % (len(files), kept_original))
+    print("Settings          : %s, max %dpx, quality %d" % (image_format, max_dimension, quality))
+    print("Bytes original    : %d" % total_original)
+    print("Bytes output      : %d (%.1f%%)" % (total_output, 100.0 * total_output / total_original))
+    print("Time per image    : mean %.2f ms, median %.2f ms, max %.2f ms" % (
+        statistics.mean(durations) * 1000, statistics.median(durations) * 1000, max(durations) * 1000))
+    print("Throughput        : %.1f images/sec" % (len(files) / sum(durations)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark thumbnail downscaling on a local corpus of images")
+    parser.add_argument('corpus', type=pathlib.Path, help="Directory of sample images")
+    parser.add_argument('--max-dimension', type=int, default=256)
+    parser.add_argument('--quality', type=int, default=80)
+    parser.add_argument('--format', default='webp', choices=ThumbnailProcessor.SUPPORTED_FORMATS.keys())
+    args = parser.parse_args()
+
+    benchmark(args.corpus, args.max_dimension, args.quality, args.format)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Upload routing between two local stand-in filehosts (FakeFilehost). The fast filehost fails in the middle of the
+batch and recovers later, reports where each upload went and the upload latency.
+
+The MilleGrilles certificates of a test instance are required in the environment (CA_PEM, CERT_PEM, KEY_PEM) to
+sign the filehost authentication. No MQ or filehost is used.
+
+Usage: python3 test/FailoverFilehosts.py --uploads 200 --size 100000
+"""
+import argparse
+import asyncio
+import io
+import os
+import statistics
+import tempfile
+import time
+
+from asyncio import TaskGroup
+
+from millegrilles_messages.bus.BusContext import ForceTerminateExecution
+
+from millegrilles_webscraper.Configuration import WebScraperConfiguration
+from millegrilles_webscraper.Context import WebScraperContext
+from millegrilles_webscraper.scrapers.AttachedFileHelper import AttachedFileHelper
+
+from harness.FakeFilehost import FakeFilehost
+from harness.FakeProducer import FakeProducer, FakeBusConnector
+
+
+async def run_uploads(args: argparse.Namespace, helper: AttachedFileHelper, fast: FakeFilehost, durations: list[float]):
+    content = os.urandom(args.size)
+
+    # Wait for both sessions
+    while len([s for s in helper.filehosts.stats() if s.ready]) < 2:
+        await asyncio.sleep(0.1)
+
+    fail_at = args.uploads // 3
+    recover_at = 2 * args.uploads // 3
+    for i in range(args.uploads):
+        if i == fail_at:
+            print("Upload %d: fast filehost failing" % i)
+            fast.failing = True
+        elif i == recover_at:
+            print("Upload %d: fast filehost recovered" % i)
+            fast.failing = False
+        start = time.monotonic()
+        await helper.upload_file('fuuid%06d' % i, len(content), io.BytesIO(content))
+        durations.append(time.monotonic() - start)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Upload failover between two filehosts")
+    parser.add_argument('--uploads', type=int, default=200)
+    parser.add_argument('--size', type=int, default=100_000, help="Bytes per upload")
+    args = parser.parse_args()
+
+    fast = FakeFilehost(filehost_id='fast', latency=0.005)
+    slow = FakeFilehost(filehost_id='slow', latency=0.05)
+    await fast.start()
+    await slow.start()
+
+    config = WebScraperConfiguration()
+    config.parse_config()
+    config.dir_data = tempfile.mkdtemp(prefix='webscraper_failover_')
+    context = WebScraperContext(config)
+    producer = FakeProducer(list(), list(), fast.filehost_dict(), list(),
+                            filehosts=[fast.filehost_dict(), slow.filehost_dict()])
+    context.bus_connector = FakeBusConnector(producer)
+    helper = AttachedFileHelper(context)
+
+    durations: list[float] = list()
+
+    async def upload_then_stop():
+        await run_uploads(args, helper, fast, durations)
+        context.stop()
+        await asyncio.sleep(0.5)
+        raise ForceTerminateExecution()
+
+    try:
+        async with TaskGroup() as group:
+            group.create_task(context.run())
+            group.create_task(helper.run())
+            group.create_task(upload_then_stop())
+    except* (ForceTerminateExecution, asyncio.CancelledError):
+        pass
+
+    await fast.stop()
+    await slow.stop()
+
+    print("Uploads           : %d of %d bytes" % (len(durations), args.size))
+    print("Fast filehost     : %d uploads, %d authentications" % (fast.uploads, fast.authentications))
+    print("Slow filehost     : %d uploads, %d authentications" % (slow.uploads, slow.authentications))
+    if len(durations) > 0:
+        print("Upload latency    : median %.3f s, max %.3f s" % (statistics.median(durations), max(durations)))
+    for stats in helper.filehosts.stats():
+        print("Filehost %-8s : %s" % (stats.filehost_id, stats.to_dict()))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,6 +1,3 @@
-from io import BytesIO
-
-import aiohttp
 import asyncio
 import datetime
 import tempfile
@@ -80,27 +77,26 @@ async def __verify_image_digests(context: WebScraperContext, picture_urls: dict[
 async def __download_save_pictures(context: WebScraperContext, encryption_key: EncryptionKey, picture_urls: dict[str, PictureInfo]):
     for picture_info in picture_urls.values():
         if picture_info.fuuid is None:
-            async with aiohttp.ClientSession() as session:
-                picture_url = picture_info.url
-                print("Downloading thumbnail %s" % picture_url)
-                async with session.get(picture_url) as response:
-                    if response.status == 200:
-                        content_bytes = await response.content.read()
-                        content_bytes_io = BytesIO(content_bytes)
-                        attached_file: AttachedFile = await context.file_handler.encrypt_upload_file(
-                            encryption_key.secret_key, content_bytes_io)
-
-                        # Inject file information into picture_info
-                        picture_info.fuuid = attached_file['fuuid']
-                        picture_info.format = attached_file['format']
-                        picture_info.compression = attached_file.get('compression')
-                        picture_info.nonce = attached_file.get('nonce')
-                        picture_info.cle_id = encryption_key.key_id
-                    else:
-                        print("Error loading thumbnail (%s) at %s" % (response.status, picture_url))
-                        await asyncio.sleep(0.5)
-                        continue
-            pass
+            # Shared http layer: coalesced with other feeds, recorded/replayed in capture mode
+            picture_url = picture_info.url
+            print("Downloading thumbnail %s" % picture_url)
+            content = await context.http_client.get(picture_url)
+            if content.status == 200:
+                with content.open() as content_reader:
+                    attached_file: AttachedFile = await context.file_handler.encrypt_upload_file(
+                        encryption_key.secret_key, content_reader, encryption_key.key_id, thumbnail=True)
+
+                # Inject file information into picture_info
+                picture_info.fuuid = attached_file['fuuid']
+                picture_info.format = attached_file['format']
+                picture_info.compression = attached_file.get('compression')
+                picture_info.nonce = attached_file.get('nonce')
+                picture_info.cle_id = attached_file['cle_id']  # Can differ when existing content is reused
+                picture_info.pack = attached_file.get('pack')  # Set by the scraper when packed in this scrape
+            else:
+                print("Error loading thumbnail (%s) at %s" % (content.status, picture_url))
+                await asyncio.sleep(0.5)
+                continue
 
     return None
 
@@ -113,7 +109,7 @@ async def process(context: WebScraperContext, encryption_key: EncryptionKey,
     output = CustomProcessOutput()
 
     # Extract picture URLs from input
-    output.pub_date_start, output.pub_date_end, attached_files = await asyncio.to_thread(__extract_data, input_file)
+    output.pub_date_start, output.pub_date_end, attached_files = await context.cpu_executor.run(__extract_data, input_file)
     # Remove already downloaded pictures (checking with DataCollector domain)
     await __verify_image_digests(context, attached_files)
     # Download pictures and save to filehost
@@ -0,0 +1,198 @@
+"""
+Offline end-to-end load harness. Drives FeedManager with synthetic feeds against local stand-ins for the bus
+(FakeProducer), the filehost (FakeFilehost) and the web sites (FeedServer), then reports throughput, latency and
+peak memory.
+
+The MilleGrilles certificates of a test instance are still required in the environment (CA_PEM, CERT_PEM, KEY_PEM)
+to sign messages and generate encryption keys. No MQ, filehost or internet access is used.
+
+Usage: python3 test/LoadHarness.py --feeds 100 --duration 60 --concurrency 10
+"""
+import argparse
+import asyncio
+import base64
+import logging
+import os
+import resource
+import statistics
+import tempfile
+import time
+
+from asyncio import TaskGroup
+
+from millegrilles_messages.bus.BusContext import ForceTerminateExecution
+from millegrilles_messages.chiffrage.Mgs4 import chiffrer_document
+
+from millegrilles_webscraper.Configuration import WebScraperConfiguration
+from millegrilles_webscraper.Context import WebScraperContext
+from millegrilles_webscraper.FeedManager import FeedManager, map_decrypted_keys
+from millegrilles_webscraper.HttpClient import HttpClient
+from millegrilles_webscraper.scrapers.AttachedFileHelper import AttachedFileHelper
+
+from harness.FakeFilehost import FakeFilehost
+from harness.FakeProducer import FakeProducer, FakeBusConnector
+from harness.FeedServer import FeedServer
+
+LOGGER = logging.getLogger(__name__)
+
+HARNESS_KEY_ID = 'harness-key'
+FEED_TYPES = ['web.google_trends.news', 'web.scraper.rss', 'web.scraper.python_custom']
+
+
+class HarnessFeedManager(FeedManager):
+    """ The harness sends the feed keys in cleartext, they are not encrypted for the scraper certificate. """
+
+    def decrypt_keys(self, keys: dict) -> dict[str, bytes]:
+        return map_decrypted_keys(keys['cles'])
+
+
+class HarnessStats:
+
+    def __init__(self):
+        self.scrape_durations: list[float] = list()
+        self.downloaded_bytes = 0
+
+    def observe(self, stage: str, duration: float, nbytes, feed_type: str, feed_id: str):
+        if stage == 'scrape':
+            self.scrape_durations.append(duration)
+        elif stage in ('download', 'download_thumbnail') and nbytes:
+            self.downloaded_bytes += nbytes
+
+
+def build_feed(feed_server: FeedServer, index: int, feed_type: str, secret_key: bytes, poll_rate: int) -> dict:
+    name = 'feed%05d' % index
+    if feed_type == 'web.google_trends.news':
+        url = feed_server.trends_url(name)
+    elif feed_type == 'web.scraper.rss':
+        url = feed_server.rss_url(name)
+    else:
+        url = feed_server.page_url(name)
+
+    feed_information = {'name': name, 'url': url}
+    encrypted_feed_information = chiffrer_document(secret_key, HARNESS_KEY_ID, feed_information)
+    encrypted_feed_information['cle_id'] = HARNESS_KEY_ID
+
+    return {
+        'feed_id': name,
+        'feed_type': feed_type,
+        'security_level': '1.public',
+        'domain': 'DataCollector',
+        'poll_rate': poll_rate,
+        'active': True,
+        'decrypt_in_database': False,
+        'encrypted_feed_information': encrypted_feed_information,
+        'decrypted_feed_information': None,
+        'deleted': False,
+    }
+
+
+def build_feeds(feed_server: FeedServer, count: int, feed_types: list[str], secret_key: bytes, poll_rate: int) -> list[dict]:
+    return [build_feed(feed_server, i, feed_types[i % len(feed_types)], secret_key, poll_rate) for i in range(count)]
+
+
+def load_keymaster_certificates(path: str) -> list[list[str]]:
+    with open(path, 'rt') as fp:
+        return [fp.read().strip().split('\n')]
+
+
+def percentile(values: list[float], pct: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_harness(args: argparse.Namespace, feeds_factory=build_feeds):
+    feed_server = FeedServer(items_per_document=args.items, page_size=args.page_size, change_interval=args.change_interval)
+    filehost = FakeFilehost()
+    await feed_server.start()
+    await filehost.start()
+
+    config = WebScraperConfiguration()
+    config.parse_config()
+    config.dir_data = tempfile.mkdtemp(prefix='webscraper_harness_')
+    config.scrape_concurrency = args.concurrency
+    config.scrape_throttle = 0
+    context = WebScraperContext(config)
+
+    secret_key = os.urandom(32)
+    keys = [{'cle_id': HARNESS_KEY_ID, 'cle_secrete_base64': base64.b64encode(secret_key).decode('utf-8')}]
+    feeds = feeds_factory(feed_server, args.feeds, args.feed_types, secret_key, args.poll_rate)
+    producer = FakeProducer(feeds, keys, filehost.filehost_dict(), load_keymaster_certificates(args.keymaster_cert),
+                            latency=args.bus_latency)
+
+    context.bus_connector = FakeBusConnector(producer)
+    http_client = HttpClient(context)
+    attached_file_helper = AttachedFileHelper(context)
+    feed_manager = HarnessFeedManager(context)
+    context.http_client = http_client
+    context.file_handler = attached_file_helper
+
+    stats = HarnessStats()
+    context.metrics.add_listener(stats.observe)
+
+    async def stop_after():
+        await asyncio.sleep(args.duration)
+        context.stop()
+        await asyncio.sleep(1)
+        raise ForceTerminateExecution()
+
+    start = time.monotonic()
+    try:
+        async with TaskGroup() as group:
+            group.create_task(context.run())
+            group.create_task(http_client.run())
+            group.create_task(attached_file_helper.run())
+            group.create_task(feed_manager.run())
+            group.create_task(stop_after())
+    except* (ForceTerminateExecution, asyncio.CancelledError):
+        pass
+    elapsed = time.monotonic() - start
+
+    await feed_server.stop()
+    await filehost.stop()
+
+    durations = stats.scrape_durations
+    peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("Feeds             : %d (%s), concurrency %d" % (args.feeds, ', '.join(args.feed_types), args.concurrency))
+    print("Elapsed           : %.1f s" % elapsed)
+    print("Scrapes           : %d (%.2f scrapes/sec)" % (len(durations), len(durations) / elapsed))
+    print("Items saved       : %d" % producer.saved_items)
+    print("Downloaded        : %d bytes (%.0f bytes/sec)" % (stats.downloaded_bytes, stats.downloaded_bytes / elapsed))
+    print("Uploaded          : %d bytes in %d files (%.0f bytes/sec)" % (filehost.uploaded_bytes, filehost.uploads, filehost.uploaded_bytes / elapsed))
+    if len(durations) > 0:
+        print("Scrape latency    : p50 %.3f s, p90 %.3f s, p99 %.3f s, max %.3f s, mean %.3f s" % (
+            percentile(durations, 50), percentile(durations, 90), percentile(durations, 99), max(durations),
+            statistics.mean(durations)))
+    print("Bus requests      : %s" % producer.request_counts)
+    print("Peak RSS          : %.1f MB" % (peak_rss_kb / 1024))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Offline load harness for the web scraper")
+    parser.add_argument('--feeds', type=int, default=100, help="Number of feeds")
+    parser.add_argument('--feed-types', nargs='+', default=FEED_TYPES, help="Feed types, assigned round-robin")
+    parser.add_argument('--duration', type=float, default=60, help="Duration of the run in seconds")
+    parser.add_argument('--concurrency', type=int, default=10, help="Feeds scraped at the same time")
+    parser.add_argument('--poll-rate', type=int, default=120, help="Feed poll rate in seconds")
+    parser.add_argument('--items', type=int, default=20, help="Items per RSS/trends document")
+    parser.add_argument('--page-size', type=int, default=200_000, help="Size of html pages in bytes")
+    parser.add_argument('--change-interval', type=float, default=60, help="Seconds between content changes")
+    parser.add_argument('--bus-latency', type=float, default=0.002, help="Simulated bus round-trip in seconds")
+    parser.add_argument('--keymaster-cert', default=os.environ.get('CERT_PEM'),
+                        help="PEM certificate returned as the keymaster certificate (default: CERT_PEM)")
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.verbose:
+        logging.getLogger('millegrilles_webscraper').setLevel(logging.DEBUG)
+    asyncio.run(run_harness(args))
+
+
+if __name__ == '__main__':
+    main()
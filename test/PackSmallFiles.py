@@ -0,0 +1,103 @@
+"""
+Uploads small files (e.g. thumbnails) with and without pack files to a local stand-in filehost (FakeFilehost),
+then reads back each file individually with PackReader (range request on the pack) and checks the decrypted
+content. Reports the number of uploads and the upload time.
+
+The MilleGrilles certificates of a test instance are required in the environment (CA_PEM, CERT_PEM, KEY_PEM) to
+sign the filehost authentication. No MQ or filehost is used.
+
+Usage: python3 test/PackSmallFiles.py --files 200 --size 5000
+"""
+import argparse
+import asyncio
+import os
+import io
+import tempfile
+import time
+
+from asyncio import TaskGroup
+
+from millegrilles_messages.bus.BusContext import ForceTerminateExecution
+
+from millegrilles_webscraper.Configuration import WebScraperConfiguration
+from millegrilles_webscraper.Context import WebScraperContext
+from millegrilles_webscraper.DataStructures import AttachedFile
+from millegrilles_webscraper.scrapers.AttachedFileHelper import AttachedFileHelper
+
+from harness.FakeFilehost import FakeFilehost
+from harness.FakeProducer import FakeProducer, FakeBusConnector
+from harness.PackReader import PackReader
+
+
+async def upload_files(helper: AttachedFileHelper, secret_key: bytes, contents: list[bytes]) -> list[AttachedFile]:
+    attached_files = list()
+    async with helper.pack():
+        for content in contents:
+            attached_files.append(await helper.encrypt_upload_file(secret_key, io.BytesIO(content)))
+    return attached_files
+
+
+async def run(args: argparse.Namespace, pack_member_size: int):
+    filehost = FakeFilehost(store=True)
+    await filehost.start()
+
+    config = WebScraperConfiguration()
+    config.parse_config()
+    config.dir_data = tempfile.mkdtemp(prefix='webscraper_pack_')
+    config.pack_member_size = pack_member_size or None
+    context = WebScraperContext(config)
+    producer = FakeProducer(list(), list(), filehost.filehost_dict(), list())
+    context.bus_connector = FakeBusConnector(producer)
+    helper = AttachedFileHelper(context)
+
+    secret_key = os.urandom(32)
+    contents = [os.urandom(args.size) for _ in range(args.files)]
+    results = dict()
+
+    async def upload_then_stop():
+        while helper.ready is False:
+            await asyncio.sleep(0.1)
+        start = time.monotonic()
+        attached_files = await upload_files(helper, secret_key, contents)
+        results['duration'] = time.monotonic() - start
+
+        async with PackReader(filehost.url) as reader:
+            for content, attached_file in zip(contents, attached_files):
+                if await reader.read(secret_key, attached_file) != content:
+                    raise ValueError('Content mismatch for %s' % attached_file['fuuid'])
+            results['reads'] = reader.requests
+            results['packed'] = len([f for f in attached_files if f.get('pack') is not None])
+
+        context.stop()
+        await asyncio.sleep(0.5)
+        raise ForceTerminateExecution()
+
+    try:
+        async with TaskGroup() as group:
+            group.create_task(context.run())
+            group.create_task(helper.run())
+            group.create_task(upload_then_stop())
+    except* (ForceTerminateExecution, asyncio.CancelledError):
+        pass
+
+    await filehost.stop()
+
+    label = 'pack <= %d bytes' % pack_member_size if pack_member_size else 'no pack'
+    print("%-18s: %d files, %d packed, %d uploads (%d bytes), upload %.3f s, %d files read and verified" % (
+        label, args.files, results['packed'], filehost.uploads, filehost.uploaded_bytes, results['duration'],
+        results['reads']))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Small files uploaded with and without pack files")
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--size', type=int, default=5_000, help="Bytes per file")
+    parser.add_argument('--member-size', type=int, default=64 * 1024, help="Largest file added to a pack")
+    args = parser.parse_args()
+
+    await run(args, 0)
+    await run(args, args.member_size)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
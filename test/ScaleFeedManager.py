@@ -0,0 +1,192 @@
+"""
+Scale test of FeedManager and the FeedScheduler with a generated feed population (harness.FeedGenerator).
+
+Measures the duration of maintain_scraper_list (initial load and update of existing scrapers), the memory
+allocated per feed and the event loop overhead of the scheduler. Feeds are scraped by --concurrency workers
+(default 1), the feeds waiting for a worker only cost their FeedRecord in the scheduler queue.
+See BenchmarkFeedScheduler.py for the scheduling overhead without the scrapes.
+
+The MilleGrilles certificates of a test instance are required in the environment (CA_PEM, CERT_PEM, KEY_PEM),
+see LoadHarness.py.
+
+Usage: python3 test/ScaleFeedManager.py --feeds 10000 --idle 30
+"""
+import argparse
+import asyncio
+import base64
+import gc
+import logging
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+
+from asyncio import TaskGroup
+
+from millegrilles_messages.bus.BusContext import ForceTerminateExecution
+
+from millegrilles_webscraper.Configuration import WebScraperConfiguration
+from millegrilles_webscraper.Context import WebScraperContext
+from millegrilles_webscraper.HttpClient import HttpClient
+from millegrilles_webscraper.scrapers.AttachedFileHelper import AttachedFileHelper
+
+from harness.FakeFilehost import FakeFilehost
+from harness.FakeProducer import FakeProducer, FakeBusConnector
+from harness.FeedGenerator import FeedGenerator
+from harness.FeedServer import FeedServer
+from LoadHarness import HarnessFeedManager, HARNESS_KEY_ID, load_keymaster_certificates, percentile
+
+LAG_SAMPLE_INTERVAL = 0.01
+
+
+class TimedFeedManager(HarnessFeedManager):
+
+    def __init__(self, context: WebScraperContext):
+        super().__init__(context)
+        self.refresh_durations: list[float] = list()
+        self.refreshed = asyncio.Event()
+
+    async def maintain_scraper_list(self):
+        start = time.perf_counter()
+        await super().maintain_scraper_list()
+        self.refresh_durations.append(time.perf_counter() - start)
+        self.refreshed.set()
+
+
+async def measure_loop(duration: float) -> tuple[list[float], float]:
+    """
+    :return: Loop lag samples in seconds and the process cpu time used during the measure
+    """
+    loop = asyncio.get_running_loop()
+    lags = list()
+    cpu_start = time.process_time()
+    end = loop.time() + duration
+    while loop.time() < end:
+        start = loop.time()
+        await asyncio.sleep(LAG_SAMPLE_INTERVAL)
+        lags.append(max(0.0, loop.time() - start - LAG_SAMPLE_INTERVAL))
+    return lags, time.process_time() - cpu_start
+
+
+def allocation_report(before: tracemalloc.Snapshot, after: tracemalloc.Snapshot, feeds: int, limit: int = 10):
+    stats = after.compare_to(before, 'filename')
+    total = sum(s.size_diff for s in stats)
+    print("Allocated         : %.1f MB (%.1f KB/feed)" % (total / 1024 / 1024, total / feeds / 1024))
+    for stat in stats[:limit]:
+        print("    %10.1f KB  %8d blocks  %s" % (stat.size_diff / 1024, stat.count_diff, stat.traceback[0].filename))
+
+
+async def run_scale(args: argparse.Namespace):
+    feed_server = FeedServer(items_per_document=args.items, page_size=args.page_size, item_padding=args.item_padding)
+    filehost = FakeFilehost()
+    await feed_server.start()
+    await filehost.start()
+
+    config = WebScraperConfiguration()
+    config.parse_config()
+    config.dir_data = tempfile.mkdtemp(prefix='webscraper_scale_')
+    config.scrape_concurrency = args.concurrency
+    config.scrape_throttle = 0
+    config.loop_stall_threshold = 0
+    context = WebScraperContext(config)
+
+    secret_key = os.urandom(32)
+    keys = [{'cle_id': HARNESS_KEY_ID, 'cle_secrete_base64': base64.b64encode(secret_key).decode('utf-8')}]
+    generator = FeedGenerator(feed_server, secret_key, HARNESS_KEY_ID, seed=args.seed, custom_code_size=args.custom_code_size)
+
+    start = time.perf_counter()
+    feeds = generator.generate(args.feeds)
+    print("Generated         : %d feeds in %.2f s" % (len(feeds), time.perf_counter() - start))
+    feed_types = dict()
+    for feed in feeds:
+        feed_types[feed['feed_type']] = feed_types.get(feed['feed_type'], 0) + 1
+    print("Feed types        : %s" % feed_types)
+
+    producer = FakeProducer(feeds, keys, filehost.filehost_dict(), load_keymaster_certificates(args.keymaster_cert))
+    context.bus_connector = FakeBusConnector(producer)
+    http_client = HttpClient(context)
+    attached_file_helper = AttachedFileHelper(context)
+    feed_manager = TimedFeedManager(context)
+    context.http_client = http_client
+    context.file_handler = attached_file_helper
+
+    if args.tracemalloc:
+        tracemalloc.start(1)
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    gc.collect()
+    snapshot_before = tracemalloc.take_snapshot() if args.tracemalloc else None
+
+    async def measure():
+        # Initial load, the feeds are added to the scheduler
+        await feed_manager.refreshed.wait()
+        tasks = len(asyncio.all_tasks())
+        print("Initial refresh   : %.3f s (%.3f ms/feed)" % (
+            feed_manager.refresh_durations[0], feed_manager.refresh_durations[0] * 1000 / len(feeds)))
+        print("Tasks             : %d" % tasks)
+        print("Scheduler         : %s" % feed_manager.scheduler.stats().to_dict())
+        if snapshot_before is not None:
+            gc.collect()
+            allocation_report(snapshot_before, tracemalloc.take_snapshot(), len(feeds))
+            tracemalloc.stop()
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print("Peak RSS growth   : %.1f MB" % ((rss_after - rss_before) / 1024))
+
+        # Event loop overhead of the scheduler and the scrapes
+        lags, cpu = await measure_loop(args.idle)
+        print("Loop lag          : p50 %.2f ms, p99 %.2f ms, max %.2f ms" % (
+            percentile(lags, 50) * 1000, percentile(lags, 99) * 1000, max(lags) * 1000))
+        print("CPU usage         : %.1f%% over %.0f s" % (cpu * 100 / args.idle, args.idle))
+
+        # Update of the existing scrapers
+        changed = generator.mutate(producer.feeds, args.mutate)
+        await feed_manager.maintain_scraper_list()
+        print("Update refresh    : %.3f s (%d feeds changed)" % (feed_manager.refresh_durations[-1], changed))
+        print("Scrapes           : %d" % producer.request_counts.get('checkExistingDataIds', 0))
+
+        context.stop()
+        await asyncio.sleep(1)
+        raise ForceTerminateExecution()
+
+    try:
+        async with TaskGroup() as group:
+            group.create_task(context.run())
+            group.create_task(http_client.run())
+            group.create_task(attached_file_helper.run())
+            group.create_task(feed_manager.run())
+            group.create_task(measure())
+    except* (ForceTerminateExecution, asyncio.CancelledError):
+        pass
+
+    await feed_server.stop()
+    await filehost.stop()
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="FeedManager scale test with generated feeds")
+    parser.add_argument('--feeds', type=int, default=10_000, help="Number of feeds")
+    parser.add_argument('--concurrency', type=int, default=1, help="Feeds scraped at the same time (scrape workers)")
+    parser.add_argument('--idle', type=float, default=30, help="Seconds measuring the event loop overhead")
+    parser.add_argument('--mutate', type=float, default=0.1, help="Fraction of the feeds changed for the update refresh")
+    parser.add_argument('--seed', type=int, default=0, help="Seed of the feed generator")
+    parser.add_argument('--items', type=int, default=20, help="Items per RSS/trends document")
+    parser.add_argument('--item-padding', type=int, default=240, help="Bytes of description per item")
+    parser.add_argument('--page-size', type=int, default=200_000, help="Size of html pages in bytes")
+    parser.add_argument('--custom-code-size', type=int, default=2_000, help="Size of the custom code in bytes")
+    parser.add_argument('--no-tracemalloc', dest='tracemalloc', action='store_false', help="Skip the allocation report")
+    parser.add_argument('--keymaster-cert', default=os.environ.get('CERT_PEM'),
+                        help="PEM certificate returned as the keymaster certificate (default: CERT_PEM)")
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    if args.verbose:
+        logging.getLogger('millegrilles_webscraper').setLevel(logging.DEBUG)
+    asyncio.run(run_scale(args))
+
+
+if __name__ == '__main__':
+    main()
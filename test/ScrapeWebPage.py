@@ -1,17 +1,60 @@
 import asyncio
+from asyncio import TaskGroup
 
+from millegrilles_messages.bus.PikaConnector import MilleGrillesPikaConnector
 from millegrilles_webscraper.Configuration import WebScraperConfiguration
 from millegrilles_webscraper.Context import WebScraperContext
+from millegrilles_webscraper.HttpClient import HttpClient
+from millegrilles_webscraper.scrapers.AttachedFileHelper import AttachedFileHelper
 from millegrilles_webscraper.scrapers.HtmlScraper import HtmlScraper
 
 
+async def run_scrape_test(context: WebScraperContext):
+    semaphore = asyncio.BoundedSemaphore(1)
+
+    feed = {
+        'feed_id': 'Test',
+        'decrypted_feed_information': {
+            'url': 'https://www.cbc.ca/news',
+            'extraction': {
+                'items': 'a.card',
+                'fields': {
+                    'title': 'h3.headline',
+                    'snippet': 'div.description',
+                    'url': '@href',
+                    'date': 'time@datetime',
+                    'picture_url': 'img@src',
+                },
+            },
+        },
+        'poll_rate': 300,
+    }
+
+    html_scraper = HtmlScraper(context, feed, semaphore)
+    await html_scraper.run()
+
+    context.stop()
+
+
 async def main():
     config = WebScraperConfiguration.load()
     context = WebScraperContext(config)
-    semaphore = asyncio.BoundedSemaphore(1)
+    bus_connector = MilleGrillesPikaConnector(context)
+    context.bus_connector = bus_connector
+    attached_file_helper = AttachedFileHelper(context)
+    http_client = HttpClient(context)
 
-    html_scraper = HtmlScraper(context, 'https://www.dailymail.co.uk/sport/othersports/article-14443977/Joy-Taylor-sidelined-Fox-Sports-sex-lawsuit-Speak.html', semaphore)
-    await html_scraper.run()
+    # Additional wiring
+    context.file_handler = attached_file_helper
+    context.http_client = http_client
+
+    # Create tasks
+    async with TaskGroup() as group:
+        group.create_task(context.run())
+        group.create_task(bus_connector.run())
+        group.create_task(run_scrape_test(context))
+        group.create_task(attached_file_helper.run())
+        group.create_task(http_client.run())
 
 
 if __name__ == '__main__':
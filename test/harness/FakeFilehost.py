@@ -0,0 +1,95 @@
+import asyncio
+import logging
+
+from typing import Optional
+
+from aiohttp import web
+
+
+class FakeFilehost:
+    """
+    Local stand-in for the filehost authenticate and files endpoints. Files are kept in memory when store is True,
+    GET supports range requests.
+    Set latency to delay the uploads and failing to answer all requests with HTTP 503.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, store: bool = False, filehost_id: str = 'harness',
+                 latency: float = 0.0):
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.__host = host
+        self.__port = port
+        self.__store = store
+        self.__runner: Optional[web.AppRunner] = None
+        self.filehost_id = filehost_id
+        self.latency = latency
+        self.failing = False
+
+        self.files: dict[str, Optional[bytes]] = dict()
+        self.uploaded_bytes = 0
+        self.uploads = 0
+        self.downloads = 0
+        self.downloaded_bytes = 0
+        self.authentications = 0
+
+    @property
+    def url(self) -> str:
+        return 'http://%s:%d/' % (self.__host, self.__port)
+
+    def filehost_dict(self) -> dict:
+        """ :return: Value for the getFilehostForInstance response """
+        return {'filehost_id': self.filehost_id, 'url_external': self.url, 'tls_external': 'nocheck', 'instance_id': 'harness'}
+
+    async def start(self):
+        app = web.Application(client_max_size=1024 * 1024 * 1024)
+        app.router.add_post('/filehost/authenticate', self.handle_authenticate)
+        app.router.add_put('/filehost/files/{fuuid}', self.handle_put)
+        app.router.add_get('/filehost/files/{fuuid}', self.handle_get)
+        self.__runner = web.AppRunner(app)
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, self.__host, self.__port)
+        await site.start()
+        self.__port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+
+    async def handle_authenticate(self, request: web.Request) -> web.Response:
+        await request.json()
+        if self.failing:
+            return web.Response(status=503)
+        self.authentications += 1
+        return web.json_response({'ok': True})
+
+    async def handle_put(self, request: web.Request) -> web.Response:
+        fuuid = request.match_info['fuuid']
+        if self.failing:
+            return web.Response(status=503)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        content = bytearray() if self.__store else None
+        size = 0
+        async for chunk in request.content.iter_chunked(64 * 1024):
+            size += len(chunk)
+            if content is not None:
+                content.extend(chunk)
+        self.files[fuuid] = bytes(content) if content is not None else None
+        self.uploaded_bytes += size
+        self.uploads += 1
+        return web.Response(status=200)
+
+    async def handle_get(self, request: web.Request) -> web.Response:
+        fuuid = request.match_info['fuuid']
+        if self.failing:
+            return web.Response(status=503)
+        if fuuid not in self.files:
+            return web.Response(status=404)
+        content = self.files[fuuid] or b''
+        self.downloads += 1
+        if request.http_range.start is not None:
+            # Range request, used to read a member of a pack file
+            content = content[request.http_range]
+            self.downloaded_bytes += len(content)
+            return web.Response(status=206, body=content)
+        self.downloaded_bytes += len(content)
+        return web.Response(body=content)
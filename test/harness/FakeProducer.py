@@ -0,0 +1,104 @@
+import asyncio
+import logging
+
+from typing import Optional
+
+
+class FakeResponse:
+
+    def __init__(self, parsed: dict):
+        self.parsed = parsed
+
+
+class FakeProducer:
+    """
+    In-process stand-in for the bus producer. Answers the requests and commands used by the web scraper.
+    """
+
+    def __init__(self, feeds: list[dict], keys: list[dict], filehost: dict, keymaster_certificates: list[list[str]],
+                 latency: float = 0.0, filehosts: Optional[list[dict]] = None):
+        """
+        :param feeds: Feeds returned by getFeedsForScraper (FeedParametersType with encrypted_feed_information)
+        :param keys: Cleartext keys [{cle_id, cle_secrete_base64}], see HarnessFeedManager
+        :param filehost: Filehost returned by getFilehostForInstance
+        :param keymaster_certificates: PEM certificates (list of lines) returned by ficheMillegrille
+        :param latency: Simulated bus round-trip in seconds
+        :param filehosts: Filehosts returned by getFilehosts, defaults to the filehost of the instance
+        """
+        self.__logger = logging.getLogger(__name__ + '.' + self.__class__.__name__)
+        self.feeds = feeds
+        self.keys = keys
+        self.filehost = filehost
+        self.filehosts = filehosts or [filehost]
+        self.keymaster_certificates = keymaster_certificates
+        self.latency = latency
+
+        self.saved_data_ids: dict[str, set[str]] = dict()
+        self.volatile_files: dict[str, dict] = dict()
+        self.request_counts: dict[str, int] = dict()
+        self.saved_items = 0
+
+    async def request(self, message: dict, domain: str, action: str, exchange: Optional[str] = None, **kwargs) -> FakeResponse:
+        return await self.__handle(message, domain, action)
+
+    async def command(self, message: dict, domain: str, action: str, exchange: Optional[str] = None, **kwargs) -> FakeResponse:
+        return await self.__handle(message, domain, action)
+
+    async def __handle(self, message: dict, domain: str, action: str) -> FakeResponse:
+        self.request_counts[action] = self.request_counts.get(action, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        handler = getattr(self, '_handle_' + action, None)
+        if handler is None:
+            self.__logger.warning("Unhandled action %s.%s" % (domain, action))
+            return FakeResponse({'ok': False, 'err': 'Unhandled action %s' % action})
+        return FakeResponse(handler(message))
+
+    def _handle_getFeedsForScraper(self, message: dict) -> dict:
+        return {'ok': True, 'feeds': [dict(f) for f in self.feeds], 'keys': {'cles': self.keys}}
+
+    def _handle_checkExistingDataIds(self, message: dict) -> dict:
+        saved = self.saved_data_ids.get(message['feed_id']) or set()
+        return {'ok': True, 'missing_ids': [d for d in message['data_ids'] if d not in saved]}
+
+    def _handle_saveDataItem(self, message: dict) -> dict:
+        saved = self.saved_data_ids.setdefault(message['feed_id'], set())
+        if message['data_id'] in saved:
+            return {'ok': False, 'code': 409}
+        saved.add(message['data_id'])
+        self.saved_items += 1
+        return {'ok': True}
+
+    def _handle_saveDataItemV2(self, message: dict) -> dict:
+        return self._handle_saveDataItem(message)
+
+    def _handle_ficheMillegrille(self, message: dict) -> dict:
+        return {'ok': True, 'chiffrage': self.keymaster_certificates}
+
+    def _handle_getFilehostForInstance(self, message: dict) -> dict:
+        return {'ok': True, 'filehost': self.filehost}
+
+    def _handle_getFilehosts(self, message: dict) -> dict:
+        return {'ok': True, 'list': self.filehosts}
+
+    def _handle_addFuuidsVolatile(self, message: dict) -> dict:
+        for f in message['files']:
+            self.volatile_files[f['correlation']] = f
+        return {'ok': True}
+
+    def _handle_getFuuidsVolatile(self, message: dict) -> dict:
+        files = [self.volatile_files[c] for c in message['correlations'] if c in self.volatile_files]
+        return {'ok': True, 'files': files}
+
+
+class FakeBusConnector:
+    """
+    Replaces MilleGrillesPikaConnector on the context.
+    """
+
+    def __init__(self, producer: FakeProducer):
+        self.__producer = producer
+
+    async def get_producer(self):
+        return self.__producer
@@ -0,0 +1,144 @@
+import random
+
+from typing import Optional
+
+from millegrilles_messages.chiffrage.Mgs4 import chiffrer_document
+
+from harness.FeedServer import FeedServer
+
+# Weights of the generated feed types
+DEFAULT_FEED_TYPES = {
+    'web.google_trends.news': 5,
+    'web.google_trends.news.multi_region': 1,
+    'web.scraper.rss': 3,
+    'web.scraper.python_custom': 2,
+}
+
+# Weights of the poll rates (seconds), most feeds poll every few minutes
+DEFAULT_POLL_RATES = {120: 3, 300: 3, 900: 2, 3600: 1.5, 86400: 0.5}
+
+# Weights of the content change intervals (seconds) of the generated documents
+DEFAULT_CHANGE_INTERVALS = {60: 1, 300: 3, 1800: 3, 3600: 2, 86400: 1}
+
+GEOS = ['US', 'CA', 'GB', 'FR', 'DE', 'BR', 'IN', 'JP', 'AU', 'MX']
+
+USER_AGENTS = [
+    None,
+    'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:138.0) Gecko/20100101 Firefox/138.0',
+    'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0 Safari/537.36',
+]
+
+# Custom code run by python_custom feeds: reads the page and returns the publication dates, no attached files.
+CUSTOM_CODE_TEMPLATE = """
+import datetime
+
+from millegrilles_webscraper.DataStructures import CustomProcessOutput
+
+# Generated feed %(name)s
+%(padding)s
+
+async def process(context, encryption_key, input_file) -> CustomProcessOutput:
+    lines = 0
+    for _line in input_file:
+        lines += 1
+    output = CustomProcessOutput()
+    now = datetime.datetime.now(tz=datetime.timezone.utc)
+    output.pub_date_start = now - datetime.timedelta(seconds=%(window)d)
+    output.pub_date_end = now
+    return output
+"""
+
+
+class FeedGenerator:
+    """
+    Generates populations of feeds (FeedParametersType) for scale tests. The feed information is encrypted like
+    the feeds received from DataCollector and points to documents of the FeedServer. Generation is deterministic
+    for a given seed.
+    """
+
+    def __init__(self, feed_server: FeedServer, secret_key: bytes, key_id: str, seed: int = 0,
+                 feed_types: Optional[dict[str, float]] = None, poll_rates: Optional[dict[int, float]] = None,
+                 change_intervals: Optional[dict[float, float]] = None, custom_code_size: int = 2_000):
+        """
+        :param feed_types: Weight of each feed type
+        :param poll_rates: Weight of each poll rate in seconds
+        :param change_intervals: Weight of each document change interval in seconds
+        :param custom_code_size: Approximate size in bytes of the custom code of python_custom feeds
+        """
+        self.__feed_server = feed_server
+        self.__secret_key = secret_key
+        self.__key_id = key_id
+        self.__random = random.Random(seed)
+        self.__feed_types = feed_types or DEFAULT_FEED_TYPES
+        self.__poll_rates = poll_rates or DEFAULT_POLL_RATES
+        self.__change_intervals = change_intervals or DEFAULT_CHANGE_INTERVALS
+        self.__custom_code_size = custom_code_size
+
+    def generate(self, count: int, start: int = 0) -> list[dict]:
+        return [self.feed(i) for i in range(start, start + count)]
+
+    def feed(self, index: int) -> dict:
+        feed_type = self.__choice(self.__feed_types)
+        name = 'feed%06d' % index
+        feed_information = self.__feed_information(name, feed_type, self.__choice(self.__change_intervals))
+        return {
+            'feed_id': name,
+            'feed_type': feed_type,
+            'security_level': '1.public',
+            'domain': 'DataCollector',
+            'poll_rate': self.__choice(self.__poll_rates),
+            'active': True,
+            'decrypt_in_database': False,
+            'encrypted_feed_information': self.__encrypt(feed_information),
+            'decrypted_feed_information': None,
+            'deleted': False,
+        }
+
+    def mutate(self, feeds: list[dict], fraction: float) -> int:
+        """
+        Changes the poll rate and re-encrypts the information of a fraction of the feeds, exercises the update
+        of existing scrapers on the next refresh.
+        :return: Number of feeds changed
+        """
+        count = int(len(feeds) * fraction)
+        for feed in self.__random.sample(feeds, count):
+            feed['poll_rate'] = self.__choice(self.__poll_rates)
+            feed_information = self.__feed_information(feed['feed_id'], feed['feed_type'], self.__choice(self.__change_intervals))
+            feed['encrypted_feed_information'] = self.__encrypt(feed_information)
+        return count
+
+    def __feed_information(self, name: str, feed_type: str, change_interval: float) -> dict:
+        feed_server = self.__feed_server
+        feed_information = {'name': name}
+
+        user_agent = self.__random.choice(USER_AGENTS)
+        if user_agent:
+            feed_information['user_agent'] = user_agent
+
+        if feed_type == 'web.google_trends.news':
+            feed_information['url'] = feed_server.trends_url(name, self.__random.choice(GEOS), change_interval)
+        elif feed_type == 'web.google_trends.news.multi_region':
+            feed_information['url'] = feed_server.trends_url(name, change_interval=change_interval)
+            feed_information['geos'] = self.__random.sample(GEOS, self.__random.randint(2, 5))
+        elif feed_type == 'web.scraper.rss':
+            feed_information['url'] = feed_server.rss_url(name, change_interval)
+        elif feed_type == 'web.scraper.python_custom':
+            feed_information['url'] = feed_server.page_url(name, change_interval)
+            feed_information['custom_code'] = self.__custom_code(name)
+        else:
+            raise ValueError('Unsupported feed type: %s' % feed_type)
+
+        return feed_information
+
+    def __custom_code(self, name: str) -> str:
+        padding_line = '# Lorem ipsum dolor sit amet, consectetur adipiscing elit.\n'
+        padding = padding_line * max(0, self.__custom_code_size // len(padding_line) - 15)
+        return CUSTOM_CODE_TEMPLATE % {'name': name, 'padding': padding, 'window': self.__random.choice([3600, 86400])}
+
+    def __encrypt(self, feed_information: dict) -> dict:
+        encrypted_feed_information = chiffrer_document(self.__secret_key, self.__key_id, feed_information)
+        encrypted_feed_information['cle_id'] = self.__key_id
+        return encrypted_feed_information
+
+    def __choice(self, weights: dict):
+        return self.__random.choices(list(weights.keys()), weights=list(weights.values()))[0]
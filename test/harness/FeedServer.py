@@ -0,0 +1,165 @@
+import os
+import time
+import zlib
+
+from email.utils import format_datetime
+from typing import Optional
+from xml.sax.saxutils import escape
+
+import datetime
+
+from aiohttp import web
+
+NAMESPACE_HT = 'https://trends.google.com/trending/rss'
+
+
+class FeedServer:
+    """
+    Local http server producing synthetic Google Trends RSS, RSS and html documents and images.
+
+    Content of a feed changes every change_interval seconds: the items of a document are generated from the
+    feed name and the current period, a new period produces new items. The change query parameter of a url
+    overrides change_interval for that feed.
+    """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, items_per_document: int = 20,
+                 page_size: int = 200_000, image_size: int = 20_000, image_pool: int = 50, change_interval: float = 60.0,
+                 item_padding: int = 240):
+        """
+        :param items_per_document: Items in each RSS/trends document
+        :param item_padding: Bytes of description text in each RSS/trends item
+        :param page_size: Size in bytes of html pages
+        :param image_size: Size in bytes of images
+        :param image_pool: Number of distinct images, shared by all feeds
+        :param change_interval: Seconds between content changes of a feed
+        """
+        self.__host = host
+        self.__port = port
+        self.__runner: Optional[web.AppRunner] = None
+        self.items_per_document = items_per_document
+        self.page_size = page_size
+        self.image_size = image_size
+        self.image_pool = image_pool
+        self.change_interval = change_interval
+        self.item_padding = item_padding
+
+        self.__images = [os.urandom(image_size) for _ in range(image_pool)]
+        self.requests = 0
+        self.served_bytes = 0
+
+    @property
+    def url(self) -> str:
+        return 'http://%s:%d' % (self.__host, self.__port)
+
+    def trends_url(self, name: str, geo: str = 'US', change_interval: Optional[float] = None) -> str:
+        return '%s/trends/%s.xml?geo=%s%s' % (self.url, name, geo, _change_query(change_interval, '&'))
+
+    def rss_url(self, name: str, change_interval: Optional[float] = None) -> str:
+        return '%s/rss/%s.xml%s' % (self.url, name, _change_query(change_interval))
+
+    def page_url(self, name: str, change_interval: Optional[float] = None) -> str:
+        return '%s/pages/%s.html%s' % (self.url, name, _change_query(change_interval))
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/trends/{name}.xml', self.handle_trends)
+        app.router.add_get('/rss/{name}.xml', self.handle_rss)
+        app.router.add_get('/pages/{name}.html', self.handle_page)
+        app.router.add_get('/images/{index}.jpg', self.handle_image)
+        self.__runner = web.AppRunner(app)
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, self.__host, self.__port)
+        await site.start()
+        self.__port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+
+    def __period(self, change_interval: Optional[float] = None) -> int:
+        return int(time.time() / (change_interval or self.change_interval))
+
+    def __padding(self) -> str:
+        text = 'Lorem ipsum dolor sit amet. '
+        return (text * (self.item_padding // len(text) + 1))[:self.item_padding]
+
+    def __respond(self, body: bytes, content_type: str) -> web.Response:
+        self.requests += 1
+        self.served_bytes += len(body)
+        return web.Response(body=body, content_type=content_type)
+
+    def __image_url(self, seed: str) -> str:
+        return '%s/images/%d.jpg' % (self.url, zlib.crc32(seed.encode('utf-8')) % self.image_pool)
+
+    async def handle_trends(self, request: web.Request) -> web.Response:
+        name = request.match_info['name']
+        geo = request.query.get('geo', 'US')
+        document = self.trends_document(name, geo, _change_interval(request))
+        return self.__respond(document.encode('utf-8'), 'application/rss+xml')
+
+    async def handle_rss(self, request: web.Request) -> web.Response:
+        name = request.match_info['name']
+        return self.__respond(self.rss_document(name, _change_interval(request)).encode('utf-8'), 'application/rss+xml')
+
+    async def handle_page(self, request: web.Request) -> web.Response:
+        name = request.match_info['name']
+        return self.__respond(self.html_page(name, _change_interval(request)), 'text/html')
+
+    async def handle_image(self, request: web.Request) -> web.Response:
+        index = int(request.match_info['index']) % self.image_pool
+        return self.__respond(self.__images[index], 'image/jpeg')
+
+    def trends_document(self, name: str, geo: str, change_interval: Optional[float] = None) -> str:
+        change_interval = change_interval or self.change_interval
+        period = self.__period(change_interval)
+        pub_date = format_datetime(datetime.datetime.fromtimestamp(period * change_interval, tz=datetime.timezone.utc))
+        padding = self.__padding()
+        items = list()
+        for i in range(self.items_per_document):
+            # News urls do not depend on the geo, regions share stories
+            story = '%s-%d-%d' % (name, period, i)
+            items.append(
+                '<item><title>Trend %s</title><ht:approx_traffic>%d+</ht:approx_traffic><pubDate>%s</pubDate>'
+                '<ht:picture>%s</ht:picture><ht:picture_source>Harness</ht:picture_source>'
+                '<ht:news_item><ht:news_item_title>Story %s</ht:news_item_title>'
+                '<ht:news_item_snippet>%s</ht:news_item_snippet>'
+                '<ht:news_item_url>https://news.example.com/%s</ht:news_item_url>'
+                '<ht:news_item_picture>%s</ht:news_item_picture><ht:news_item_source>Harness</ht:news_item_source>'
+                '</ht:news_item></item>' % (
+                    escape(story), (i + 1) * 1000, pub_date, self.__image_url(story + 'group'),
+                    escape(story), padding, escape(story), self.__image_url(story)))
+        return ('<?xml version="1.0" encoding="UTF-8"?><rss version="2.0" xmlns:ht="%s"><channel>'
+                '<title>Trends %s</title>%s</channel></rss>' % (NAMESPACE_HT, geo, ''.join(items)))
+
+    def rss_document(self, name: str, change_interval: Optional[float] = None) -> str:
+        change_interval = change_interval or self.change_interval
+        period = self.__period(change_interval)
+        pub_date = format_datetime(datetime.datetime.fromtimestamp(period * change_interval, tz=datetime.timezone.utc))
+        padding = self.__padding()
+        items = list()
+        for i in range(self.items_per_document):
+            item_id = '%s-%d-%d' % (name, period, i)
+            items.append(
+                '<item><title>Article %s</title><link>https://news.example.com/%s</link><guid>%s</guid>'
+                '<pubDate>%s</pubDate><description>%s</description></item>' % (
+                    escape(item_id), escape(item_id), escape(item_id), pub_date, padding))
+        return ('<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel><title>%s</title>%s</channel></rss>' %
+                (escape(name), ''.join(items)))
+
+    def html_page(self, name: str, change_interval: Optional[float] = None) -> bytes:
+        period = self.__period(change_interval)
+        header = ('<html><head><title>%s %d</title></head><body>' % (escape(name), period)).encode('utf-8')
+        line = b'<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit.</p>\n'
+        body = line * max(1, (self.page_size - len(header)) // len(line))
+        return header + body + b'</body></html>'
+
+
+def _change_query(change_interval: Optional[float], separator: str = '?') -> str:
+    if change_interval is None:
+        return ''
+    return '%schange=%s' % (separator, change_interval)
+
+
+def _change_interval(request: web.Request) -> Optional[float]:
+    change = request.query.get('change')
+    return float(change) if change else None
@@ -0,0 +1,59 @@
+import binascii
+
+from typing import Optional
+from urllib.parse import urljoin
+
+import aiohttp
+
+from millegrilles_messages.chiffrage.Mgs4 import DecipherMgs4
+
+from millegrilles_webscraper.DataStructures import AttachedFile
+from millegrilles_webscraper.scrapers.PackFile import pack_range_header
+
+
+class PackReader:
+    """
+    Local stand-in for a reader of attached files. Members of a pack file are fetched with a range request, other
+    files are fetched whole. The content is decrypted with the secret key.
+    """
+
+    def __init__(self, filehost_url: str):
+        self.__filehost_url = filehost_url
+        self.__session: Optional[aiohttp.ClientSession] = None
+        self.requests = 0
+        self.bytes_read = 0
+
+    async def __aenter__(self):
+        self.__session = aiohttp.ClientSession()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.__session.close()
+
+    async def fetch(self, attached_file: AttachedFile) -> bytes:
+        """ :return: Encrypted content of the file """
+        reference = attached_file.get('pack')
+        if reference is not None:
+            url = urljoin(self.__filehost_url, '/filehost/files/%s' % reference['fuuid'])
+            headers = pack_range_header(reference)
+            expected_status = 206
+        else:
+            url = urljoin(self.__filehost_url, '/filehost/files/%s' % attached_file['fuuid'])
+            headers = None
+            expected_status = 200
+
+        async with self.__session.get(url, headers=headers) as response:
+            if response.status != expected_status:
+                raise ValueError('Unexpected status %d for %s' % (response.status, attached_file['fuuid']))
+            content = await response.read()
+        self.requests += 1
+        self.bytes_read += len(content)
+        return content
+
+    async def read(self, secret_key: bytes, attached_file: AttachedFile) -> bytes:
+        """ :return: Decrypted content of the file """
+        content = await self.fetch(attached_file)
+        nonce = attached_file['nonce']
+        header = binascii.a2b_base64(nonce + '=' * (-len(nonce) % 4))
+        decipher = DecipherMgs4(secret_key, header)
+        return decipher.update(content) + decipher.finalize()